@@ -1,8 +1,11 @@
+from functools import partial
+
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import Permission
 
 from apps.account.models import RoleGroup, UserRoleGroup, UserPermission, GroupPermission
-from django.db import connection
+from apps.account.permission import invalidate_permissions, invalidate_group_permissions
+from django.db import connection, transaction
 
 
 def service_get_user_detail(user_id, is_list=False, is_check=False):
@@ -98,12 +101,18 @@ def service_get_role_group_detail(group_id, is_detail=False, is_list=False, is_c
 def service_assign_perm(user_id_list, permission_code, doc_id_list):
     try:
         permission = Permission.objects.get(codename=permission_code)
-        user_list = [get_user_model().objects.get(pk=user) for user in user_id_list]
-        for doc_id in doc_id_list:
-            for user in user_list:
-                doc_type = '_'.join(permission_code.split('_')[-2:])
-                user_perm = UserPermission.objects.create(user=user, permission=permission, doc_id=doc_id,
-                                                          doc_type=doc_type)
+        user_ids = set(get_user_model().objects.filter(pk__in=user_id_list).values_list('id', flat=True))
+        if len(user_ids) != len(set(str(user_id) for user_id in user_id_list)):
+            raise get_user_model().DoesNotExist()
+        doc_type = '_'.join(permission_code.split('_')[-2:])
+        # only the (user, doc) pairs not granted yet
+        existing = set((user_id, str(doc_id)) for user_id, doc_id in UserPermission.objects.filter(
+            user_id__in=user_ids, permission=permission, doc_id__in=doc_id_list).values_list('user_id', 'doc_id'))
+        user_perms = [UserPermission(user_id=user_id, permission=permission, doc_id=doc_id, doc_type=doc_type)
+                      for doc_id in doc_id_list for user_id in user_ids if (user_id, str(doc_id)) not in existing]
+        with transaction.atomic():
+            UserPermission.objects.bulk_create(user_perms, batch_size=500)
+            transaction.on_commit(partial(invalidate_permissions, *user_ids))
         return True
     except Exception as e:
         print(e)
@@ -210,78 +219,83 @@ class RolePermHandleApplyFor:
                 del kwargs[key]
         return kwargs
 
-    def handle(self):
-        if self.role:
-            # add
-            for perm_data in self.perm_data_add:
-                try:
-                    permission = Permission.objects.filter(codename=perm_data['codename']).first()
-                    if permission:
-                        kw_data = self.convert_data(perm_data)
-                        role_perm = GroupPermission.objects.filter(group_id=self.role.id, permission_id=permission.id, **kw_data).first()
-                        if role_perm:
-                            for key in ['doc_type', 'doc_id']:
-                                if key in perm_data:
-                                    setattr(role_perm, key, perm_data[key])
-                            role_perm.save()
-                        else:
-                            GroupPermission.objects.create(group_id=self.role.id, permission_id=permission.id, **kw_data)
-                    else:
-                        print('perm error ', perm_data)
-                except Exception as e:
-                    print(e)
+    @staticmethod
+    def matches(row, permission_id, kw_data):
+        if row['permission_id'] != permission_id:
+            return False
+        return all(str(row[key]) == str(value) if value is not None else row[key] is None
+                   for key, value in kw_data.items())
+
+    def apply(self, model, owner, invalidate):
+        """
+        diff perm_data_add / perm_data_remove against the current rows of owner
+        in memory and write the delta in one transaction, invalidate runs once
+        it commits; returns the counts
+        """
+        codenames = set(perm_data['codename'] for perm_data in self.perm_data_add + self.perm_data_remove)
+        permissions = {}
+        for codename, permission_id in Permission.objects.filter(codename__in=codenames).order_by(
+                'id').values_list('codename', 'id'):
+            permissions.setdefault(codename, permission_id)
+        rows = list(model.objects.filter(permission_id__in=permissions.values(), **owner).values(
+            'id', 'permission_id', 'doc_type', 'doc_id'))
+
+        result = {'added': 0, 'removed': 0, 'unchanged': 0, 'missing': 0, 'invalid': 0}
+        created = []
+        for perm_data in self.perm_data_add:
+            permission_id = permissions.get(perm_data['codename'], None)
+            if not permission_id:
+                print('perm error ', perm_data)
+                result['invalid'] += 1
+                continue
+            kw_data = self.convert_data(perm_data)
+            if any(self.matches(row, permission_id, kw_data) for row in rows):
+                result['unchanged'] += 1
+                continue
+            perm = model(permission_id=permission_id, **owner, **kw_data)
+            created.append(perm)
+            rows.append({'id': perm.id, 'permission_id': permission_id, 'doc_type': perm.doc_type,
+                         'doc_id': perm.doc_id})
+
+        removed = set()
+        for perm_data in self.perm_data_remove:
+            permission_id = permissions.get(perm_data['codename'], None)
+            if not permission_id:
+                print('perm error ', perm_data)
+                result['invalid'] += 1
+                continue
+            kw_data = self.convert_data(perm_data)
+            row = next((row for row in rows if row['id'] not in removed and self.matches(row, permission_id, kw_data)),
+                       None)
+            if row:
+                removed.add(row['id'])
+            else:
+                print('role not found: ', perm_data)
+                result['missing'] += 1
 
-            # remove
-            for perm_data in self.perm_data_remove:
-                try:
-                    permission = Permission.objects.filter(codename=perm_data['codename']).first()
-                    if permission:
-                        kw_data = self.convert_data(perm_data)
-                        role_perm = GroupPermission.objects.filter(group_id=self.role.id, permission_id=permission.id, **kw_data).first()
-                        if role_perm:
-                            role_perm.delete()
-                        else:
-                            print('role not found: ', perm_data)
-                    else:
-                        print('perm error ', perm_data)
-                except Exception as e:
-                    print(e)
-            return True
-        elif self.ref_type == 'user':
-            user_obj = get_user_model().objects.filter(id=self.ref_id).first()
-            if user_obj:
-                for perm_data in self.perm_data_add:
-                    try:
-                        permission = Permission.objects.filter(codename=perm_data['codename']).first()
-                        if permission:
-                            kw_data = self.convert_data(perm_data)
-                            role_perm = UserPermission.objects.filter(user_id=user_obj.id, permission_id=permission.id, **kw_data).first()
-                            if role_perm:
-                                for key in ['doc_type', 'doc_id']:
-                                    if key in perm_data:
-                                        setattr(role_perm, key, perm_data[key])
-                                role_perm.save()
-                            else:
-                                UserPermission.objects.create(user_id=user_obj.id, permission_id=permission.id, **kw_data)
-                        else:
-                            print('perm error ', perm_data)
-                    except Exception as e:
-                        print(e)
+        # a permission added and removed by the same call is never written
+        created_ids = set(perm.id for perm in created)
+        created = [perm for perm in created if perm.id not in removed]
+        removed = [pk for pk in removed if pk not in created_ids]
+        with transaction.atomic():
+            model.objects.bulk_create(created, batch_size=500)
+            if len(removed) > 0:
+                # one statement, the permission signals would query once per deleted row
+                model.objects.filter(id__in=removed)._raw_delete(model.objects.db)
+            transaction.on_commit(invalidate)
+        result['added'], result['removed'] = len(created), len(removed)
+        return result
 
-                # remove
-                for perm_data in self.perm_data_remove:
-                    try:
-                        permission = Permission.objects.filter(codename=perm_data['codename']).first()
-                        if permission:
-                            kw_data = self.convert_data(perm_data)
-                            role_perm = UserPermission.objects.filter(user_id=user_obj.id, permission_id=permission.id, **kw_data).first()
-                            if role_perm:
-                                role_perm.delete()
-                            else:
-                                print('role not found: ', perm_data)
-                        else:
-                            print('perm error ', perm_data)
-                    except Exception as e:
-                        print(e)
-                return True
+    def handle(self):
+        try:
+            if self.role:
+                return self.apply(GroupPermission, {'group_id': self.role.id},
+                                  partial(invalidate_group_permissions, self.role.id))
+            elif self.ref_type == 'user':
+                user_obj = get_user_model().objects.filter(id=self.ref_id).first()
+                if user_obj:
+                    return self.apply(UserPermission, {'user_id': user_obj.id},
+                                      partial(invalidate_permissions, user_obj.id))
+        except Exception as e:
+            print(e)
         return False
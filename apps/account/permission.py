@@ -1,9 +1,151 @@
+import collections
+from uuid import uuid4
+
+from django.conf import settings
 from django.contrib.auth.models import Permission
+from django.core.cache import cache
 from django.db.models import Q
 
 from apps.account.models import UserPermission, GroupPermission, UserRoleGroup
-from apps.account.utils import format_codename_to_all
-from apps.base.middleware import get_user_extra
-from serverCjinn import settings
+
+# one granted permission, doc_id is a str or None for application wide grants
+PermissionEntry = collections.namedtuple('PermissionEntry', ['app_label', 'model', 'codename', 'name', 'doc_id',
+                                                             'doc_type', 'option', 'more', 'lower_level'])
+
+ENTRY_FIELDS = ('permission__content_type__app_label', 'permission__content_type__model', 'permission__codename',
+                'permission__name', 'doc_id', 'doc_type', 'option', 'more', 'lower_level')
+
+
+class PermissionSet:
+    """
+    effective permissions of a user, direct grants and the grants of every
+    role group, indexed by app_label then doc_id so lookups are dict reads
+    """
+
+    def __init__(self, user_entries=(), group_entries=()):
+        self.user = self.index(user_entries)
+        self.groups = self.index(group_entries)
+
+    @staticmethod
+    def index(entries):
+        result = {}
+        for entry in entries:
+            result.setdefault(entry.app_label, {}).setdefault(entry.doc_id, []).append(entry)
+        return result
+
+    @staticmethod
+    def lookup(index, application=None, doc_id=None, doc_type=None, model=None, codename=None):
+        doc_id = str(doc_id) if doc_id else None
+        apps = [application] if application else index.keys()
+        result = []
+        for app_label in apps:
+            for entry in index.get(app_label, {}).get(doc_id, ()):
+                if doc_type and entry.doc_type != doc_type:
+                    continue
+                if model and entry.model != model:
+                    continue
+                if codename and entry.codename != codename:
+                    continue
+                result.append(entry)
+        return result
+
+    @classmethod
+    def load(cls, user_id):
+        """two queries, direct grants and role group grants"""
+        user_entries = UserPermission.objects.filter(user_id=user_id).values_list(*ENTRY_FIELDS).distinct()
+        group_ids = UserRoleGroup.objects.filter(user_id=user_id).values('group_id')
+        group_entries = GroupPermission.objects.filter(group_id__in=group_ids).values_list(*ENTRY_FIELDS)
+        return cls([cls.make_entry(row) for row in user_entries], [cls.make_entry(row) for row in group_entries])
+
+    @staticmethod
+    def make_entry(row):
+        entry = PermissionEntry(*row)
+        return entry._replace(doc_id=str(entry.doc_id) if entry.doc_id else None)
+
+
+def permission_prefix(user_id, generation):
+    return f'permissions:{user_id.__str__()}:{generation}'
+
+
+def generation_prefix(user_id):
+    return f'permissions:generation:{user_id.__str__()}'
+
+
+def get_permission_generation(user_id):
+    """current generation of a user's permissions, a new one is issued on every invalidation"""
+    key = generation_prefix(user_id)
+    generation = cache.get(key)
+    if generation is None:
+        generation = uuid4().hex
+        if not cache.add(key, generation, timeout=settings.PERMISSION_CACHE_TIMEOUT):
+            generation = cache.get(key) or generation
+    return generation
+
+
+def get_permission_set(user):
+    """
+    the PermissionSet of a user, cached per user and generation; the copy kept
+    on the instance is only trusted while its generation is current, so a
+    long-lived user sees grants changed after it was loaded
+    """
+    generation = get_permission_generation(user.id)
+    memo = getattr(user, '_permission_set', None)
+    if memo is not None and memo[0] == generation:
+        return memo[1]
+    key = permission_prefix(user.id, generation)
+    permission_set = cache.get(key)
+    if permission_set is None:
+        permission_set = PermissionSet.load(user.id)
+        cache.set(key, permission_set, timeout=settings.PERMISSION_CACHE_TIMEOUT)
+    user._permission_set = (generation, permission_set)
+    return permission_set
+
+
+def invalidate_permissions(*user_ids):
+    """move the users to a new generation, every cached and memoised set of theirs goes stale"""
+    cache.set_many({generation_prefix(user_id): uuid4().hex for user_id in user_ids},
+                   timeout=settings.PERMISSION_CACHE_TIMEOUT)
+
+
+def invalidate_group_permissions(*group_ids):
+    """drop the cached sets of every member of the role groups"""
+    user_ids = UserRoleGroup.objects.filter(group_id__in=group_ids).values_list('user_id', flat=True).distinct()
+    invalidate_permissions(*user_ids)
+
+
+def get_admin_favor_permissions():
+    """PERMISSION_ADMIN_FAVOR permissions as PermissionEntry without grant data, cached globally"""
+    entries = cache.get('permissions:admin_favor')
+    if entries is None:
+        admin_filter = Q()
+        for admin_granted in settings.PERMISSION_ADMIN_FAVOR:
+            admin_filter.add(Q(content_type__app_label=admin_granted['app_label'],
+                               content_type__model=admin_granted['model']), Q.OR)
+        entries = []
+        if admin_filter:
+            entries = [PermissionEntry(app_label, model, codename, name, None, None, None, [], False)
+                       for app_label, model, codename, name in Permission.objects.filter(admin_filter).values_list(
+                    'content_type__app_label', 'content_type__model', 'codename', 'name')]
+        cache.set('permissions:admin_favor', entries, timeout=settings.PERMISSION_CACHE_TIMEOUT)
+    return entries
+
+
+def admin_favor(application=None, doc_id=None, model=None, codename=None):
+    """the admin favor permissions a staff user gets for a lookup"""
+    entries = get_admin_favor_permissions()
+    if application is None and model is None:
+        if doc_id is None and codename is None:
+            return entries
+        if codename is not None:
+            return [entry for entry in entries if entry.codename == codename]
+        return []
+    if application is None:
+        return []
+    return [entry for entry in entries if entry.app_label == application and (model is None or entry.model == model)]
 
 
+def to_dict(entry, **kwargs):
+    result = {'name': entry.name, 'codename': entry.codename, 'option': entry.option, 'more': entry.more,
+              'lower_level': entry.lower_level}
+    result.update(kwargs)
+    return result
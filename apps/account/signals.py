@@ -0,0 +1,19 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from apps.account.models import UserPermission, GroupPermission, UserRoleGroup
+from apps.account.permission import invalidate_permissions, invalidate_group_permissions
+
+
+@receiver(post_save, sender=UserPermission)
+@receiver(post_delete, sender=UserPermission)
+@receiver(post_save, sender=UserRoleGroup)
+@receiver(post_delete, sender=UserRoleGroup)
+def refresh_user_permissions(sender, instance, **kwargs):
+    invalidate_permissions(instance.user_id)
+
+
+@receiver(post_save, sender=GroupPermission)
+@receiver(post_delete, sender=GroupPermission)
+def refresh_group_permissions(sender, instance, **kwargs):
+    invalidate_group_permissions(instance.group_id)
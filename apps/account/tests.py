@@ -1,3 +1,91 @@
+from uuid import uuid4
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Permission
+from django.contrib.contenttypes.models import ContentType
 from django.test import TestCase
 
-# Create your tests here.
+from apps.account.func import service_assign_perm, service_handle_perm_apply_for
+from apps.account.models import RoleGroup, UserRoleGroup, GroupPermission
+from apps.account.permission import PermissionSet, get_permission_set
+from apps.account.utils import list_perm
+
+UserModel = get_user_model()
+
+
+class PermissionTestCase(TestCase):
+    def setUp(self):
+        self.user = UserModel.objects.create(username='alice', email='alice@example.com')
+        content_type = ContentType.objects.get_for_model(RoleGroup)
+        self.view = Permission.objects.create(codename='view_test_crm_workspace', name='Can view workspace',
+                                              content_type=content_type)
+        self.change = Permission.objects.create(codename='change_test_crm_workspace', name='Can change workspace',
+                                                content_type=content_type)
+        self.doc_id = uuid4()
+
+    def grant(self, codename):
+        return {'codename': codename, 'doc_type': 'crm_workspace', 'doc_id': str(self.doc_id)}
+
+    @staticmethod
+    def codenames(entries):
+        return sorted(entry['codename'] if isinstance(entry, dict) else entry.codename for entry in entries)
+
+
+class PermissionCacheTests(PermissionTestCase):
+    def test_memo_is_reused_until_invalidated(self):
+        self.assertEqual(list_perm(self.user, doc_id=self.doc_id), [])
+        # the set memoised on the instance only costs the generation check
+        with self.assertNumQueries(0):
+            list_perm(self.user, doc_id=self.doc_id)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertTrue(service_assign_perm([self.user.id], self.view.codename, [self.doc_id]))
+        # same long-lived instance, the new grant is seen once committed
+        self.assertEqual(self.codenames(list_perm(self.user, doc_id=self.doc_id)), [self.view.codename])
+
+    def test_group_grants_invalidate_members(self):
+        role = RoleGroup.objects.create(name='department system', is_hidden=True, ref_id=uuid4(), ref_type='department')
+        UserRoleGroup.objects.create(user=self.user, group=role)
+        self.assertEqual(PermissionSet.lookup(get_permission_set(self.user).groups, doc_id=self.doc_id), [])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            service_handle_perm_apply_for(role.ref_id, role.ref_type, [self.grant(self.view.codename)], [])
+        self.assertEqual(self.codenames(PermissionSet.lookup(get_permission_set(self.user).groups,
+                                                             doc_id=self.doc_id)), [self.view.codename])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            service_handle_perm_apply_for(role.ref_id, role.ref_type, [], [self.grant(self.view.codename)])
+        self.assertEqual(PermissionSet.lookup(get_permission_set(self.user).groups, doc_id=self.doc_id), [])
+
+
+class RolePermDiffTests(PermissionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.ref_id = uuid4()
+
+    def apply(self, perm_add=(), perm_remove=()):
+        return service_handle_perm_apply_for(self.ref_id, 'department', list(perm_add), list(perm_remove))
+
+    def stored(self):
+        return sorted(GroupPermission.objects.filter(group__ref_id=self.ref_id).values_list(
+            'permission__codename', flat=True))
+
+    def test_only_the_delta_is_written(self):
+        result = self.apply([self.grant(self.view.codename)])
+        self.assertEqual((result['added'], result['unchanged']), (1, 0))
+
+        result = self.apply([self.grant(self.view.codename), self.grant(self.change.codename)])
+        self.assertEqual((result['added'], result['unchanged']), (1, 1))
+        self.assertEqual(self.stored(), [self.change.codename, self.view.codename])
+
+    def test_remove_and_unknown_grants(self):
+        self.apply([self.grant(self.view.codename)])
+        result = self.apply(perm_remove=[self.grant(self.view.codename), self.grant(self.change.codename),
+                                         self.grant('missing_codename')])
+        self.assertEqual((result['removed'], result['missing'], result['invalid']), (1, 1, 1))
+        self.assertEqual(self.stored(), [])
+
+    def test_grant_added_and_removed_in_one_call_is_not_written(self):
+        result = self.apply([self.grant(self.view.codename)], [self.grant(self.view.codename)])
+        self.assertEqual((result['added'], result['removed']), (0, 0))
+        self.assertEqual(self.stored(), [])
@@ -2,10 +2,10 @@ import graphene
 from django.contrib.auth import get_user_model
 from django.db.models import QuerySet
 from graphene_django import DjangoObjectType
+from promise import Promise
 
 from apps.account.models import RoleGroup
-from apps.messenger.func import get_user_cache
-from apps.messenger.models import UserInfo
+from apps.base.loaders import get_loaders
 
 UserModel = get_user_model()
 
@@ -57,24 +57,24 @@ class UserInfoType(DjangoObjectType):
         return self.pk
 
     def resolve_status(self, info):
-        user = get_user_cache(user_id=self.pk)
-        if user and user.devices:
-            for device in user.devices:
-                if device.friend_online:
-                    return 'online'
-        return 'offline'
+        return get_loaders(info).presences.load(self.pk).then(
+            lambda presence: 'online' if presence.online else 'offline')
 
     def resolve_contact_status(self, info, **kwargs):
-        user_info = UserInfo.objects.filter(user_id=self.pk).first()
-        if user_info.contacts and user_info.contacts.__contains__(info.context.user.id.__str__()):
+        loaders, user = get_loaders(info), info.context.user
+        return Promise.all([loaders.user_infos.load(self.pk), loaders.friend_requests.load((self.pk, user.id))]).then(
+            lambda results: UserInfoType.get_contact_status(results[0], user, results[1]))
+
+    @staticmethod
+    def get_contact_status(user_info, user, req=None):
+        if user_info is None:
+            return 'no_contact'
+        if user_info.has_contact(user.id):
             return 'in_contact'
-        requests = user_info.get_friend_requests()
-        if requests:
-            req = requests.get(info.context.user.id.__str__(), None)
-            if req and req.get('type') == 'sender':
-                return 'waiting'
-            elif req and req.get('type') == 'receiver':
-                return 'requested'
+        if req and req.get('type') == 'sender':
+            return 'waiting'
+        elif req and req.get('type') == 'receiver':
+            return 'requested'
         return 'no_contact'
 
 
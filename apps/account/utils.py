@@ -1,10 +1,8 @@
-from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.contrib.auth.models import Permission
-from django.contrib.contenttypes.models import ContentType
-from django.db.models import F, Q
+from django.db.models import F
 
-from .models import RoleGroup, UserPermission, GroupPermission, UserRoleGroup
+from .models import RoleGroup, GroupPermission
+from .permission import PermissionSet, get_permission_set, admin_favor, to_dict
 
 # permission
 from ..base.middleware import get_user_extra
@@ -33,95 +31,39 @@ def get_identity(identity):
 def list_perm(user_or_group, application=None, doc_id=None, doc_type=None, model=None, codename=None):
     user, group = get_identity(user_or_group)
 
-    kwargs = {}
-
-    if application:
-        kwargs.update({'permission__content_type__app_label': application})
-    if doc_id:
-        kwargs.update({'doc_id': doc_id})
-    else:
-        kwargs.update({'doc_id__isnull': True})
-    if doc_type:
-        kwargs.update({'doc_type': doc_type})
-    if model:
-        kwargs.update({"permission__content_type__model": model})
-    if codename:
-        kwargs.update({"permission__codename": codename})
-
     if user:
-        list_permissions = []
-        code_perm_account_user = []
-
-        # filter permission admin
-        filter_content_id = Q()
-        for admin_granted in settings.PERMISSION_ADMIN_FAVOR:
-            filter_content_id.add(Q(app_label=admin_granted['app_label'], model=admin_granted['model']), Q.OR)
-        content_type_account_user = ContentType.objects.filter(app_label='account', model='user').values_list('id',
-                                                                                                              flat=True)
+        list_permissions, code_perm_account_user = [], set()
+        for entry in PermissionSet.lookup(get_permission_set(user).user, application, doc_id, doc_type, model,
+                                          codename):
+            if entry.app_label == 'account' and entry.model == 'user':
+                code_perm_account_user.add(entry.codename)
+            list_permissions.append(to_dict(entry))
 
-        kwargs.update({'user_id': user.id})
-        user_perms = UserPermission.objects.select_related('permission').filter(**kwargs).annotate(
-            content_type_id=F('permission__content_type_id'), name=F('permission__name'),
-            codename=F('permission__codename')
-        ).values('name', 'codename', 'content_type_id', 'option', 'more', 'lower_level').distinct()
-        for perm in user_perms:
-            code_perm_account_user.append(perm['codename']) if perm[
-                                                                   'content_type_id'] in content_type_account_user else None
-            list_permissions.append({
-                'name': perm['name'], 'codename': perm['codename'], 'option': perm['option'],
-                'more': perm['more'], 'lower_level': perm['lower_level']
-            })
         if user.is_superuser or user.is_staff:
-            admin_filter = Q()
-            if application is None and model is None:
-                if doc_id is None and codename is None:
-                    [
-                        admin_filter.add(
-                            Q(content_type__app_label=admin_granted['app_label'],
-                              content_type__model=admin_granted['model']), Q.OR
-                        ) for admin_granted in settings.PERMISSION_ADMIN_FAVOR
-                    ]
-                elif codename is not None:
-                    admin_filter.add(
-                        Q(
-                            codename=codename,
-                            content_type__app_label__in=[x['app_label'] for x in settings.PERMISSION_ADMIN_FAVOR],
-                            content_type__model__in=[x['model'] for x in settings.PERMISSION_ADMIN_FAVOR]
-                        ), Q.OR
-                    )
-            else:
-                for admin_granted in settings.PERMISSION_ADMIN_FAVOR:
-                    if application == admin_granted['app_label']:
-                        if model is None:
-                            admin_filter.add(Q(content_type__app_label=admin_granted['app_label'],
-                                               content_type__model=admin_granted['model']), Q.OR)
-                        elif model == admin_granted['model']:
-                            admin_filter.add(Q(content_type__app_label=admin_granted['app_label'],
-                                               content_type__model=admin_granted['model']), Q.OR)
-
             # admin permission have been granted
-            if admin_filter:
-                admin_permissions = Permission.objects.filter(admin_filter)
-                for perm in admin_permissions:
-                    if perm.codename not in code_perm_account_user:
-                        list_permissions.append(
-                            {'name': perm.name, 'codename': perm.codename, 'option': 1 if user.is_superuser else 2, 'more': [],
-                             'lower_level': False})
-
+            for entry in admin_favor(application, doc_id, model, codename):
+                if entry.codename not in code_perm_account_user:
+                    list_permissions.append(to_dict(entry, option=1 if user.is_superuser else 2))
         return list_permissions
 
     if group:
-        kwargs.update({'group_id': group.id})
+        kwargs = {'group_id': group.id}
+        if application:
+            kwargs.update({'permission__content_type__app_label': application})
+        if doc_id:
+            kwargs.update({'doc_id': doc_id})
+        else:
+            kwargs.update({'doc_id__isnull': True})
+        if doc_type:
+            kwargs.update({'doc_type': doc_type})
+        if model:
+            kwargs.update({"permission__content_type__model": model})
+        if codename:
+            kwargs.update({"permission__codename": codename})
         group_perms = GroupPermission.objects.select_related('permission').filter(**kwargs).annotate(
             name=F('permission__name'), codename=F('permission__codename')
         ).values('name', 'codename', 'option', 'more', 'lower_level')
-        for perm in group_perms:
-            perm.update({
-                'option': perm.get('option', None),
-                'more': perm.get('more', None),
-                'lower_level': perm.get('lower_level', None)
-            })
-        return group_perms if group_perms else []
+        return list(group_perms)
 
     return []
 
@@ -141,6 +83,7 @@ def user_permissions(user, application_code=None, doc_id=None, model=None, coden
     org_user = user_org.get('user')
     if org_user:
         results += list_perm(user, application=application_code, doc_id=doc_id, model=model, codename=codename)
-        for group in user.groups.all():
-            results += list_perm(group, application=application_code, doc_id=doc_id, model=model, codename=codename)
+        # role group grants come from the same cached set, no query per group
+        results += [to_dict(entry) for entry in PermissionSet.lookup(
+            get_permission_set(user).groups, application_code, doc_id, model=model, codename=codename)]
     return results
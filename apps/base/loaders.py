@@ -0,0 +1,99 @@
+from collections import defaultdict
+
+from django.contrib.auth import get_user_model
+from django.db.models import Q
+from promise import Promise
+from promise.dataloader import DataLoader
+
+UserModel = get_user_model()
+
+
+class UserLoader(DataLoader):
+    """Users by id"""
+
+    def batch_load_fn(self, keys):
+        users = UserModel.objects.in_bulk(keys)
+        return Promise.resolve([users.get(key) for key in keys])
+
+
+class ThreadMembersLoader(DataLoader):
+    """Members by thread id"""
+
+    def batch_load_fn(self, keys):
+        from apps.messenger.models import MemberInfo
+        members = defaultdict(list)
+        for member in MemberInfo.objects.filter(thread_id__in=keys).select_related('user_info'):
+            members[member.thread_id].append(member)
+        return Promise.resolve([members.get(key, []) for key in keys])
+
+
+class UserInfoLoader(DataLoader):
+    """User infos by user id"""
+
+    def batch_load_fn(self, keys):
+        from apps.messenger.models import UserInfo
+        user_infos = {user_info.user_id: user_info for user_info in UserInfo.objects.filter(user_id__in=keys)}
+        return Promise.resolve([user_infos.get(key) for key in keys])
+
+
+class PresenceLoader(DataLoader):
+    """PresenceStatus by user id, one pipelined redis round trip"""
+
+    def batch_load_fn(self, keys):
+        from apps.messenger.func import get_presence_many
+        return Promise.resolve(get_presence_many(keys))
+
+
+class FriendRequestLoader(DataLoader):
+    """Pending friend request between (user_id, other_id) pairs, as UserInfo.get_friend_request returns it"""
+
+    def batch_load_fn(self, keys):
+        from apps.messenger.models import FriendRequest
+        others = defaultdict(list)
+        for user_id, other_id in keys:
+            others[user_id].append(other_id)
+        query = Q(pk__in=[])
+        for user_id, other_ids in others.items():
+            query |= Q(sender_id=user_id, recipient_id__in=other_ids) | Q(recipient_id=user_id, sender_id__in=other_ids)
+        requests = {}
+        for request in FriendRequest.objects.filter(query, status=FriendRequest.PENDING):
+            requests[(str(request.sender_id), str(request.recipient_id))] = {
+                'timestamp': request.date_created.__str__(), 'type': 'sender'}
+            requests[(str(request.recipient_id), str(request.sender_id))] = {
+                'timestamp': request.date_created.__str__(), 'type': 'receiver'}
+        return Promise.resolve([requests.get((str(user_id), str(other_id))) for user_id, other_id in keys])
+
+
+LOADERS = {
+    'users': UserLoader,
+    'thread_members': ThreadMembersLoader,
+    'user_infos': UserInfoLoader,
+    'presences': PresenceLoader,
+    'friend_requests': FriendRequestLoader,
+}
+
+
+class LoaderRegistry(object):
+    """
+    Request-scoped DataLoaders, created lazily on first use so each level of a
+    query resolves with a single batched query.
+    """
+
+    def __init__(self):
+        self._loaders = {}
+
+    def __getattr__(self, name):
+        if name not in LOADERS:
+            raise AttributeError(name)
+        if name not in self._loaders:
+            self._loaders[name] = LOADERS[name]()
+        return self._loaders[name]
+
+
+def get_loaders(info):
+    context = info.context
+    registry = getattr(context, 'loaders', None)
+    if registry is None:
+        registry = LoaderRegistry()
+        setattr(context, 'loaders', registry)
+    return registry
@@ -1,9 +1,14 @@
+import asyncio
+import collections
 import logging
+import threading
 import uuid as uuid
+from concurrent.futures import ThreadPoolExecutor
 from re import sub
 from threading import local
 from urllib.parse import parse_qs
 
+from asgiref.sync import sync_to_async, SyncToAsync, ThreadSensitiveContext
 from channels.auth import AuthMiddlewareStack
 from channels.db import database_sync_to_async
 from channels.middleware import BaseMiddleware
@@ -17,6 +22,7 @@ from django.utils.deprecation import MiddlewareMixin
 from apps.account.models import User
 from apps.base.mixins import Output
 from apps.base.models import Token
+from apps.messenger.func import get_device_auth, set_device_auth, remove_device_auth, touch_device
 from apps.messenger.models import DeviceInfo
 
 logger = logging.getLogger(__name__)
@@ -29,6 +35,20 @@ def get_user_extra():
 
 
 class CjinnMiddleware(MiddlewareMixin, Output):
+    @staticmethod
+    def get_device(device_token):
+        cached = get_device_auth(device_token)
+        if cached:
+            device_id, user_id = cached
+            device = DeviceInfo.objects.select_related('user').filter(id=device_id, user_id=user_id,
+                                                                      token=device_token).first()
+            if device:
+                return device
+            remove_device_auth(device_token)
+        device = DeviceInfo.objects.select_related('user').get(token=device_token)
+        set_device_auth(device_token, device.id, device.user_id)
+        return device
+
     def process_request(self, request):
         is_dropdown = True if request.META.get('HTTP_VIEWTOKEN', False) == settings.KEY_VIEW_TOKEN else False
         device_token = request.META.get('HTTP_DEVICETOKEN', None)
@@ -36,10 +56,10 @@ class CjinnMiddleware(MiddlewareMixin, Output):
         if device_token is not None:
             try:
                 device_token = sub('Bearer ', '', request.META.get('HTTP_DEVICETOKEN', None))
-                device = DeviceInfo.objects.get(token=device_token)
+                device = self.get_device(device_token)
                 device.last_seen = timezone.now()
                 device.is_stale = False
-                device.save()
+                touch_device(device.id, device.last_seen)
 
                 request.device = device
                 request.user = device.user
@@ -97,6 +117,90 @@ class CjinnMiddleware(MiddlewareMixin, Output):
                 print(e)
 
 
+class RequestThreadPool:
+    """
+    A fixed set of single-thread executors lent to requests. A request holds
+    one for its whole duration, so its thread-sensitive work shares a thread,
+    DB connection and thread locals, while at most ``size`` such threads and
+    connections exist per process; further requests wait for a free one.
+    """
+
+    def __init__(self, size):
+        self.lock = threading.Lock()
+        self.free = [ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'request-{i}') for i in range(size)]
+        self.waiters = collections.deque()
+
+    async def acquire(self):
+        with self.lock:
+            if self.free:
+                return self.free.pop()
+            future = asyncio.get_running_loop().create_future()
+            self.waiters.append(future)
+        return await future
+
+    def release(self, executor):
+        with self.lock:
+            while self.waiters:
+                future = self.waiters.popleft()
+                if not future.done():
+                    # waiters may sit on another event loop than the releasing request
+                    future.get_loop().call_soon_threadsafe(self.hand_over, future, executor)
+                    return
+            self.free.append(executor)
+
+    def hand_over(self, future, executor):
+        if future.cancelled():
+            self.release(executor)
+        else:
+            future.set_result(executor)
+
+
+request_threads = RequestThreadPool(settings.REQUEST_THREADS)
+
+
+class RequestThreadContext(ThreadSensitiveContext):
+    """ThreadSensitiveContext running on a thread borrowed from request_threads instead of a new one"""
+
+    async def __aenter__(self):
+        await super().__aenter__()
+        if self.token:
+            SyncToAsync.context_to_thread_executor[self] = await request_threads.acquire()
+        return self
+
+    async def __aexit__(self, exc, value, tb):
+        if self.token:
+            executor = SyncToAsync.context_to_thread_executor.pop(self, None)
+            if executor:
+                request_threads.release(executor)
+        await super().__aexit__(exc, value, tb)
+
+
+class AsyncCjinnMiddleware(CjinnMiddleware):
+    """
+    Async-capable CjinnMiddleware. Every thread-sensitive call of the request,
+    this middleware, the ones below it and the GraphQL view, runs on one thread
+    of request_threads, so the DB connection and user_extra thread local are
+    shared without serializing requests on the global sync thread.
+    """
+    sync_capable = False
+    async_capable = True
+
+    def start_request(self, request):
+        # the thread served other requests before, drop what they left behind
+        _thread_locals.user_extra = None
+        close_old_connections()
+        self.process_request(request)
+
+    async def __call__(self, request):
+        async with RequestThreadContext():
+            try:
+                await sync_to_async(self.start_request, thread_sensitive=True)(request)
+                return await self.get_response(request)
+            finally:
+                # the connection stays with the thread up to CONN_MAX_AGE, as in a sync worker
+                await sync_to_async(close_old_connections, thread_sensitive=True)()
+
+
 ONLINE_THRESHOLD = getattr(settings, 'ONLINE_THRESHOLD', 60 * 15)
 ONLINE_MAX = getattr(settings, 'ONLINE_MAX', 50)
 
@@ -142,6 +246,15 @@ class OnlineNowMiddleware(MiddlewareMixin):
         cache.set('online-now', online_now_ids, ONLINE_THRESHOLD)
 
 
+class AsyncOnlineNowMiddleware(OnlineNowMiddleware):
+    sync_capable = False
+    async_capable = True
+
+    async def __call__(self, request):
+        await sync_to_async(self.process_request, thread_sensitive=True)(request)
+        return await self.get_response(request)
+
+
 @database_sync_to_async
 def get_user_by_token(token_key):
     try:
@@ -1,3 +1,40 @@
-from django.test import TestCase
+import json
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.test import TestCase, RequestFactory
+
+from apps.base.views import AsyncGraphQLView
+from apps.log.models import ActivityLog
+
+UserModel = get_user_model()
+
+
+class AsyncGraphQLViewTests(TestCase):
+    def setUp(self):
+        self.view = AsyncGraphQLView.as_view()
+        self.factory = RequestFactory()
+
+    def execute(self, query):
+        request = self.factory.post('/graphql/', data=json.dumps({'query': query}), content_type='application/json')
+        request.user = AnonymousUser()
+        request.device = None
+        # thread-sensitive work inside the view comes back to this thread, and to its connection
+        response = async_to_sync(self.view)(request)
+        return json.loads(response.content)
+
+    def test_loaders_batch_per_level(self):
+        users = [UserModel.objects.create(username=f'user{i}', email=f'user{i}@example.com') for i in range(5)]
+        ActivityLog.objects.bulk_create([ActivityLog(remarks=f'log {i}', user_created=user.id)
+                                         for i, user in enumerate(users)])
+
+        # one query for the page of logs, one for the users of every row
+        with self.assertNumQueries(2):
+            result = self.execute('{ activities(first: 10) { edges { node { remarks userCreated { username } } } } }')
+
+        self.assertNotIn('errors', result)
+        edges = result['data']['activities']['edges']
+        self.assertEqual(len(edges), 5)
+        self.assertEqual(set(edge['node']['userCreated']['username'] for edge in edges),
+                         set(user.username for user in users))
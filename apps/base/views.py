@@ -1,5 +1,9 @@
 import datetime
-from django.http import HttpResponse
+
+from asgiref.sync import sync_to_async
+from django.http import HttpResponse, HttpResponseNotAllowed
+from graphene_django.views import HttpError
+from graphene_file_upload.django import FileUploadGraphQLView
 
 
 def current_info(request):
@@ -14,3 +18,48 @@ def current_info(request):
     </html>
     """ % (now.strftime('%d-%m-%y, %H:%M'), len(request.online_now_ids))
     return HttpResponse(html)
+
+
+class AsyncGraphQLView(FileUploadGraphQLView):
+    """
+    GraphQL endpoint served natively under ASGI, the operation is executed in
+    one thread-sensitive call instead of holding a sync view thread
+    """
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        view = super().as_view(**initkwargs)
+
+        async def async_view(request, *args, **kwargs):
+            return await view(request, *args, **kwargs)
+
+        async_view.csrf_exempt = True
+        async_view.view_class = cls
+        return async_view
+
+    async def dispatch(self, request, *args, **kwargs):
+        try:
+            if request.method.lower() not in ('get', 'post'):
+                raise HttpError(HttpResponseNotAllowed(['GET', 'POST'], 'GraphQL only supports GET and POST requests.'))
+
+            data = self.parse_body(request)
+            if self.graphiql and self.can_display_graphiql(request, data):
+                return await sync_to_async(super().dispatch)(request, *args, **kwargs)
+
+            if self.batch:
+                responses = [await self.get_async_response(request, entry) for entry in data]
+                result = '[{}]'.format(','.join([response[0] for response in responses]))
+                status_code = max(responses, key=lambda response: response[1])[1]
+            else:
+                result, status_code = await self.get_async_response(request, data)
+            return HttpResponse(status=status_code, content=result, content_type='application/json')
+        except HttpError as e:
+            response = e.response
+            response['Content-Type'] = 'application/json'
+            response.content = self.json_encode(request, {'errors': [self.format_error(e)]})
+            return response
+
+    async def get_async_response(self, request, data):
+        # the whole operation runs once on the request's thread, so resolvers keep the
+        # connection and thread locals of the middleware and DataLoaders batch per level
+        return await sync_to_async(self.get_response, thread_sensitive=True)(request, data)
@@ -1,20 +1,29 @@
-from django.db import connection
+from uuid import uuid4
+
+from django.db import connection, transaction
+from django.db.models import Q
+from psycopg2.extras import execute_values
 
 from apps.base.utils import serializer_data
 from apps.log.models import AuthorizationLog, ActivityLog, HistoryLog, DocumentLog
+from apps.log.writer import writer
 
 
 def authorization_log(user, remarks, data):
-    try:
-        AuthorizationLog.objects.create(
-            user_created=user,
-            remarks=remarks,
-            data=data
-        )
-        return True
-    except Exception as e:
-        print(e)
-    return False
+    writer.append(AuthorizationLog(
+        user_created=user,
+        remarks=str(remarks),
+        data=data
+    ))
+    return True
+
+
+def get_log_page(queryset, after=None, limit=50):
+    """keyset page over (date_created, id), newest first"""
+    if after:
+        date_created, pk = after
+        queryset = queryset.filter(Q(date_created__lt=date_created) | Q(date_created=date_created, id__lt=pk))
+    return list(queryset.order_by('-date_created', '-id')[:limit])
 
 
 def service_get_author_log(user_id):
@@ -33,18 +42,14 @@ def service_get_author_log(user_id):
 
 def activity_log(user, remarks, doc_id, data, date_created, doc_name='', node_id=None,
                  node_name='', reason='', code_document=None, is_system=True, user_action=None, employee_action=None):
-    try:
-        ActivityLog.objects.create(
-            user_created=user, remarks=remarks, doc_id=doc_id,
-            code_document=code_document, data=data, doc_name=doc_name,
-            node_id=node_id, node_name=node_name, node_type=0 if is_system else 1, date_created=date_created,
-            reason=reason,
-            user=user_action, employee=employee_action
-        )
-        return True
-    except Exception as e:
-        print(e)
-    return False
+    writer.append(ActivityLog(
+        user_created=user, remarks=str(remarks), doc_id=doc_id,
+        code_document=code_document, data=data, doc_name=doc_name,
+        node_id=node_id, node_name=node_name, node_type=0 if is_system else 1, date_created=date_created,
+        reason=reason,
+        user=user_action, employee=employee_action
+    ))
+    return True
 
 
 def service_get_activity_log(user_id):
@@ -63,54 +68,92 @@ def service_get_activity_log(user_id):
 
 def history_log(user, remarks, doc_id, code_document, doc_detail, date_created, activity_name,
                 doc_new=None, doc_change=None, user_action=None, employee_action=None):
-    try:
-        HistoryLog.objects.create(
-            remarks=remarks, code_document=code_document,
-            doc_id=doc_id, doc_detail=doc_detail, date_created=date_created, activity_name=activity_name,
-            user_created=user,
-            doc_new=doc_new, doc_change=doc_change,
-            user=user_action, employee=employee_action
-        )
-    except Exception as e:
-        print(e)
-    return False
+    writer.append(HistoryLog(
+        remarks=str(remarks), code_document=code_document,
+        doc_id=doc_id, doc_detail=doc_detail, date_created=date_created, activity_name=activity_name,
+        user_created=user,
+        doc_new=doc_new, doc_change=doc_change,
+        user=user_action, employee=employee_action
+    ))
+    return True
+
+
+# columns written by a sync, the conflict update leaves user_created and doc_code as first seen
+DOCUMENT_LOG_FIELDS = ('org', 'company', 'department', 'user_created', 'employee_inherit', 'code_document', 'doc_id',
+                       'doc_name', 'doc_code', 'doc_status', 'date_created', 'date_modified', 'is_active', 'is_delete')
+DOCUMENT_LOG_SYNCED = ('employee_inherit', 'doc_name', 'doc_status', 'date_created', 'date_modified', 'is_active',
+                       'is_delete')
+# the parts of a document's sync key, compared as strings when a batch is deduplicated
+DOCUMENT_LOG_KEY_FIELDS = ('org', 'company', 'department', 'doc_id', 'code_document')
+# unique_together never conflicts while org / company / department are null, the sync key treats null as a value
+NULL_UUID = '00000000-0000-0000-0000-000000000000'
+DOCUMENT_LOG_KEY = f"COALESCE(org, '{NULL_UUID}'::uuid), COALESCE(company, '{NULL_UUID}'::uuid), " \
+                   f"COALESCE(department, '{NULL_UUID}'::uuid), doc_id, code_document"
+
+
+def ensure_document_log_key():
+    """create the unique index ON CONFLICT infers, duplicates left by the old sync are merged to the newest row"""
+    if connection.vendor != 'postgresql':
+        return
+    table = DocumentLog._meta.db_table
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute("SELECT to_regclass('document_log_sync_key')")
+        if cursor.fetchone()[0] is not None:
+            return
+        cursor.execute(f"""
+            DELETE FROM {table} a USING {table} b
+            WHERE a.doc_id = b.doc_id AND a.code_document = b.code_document AND a.org IS NOT DISTINCT FROM b.org
+              AND a.company IS NOT DISTINCT FROM b.company AND a.department IS NOT DISTINCT FROM b.department
+              AND (COALESCE(a.date_modified, a.date_created), a.id) < (COALESCE(b.date_modified, b.date_created), b.id)
+        """)
+        cursor.execute(f'CREATE UNIQUE INDEX document_log_sync_key ON {table} ({DOCUMENT_LOG_KEY})')
+
+
+def service_bulk_sync_document_log(documents, is_thread=False, batch_size=1000):
+    """
+    upsert many document states, every document is a dict of DOCUMENT_LOG_FIELDS
+    (org, company and department are optional), one INSERT ... ON CONFLICT DO
+    UPDATE per batch_size documents; returns the synced DocumentLog rows
+    """
+    # a statement cannot update the same row twice, the last state of a document wins
+    states = {}
+    for document in documents:
+        key = tuple(str(document[field]) if document.get(field, None) is not None else None
+                    for field in DOCUMENT_LOG_KEY_FIELDS)
+        states[key] = document
+    # absent keys take the model default as a save() would
+    defaults = {field: DocumentLog._meta.get_field(field).get_default() for field in DOCUMENT_LOG_FIELDS}
+    values = [(uuid4(),) + tuple(document[field] if field in document else defaults[field]
+                                 for field in DOCUMENT_LOG_FIELDS)
+              for document in states.values()]
+
+    columns = ('id',) + DOCUMENT_LOG_FIELDS
+    sql = f"INSERT INTO {DocumentLog._meta.db_table} ({', '.join(columns)}) VALUES %s " \
+          f"ON CONFLICT ({DOCUMENT_LOG_KEY}) DO UPDATE SET " \
+          f"{', '.join(f'{field} = EXCLUDED.{field}' for field in DOCUMENT_LOG_SYNCED)} " \
+          f"RETURNING {', '.join(columns)}"
+    result = []
+    with transaction.atomic(), connection.cursor() as cursor:
+        for i in range(0, len(values), batch_size):
+            rows = execute_values(cursor.cursor, sql, values[i:i + batch_size], page_size=batch_size, fetch=True)
+            result += [DocumentLog(**dict(zip(columns, row))) for row in rows]
+    connection.close() if is_thread else None
+    return result
 
 
 def service_sync_document_log(
         user_created, employee_inherit, code_document, doc_id, doc_name, doc_code, doc_status, date_created,
         date_modified,
-        is_active, is_delete, is_thread=False, again_num=0
+        is_active, is_delete, is_thread=False
 ):
-    if again_num > 1:
-        return False
-    else:
-        try:
-            doc = DocumentLog.objects.filter(doc_id=doc_id,
-                                             code_document=code_document).first()
-            if doc:
-                doc.employee_inherit = employee_inherit
-                doc.doc_name = doc_name
-                doc.doc_status = doc_status
-                doc.date_created = date_created
-                doc.date_modified = date_modified
-                doc.is_active = is_active
-                doc.is_delete = is_delete
-                doc.save()
-            else:
-                doc = DocumentLog.objects.create(
-                    user_created=user_created, employee_inherit=employee_inherit, code_document=code_document,
-                    doc_id=doc_id, doc_name=doc_name, doc_code=doc_code, doc_status=doc_status,
-                    date_created=date_created,
-                    date_modified=date_modified,
-                    is_active=is_active, is_delete=is_delete
-                )
-            connection.close() if is_thread else None
-            return doc
-        except Exception as e:
-            print(e)
-            return service_sync_document_log(
-                user_created, employee_inherit, code_document, doc_id, doc_name, doc_code, doc_status, date_created,
-                date_modified,
-                is_active, is_delete, is_thread=False, again_num=1
-            )
-        # return False
+    try:
+        docs = service_bulk_sync_document_log([{
+            'user_created': user_created, 'employee_inherit': employee_inherit, 'code_document': code_document,
+            'doc_id': doc_id, 'doc_name': doc_name, 'doc_code': doc_code, 'doc_status': doc_status,
+            'date_created': date_created, 'date_modified': date_modified, 'is_active': is_active,
+            'is_delete': is_delete
+        }], is_thread=is_thread)
+        return docs[0]
+    except Exception as e:
+        print(e)
+    return False
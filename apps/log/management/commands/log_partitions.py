@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from apps.log.partitions import ensure_partitions, drop_expired_partitions
+
+
+class Command(BaseCommand):
+    help = 'Create the coming monthly log partitions and drop the ones past LOG_RETENTION_MONTHS, run it monthly'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ahead', type=int, default=None, help='months to create ahead of the current one')
+        parser.add_argument('--retention', type=int, default=None, help='months of logs to keep')
+
+    def handle(self, *args, **options):
+        ensure_partitions(options['ahead'])
+        for name in drop_expired_partitions(options['retention']):
+            self.stdout.write(f'dropped {name}')
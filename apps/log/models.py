@@ -25,6 +25,11 @@ class AuthorizationLog(models.Model):
         ordering = ('-date_created',)
         default_permissions = ()
         permissions = ()
+        # keyset pages newest first, pruned to the recent partitions
+        indexes = [
+            models.Index(fields=['-date_created', '-id'], name='authorization_log_date_idx'),
+            models.Index(fields=['user_created', '-date_created', '-id'], name='authorization_log_user_idx'),
+        ]
 
 
 class ActivityLog(models.Model):
@@ -58,6 +63,12 @@ class ActivityLog(models.Model):
         ordering = ('-date_created',)
         default_permissions = ()
         permissions = ()
+        # keyset pages newest first, pruned to the recent partitions
+        indexes = [
+            models.Index(fields=['-date_created', '-id'], name='activity_log_date_idx'),
+            models.Index(fields=['user_created', '-date_created', '-id'], name='activity_log_user_idx'),
+            models.Index(fields=['doc_id', '-date_created', '-id'], name='activity_log_doc_idx'),
+        ]
 
 
 class HistoryLog(models.Model):
@@ -88,6 +99,12 @@ class HistoryLog(models.Model):
         ordering = ('-date_created',)
         default_permissions = ()
         permissions = ()
+        # keyset pages newest first, pruned to the recent partitions
+        indexes = [
+            models.Index(fields=['-date_created', '-id'], name='history_log_date_idx'),
+            models.Index(fields=['user_created', '-date_created', '-id'], name='history_log_user_idx'),
+            models.Index(fields=['doc_id', '-date_created', '-id'], name='history_log_doc_idx'),
+        ]
 
 
 # Document Log
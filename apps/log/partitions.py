@@ -0,0 +1,131 @@
+import logging
+import re
+from datetime import date
+
+from django.conf import settings
+from django.db import connection, transaction
+from django_rq import job
+
+from apps.log.models import AuthorizationLog, ActivityLog, HistoryLog
+
+logger = logging.getLogger(__name__)
+
+# log tables range partitioned by month on date_created
+PARTITIONED_MODELS = (AuthorizationLog, ActivityLog, HistoryLog)
+
+
+def add_months(month: date, count):
+    index = month.year * 12 + month.month - 1 + count
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def month_start(value):
+    return date(value.year, value.month, 1)
+
+
+def partition_name(table, month: date):
+    return f'{table}_p{month:%Y%m}'
+
+
+def is_partitioned(cursor, table):
+    cursor.execute('SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s)', [table])
+    return cursor.fetchone() is not None
+
+
+def list_partitions(cursor, table):
+    """month of every monthly partition of table"""
+    cursor.execute('SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid '
+                   'WHERE i.inhparent = to_regclass(%s)', [table])
+    pattern = re.compile(rf'^{re.escape(table)}_p(\d{{4}})(\d{{2}})$')
+    result = []
+    for name, in cursor.fetchall():
+        match = pattern.match(name)
+        if match:
+            result.append(date(int(match.group(1)), int(match.group(2)), 1))
+    return sorted(result)
+
+
+def create_partition(cursor, table, month: date):
+    """
+    add the partition of a month, rows of that month which fell into the
+    default partition are moved into it
+    """
+    name, default = partition_name(table, month), f'{table}_default'
+    start, end = month.isoformat(), add_months(month, 1).isoformat()
+    cursor.execute(f'ALTER TABLE {table} DETACH PARTITION {default}')
+    cursor.execute(f"CREATE TABLE {name} PARTITION OF {table} FOR VALUES FROM ('{start}') TO ('{end}')")
+    cursor.execute(f'WITH moved AS (DELETE FROM {default} WHERE date_created >= %s AND date_created < %s '
+                   f'RETURNING *) INSERT INTO {table} SELECT * FROM moved', [start, end])
+    cursor.execute(f'ALTER TABLE {table} ATTACH PARTITION {default} DEFAULT')
+
+
+def convert(cursor, table):
+    """
+    turn a plain log table into a partitioned one: the rows are copied into
+    monthly partitions and the indexes recreated on the parent, the primary key
+    becomes (id, date_created) as postgres requires the partition key in it
+    """
+    legacy = f'{table}_legacy'
+    cursor.execute(f'ALTER TABLE {table} RENAME TO {legacy}')
+    cursor.execute('SELECT pg_get_indexdef(indexrelid) FROM pg_index '
+                   'WHERE indrelid = to_regclass(%s) AND NOT indisprimary', [legacy])
+    indexes = [definition for definition, in cursor.fetchall()]
+    cursor.execute(f'ALTER TABLE {legacy} DROP CONSTRAINT {table}_pkey')
+
+    cursor.execute(f'CREATE TABLE {table} (LIKE {legacy} INCLUDING DEFAULTS INCLUDING CONSTRAINTS, '
+                   f'PRIMARY KEY (id, date_created)) PARTITION BY RANGE (date_created)')
+    cursor.execute(f'CREATE TABLE {table}_default PARTITION OF {table} DEFAULT')
+    cursor.execute(f"SELECT DISTINCT date_trunc('month', date_created)::date FROM {legacy}")
+    for month, in cursor.fetchall():
+        create_partition(cursor, table, month)
+    cursor.execute(f'INSERT INTO {table} SELECT * FROM {legacy}')
+    cursor.execute(f'DROP TABLE {legacy}')
+
+    for definition in indexes:
+        cursor.execute(re.sub(rf' ON (?:ONLY )?(?:\w+\.)?{re.escape(legacy)} ', f' ON {table} ', definition))
+
+
+def ensure_partitions(months_ahead=None):
+    """partition the log tables if needed and make sure the coming months have their partition"""
+    if connection.vendor != 'postgresql':
+        return
+    months_ahead = settings.LOG_PARTITION_PREMAKE if months_ahead is None else months_ahead
+    current = month_start(date.today())
+    for model in PARTITIONED_MODELS:
+        table = model._meta.db_table
+        with transaction.atomic(), connection.cursor() as cursor:
+            if not is_partitioned(cursor, table):
+                logger.info('partitioning %s by month', table)
+                convert(cursor, table)
+            existing = list_partitions(cursor, table)
+            for count in range(months_ahead + 1):
+                month = add_months(current, count)
+                if month not in existing:
+                    create_partition(cursor, table, month)
+
+
+def drop_expired_partitions(retention=None):
+    """drop the monthly partitions older than LOG_RETENTION_MONTHS, returns the dropped names"""
+    if connection.vendor != 'postgresql':
+        return []
+    retention = settings.LOG_RETENTION_MONTHS if retention is None else retention
+    cutoff = add_months(month_start(date.today()), -retention)
+    dropped = []
+    for model in PARTITIONED_MODELS:
+        table = model._meta.db_table
+        with transaction.atomic(), connection.cursor() as cursor:
+            if not is_partitioned(cursor, table):
+                continue
+            for month in list_partitions(cursor, table):
+                if month < cutoff:
+                    name = partition_name(table, month)
+                    cursor.execute(f'DROP TABLE {name}')
+                    dropped.append(name)
+            cursor.execute(f'DELETE FROM {table}_default WHERE date_created < %s', [cutoff.isoformat()])
+    return dropped
+
+
+@job
+def maintain_log_partitions():
+    ensure_partitions()
+    return drop_expired_partitions()
@@ -1,7 +1,10 @@
 import graphene
+from django.conf import settings
 
+from apps.log.func import get_log_page
 from apps.log.models import ActivityLog, HistoryLog, AuthorizationLog
 from apps.log.types import ActivityLogNode, HistoryLogNode, AuthorizationLogNode
+from apps.messenger.utils import encode_cursor, decode_cursor
 
 
 class ActivityConnection(graphene.relay.Connection):
@@ -19,21 +22,46 @@ class AuthorizeLogConnection(graphene.relay.Connection):
         node = AuthorizationLogNode
 
 
+def resolve_log_page(connection, queryset, **kwargs):
+    """
+    relay connection paged by (date_created, id) cursors instead of offsets,
+    date_from / date_to let postgres prune the monthly partitions
+    """
+    for key in ('user_created', 'doc_id'):
+        if kwargs.get(key, None):
+            queryset = queryset.filter(**{key: kwargs.get(key)})
+    if kwargs.get('date_from', None):
+        queryset = queryset.filter(date_created__gte=kwargs.get('date_from'))
+    if kwargs.get('date_to', None):
+        queryset = queryset.filter(date_created__lt=kwargs.get('date_to'))
+
+    after = kwargs.get('after', None)
+    limit = min(kwargs.get('first', None) or settings.LOG_PAGE_LIMIT, settings.LOG_PAGE_LIMIT)
+    rows = get_log_page(queryset, decode_cursor(after) if after else None, limit + 1)
+    edges = [connection.Edge(node=row, cursor=encode_cursor(row.date_created, row.id)) for row in rows[:limit]]
+    return connection(edges=edges, page_info=graphene.relay.PageInfo(
+        has_next_page=len(rows) > limit, has_previous_page=after is not None,
+        start_cursor=edges[0].cursor if edges else None, end_cursor=edges[-1].cursor if edges else None))
+
+
 class LogQuery(graphene.ObjectType):
-    activities = graphene.relay.ConnectionField(ActivityConnection)
-    histories = graphene.relay.ConnectionField(HistoryLogConnection)
-    authorize = graphene.relay.ConnectionField(AuthorizeLogConnection)
+    activities = graphene.relay.ConnectionField(ActivityConnection, user_created=graphene.UUID(),
+                                                doc_id=graphene.UUID(), date_from=graphene.DateTime(),
+                                                date_to=graphene.DateTime())
+    histories = graphene.relay.ConnectionField(HistoryLogConnection, user_created=graphene.UUID(),
+                                               doc_id=graphene.UUID(), date_from=graphene.DateTime(),
+                                               date_to=graphene.DateTime())
+    authorize = graphene.relay.ConnectionField(AuthorizeLogConnection, user_created=graphene.UUID(),
+                                               date_from=graphene.DateTime(), date_to=graphene.DateTime())
 
     @staticmethod
     def resolve_activities(root, info, **kwargs):
-        return ActivityLog.objects.all()
+        return resolve_log_page(ActivityConnection, ActivityLog.objects.all(), **kwargs)
 
     @staticmethod
     def resolve_histories(root, info, **kwargs):
-        return HistoryLog.objects.all()
+        return resolve_log_page(HistoryLogConnection, HistoryLog.objects.all(), **kwargs)
 
     @staticmethod
     def resolve_authorize(root, info, **kwargs):
-        result = AuthorizationLog.objects.all()
-        return result
-
+        return resolve_log_page(AuthorizeLogConnection, AuthorizationLog.objects.all(), **kwargs)
@@ -0,0 +1,12 @@
+from django.db.models.signals import post_migrate
+from django.dispatch import receiver
+
+from apps.log.func import ensure_document_log_key
+from apps.log.partitions import ensure_partitions
+
+
+@receiver(post_migrate)
+def partition_logs(sender, **kwargs):
+    if sender.name == 'apps.log':
+        ensure_partitions()
+        ensure_document_log_key()
@@ -1,3 +1,131 @@
+import threading
+import time
+from uuid import uuid4
+
+from django.db import transaction
 from django.test import TestCase
+from django.utils import timezone
+
+from apps.log.func import service_bulk_sync_document_log, service_sync_document_log
+from apps.log.models import DocumentLog, ActivityLog
+from apps.log.writer import AuditLogWriter
+
+
+class DocumentLogSyncTests(TestCase):
+    def setUp(self):
+        self.doc_id = uuid4()
+
+    def document(self, **kwargs):
+        document = {'code_document': 'quotation', 'doc_id': self.doc_id, 'doc_status': 0,
+                    'date_created': timezone.now()}
+        document.update(kwargs)
+        return document
+
+    def test_sync_updates_the_existing_row(self):
+        first_user, second_user = uuid4(), uuid4()
+        first = service_sync_document_log(first_user, None, 'quotation', self.doc_id, 'first', 'Q-1', 0,
+                                          timezone.now(), None, True, False)
+        second = service_sync_document_log(second_user, None, 'quotation', self.doc_id, 'second', 'Q-2', 1,
+                                           timezone.now(), timezone.now(), True, False)
+
+        self.assertEqual(DocumentLog.objects.count(), 1)
+        self.assertEqual(second.id, first.id)
+        row = DocumentLog.objects.get()
+        self.assertEqual((row.doc_name, row.doc_status), ('second', 1))
+        # user_created and doc_code stay as first seen
+        self.assertEqual((row.user_created, row.doc_code), (first_user, 'Q-1'))
+
+    def test_absent_keys_take_model_defaults(self):
+        row, = service_bulk_sync_document_log([self.document()])
+        self.assertEqual((row.doc_name, row.is_active, row.is_delete), ('', True, False))
+        row = DocumentLog.objects.get(id=row.id)
+        self.assertEqual((row.doc_name, row.is_active, row.is_delete), ('', True, False))
+
+    def test_batch_keeps_the_last_state_of_a_document(self):
+        org = uuid4()
+        rows = service_bulk_sync_document_log([
+            self.document(org=org, doc_name='first'),
+            self.document(org=str(org), doc_id=str(self.doc_id), doc_name='last'),
+            self.document(doc_name='no org'),
+        ])
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(DocumentLog.objects.count(), 2)
+        self.assertEqual(DocumentLog.objects.get(org=org).doc_name, 'last')
+        self.assertEqual(DocumentLog.objects.get(org__isnull=True).doc_name, 'no org')
+
+    def test_null_scope_conflicts_with_itself(self):
+        service_bulk_sync_document_log([self.document(doc_name='first')])
+        service_bulk_sync_document_log([self.document(doc_name='again')])
+        self.assertEqual(list(DocumentLog.objects.values_list('doc_name', flat=True)), ['again'])
+
+
+class TestWriter(AuditLogWriter):
+    # flushes run from the test so they share its connection and transaction
+    def start(self):
+        pass
+
+
+class AuditLogWriterTests(TestCase):
+    def row(self, **kwargs):
+        return ActivityLog(remarks='test', **kwargs)
+
+    def append(self, writer, count):
+        with self.captureOnCommitCallbacks(execute=True):
+            for _ in range(count):
+                writer.append(self.row())
+
+    def wait(self, writer):
+        started = time.time()
+        waiter = threading.Thread(target=writer.wait)
+        waiter.start()
+        return started, waiter
+
+    def test_rows_are_buffered_after_commit(self):
+        writer = TestWriter(batch_size=10, flush_interval=500, limit=100)
+        with self.captureOnCommitCallbacks() as callbacks:
+            with transaction.atomic():
+                writer.append(self.row())
+            self.assertEqual(len(writer.buffer), 0)
+        for callback in callbacks:
+            callback()
+        self.assertEqual(len(writer.buffer), 1)
+
+    def test_full_batch_wakes_the_writer(self):
+        writer = TestWriter(batch_size=3, flush_interval=10000, limit=100)
+        started, waiter = self.wait(writer)
+        self.append(writer, 2)
+        waiter.join(0.2)
+        self.assertTrue(waiter.is_alive())
+        self.append(writer, 1)
+        waiter.join(5)
+        self.assertFalse(waiter.is_alive())
+        self.assertLess(time.time() - started, 5)
+        self.assertEqual(writer.flush(), 3)
+        self.assertEqual(ActivityLog.objects.count(), 3)
+
+    def test_partial_batch_is_flushed_after_the_interval(self):
+        writer = TestWriter(batch_size=10, flush_interval=100, limit=100)
+        self.append(writer, 1)
+        started, waiter = self.wait(writer)
+        waiter.join(5)
+        self.assertFalse(waiter.is_alive())
+        self.assertGreaterEqual(time.time() - started, 0.09)
+        self.assertEqual(writer.flush(), 1)
+        self.assertEqual(writer.flush(), 0)
+
+    def test_callers_write_once_the_limit_is_reached(self):
+        writer = TestWriter(batch_size=10, flush_interval=500, limit=3)
+        self.append(writer, 2)
+        self.assertEqual(ActivityLog.objects.count(), 0)
+        self.append(writer, 1)
+        self.assertEqual(len(writer.buffer), 0)
+        self.assertEqual(ActivityLog.objects.count(), 3)
 
-# Create your tests here.
+    def test_failed_batch_is_written_one_by_one(self):
+        writer = TestWriter(batch_size=10, flush_interval=500, limit=100)
+        existing = ActivityLog.objects.create(remarks='existing')
+        with self.assertLogs('apps.log.writer', 'ERROR') as logs:
+            writer.write(ActivityLog, [self.row(), self.row(id=existing.id), self.row()])
+        self.assertEqual(len(logs.records), 2)
+        self.assertEqual(ActivityLog.objects.count(), 3)
+        self.assertEqual(ActivityLog.objects.get(id=existing.id).remarks, 'existing')
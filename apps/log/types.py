@@ -4,6 +4,7 @@ from django.contrib.auth import get_user_model
 from graphene_django import DjangoObjectType
 
 from apps.account.types import UserNode
+from apps.base.loaders import get_loaders
 from apps.log.filters import ActivityLogListFilter, HistoryLogListFilter
 from apps.log.models import ActivityLog, HistoryLog, AuthorizationLog, DocumentLog
 
@@ -22,8 +23,9 @@ class ActivityLogNode(DjangoObjectType):
             'node_name', 'node_type', 'reason', 'code_document', 'is_active')
 
     def resolve_user_created(self, info):
-        user_created = UserModel.objects.get(pk=self.user_created)
-        return user_created
+        if self.user_created is None:
+            return None
+        return get_loaders(info).users.load(self.user_created)
 
 
 class HistoryLogNode(DjangoObjectType):
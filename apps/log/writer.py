@@ -0,0 +1,119 @@
+import atexit
+import collections
+import logging
+import threading
+import time
+from functools import partial
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from rq import Worker
+
+logger = logging.getLogger(__name__)
+
+
+class AuditLogWriter:
+    """
+    in-process buffer for log rows, a daemon thread writes them with one
+    bulk_create per model every AUDIT_LOG_BATCH_SIZE rows or
+    AUDIT_LOG_FLUSH_INTERVAL ms, whichever comes first, and the buffer is
+    flushed once more when the process exits; rows of an atomic block are
+    only buffered once it commits
+    """
+
+    def __init__(self, batch_size, flush_interval, limit):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval / 1000
+        self.limit = limit
+        self.buffer = collections.deque()
+        self.condition = threading.Condition()
+        self.flush_lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        with self.condition:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name='audit-log-writer', daemon=True)
+                self.thread.start()
+
+    def append(self, instance):
+        transaction.on_commit(partial(self.enqueue, instance))
+
+    def enqueue(self, instance):
+        self.start()
+        with self.condition:
+            self.buffer.append(instance)
+            size = len(self.buffer)
+            if size >= self.batch_size:
+                self.condition.notify()
+        # the writer fell behind, write from the caller rather than drop audit rows
+        if size >= self.limit:
+            self.flush()
+
+    def wait(self):
+        """block until a batch is full or the flush interval elapsed"""
+        with self.condition:
+            if len(self.buffer) < self.batch_size:
+                self.condition.wait(self.flush_interval)
+
+    def run(self):
+        while True:
+            self.wait()
+            try:
+                self.flush()
+            finally:
+                close_old_connections()
+
+    def drain(self):
+        with self.condition:
+            instances = list(self.buffer)
+            self.buffer.clear()
+        return instances
+
+    def flush(self):
+        with self.flush_lock:
+            instances = self.drain()
+            groups = collections.defaultdict(list)
+            for instance in instances:
+                groups[type(instance)].append(instance)
+            for model, rows in groups.items():
+                self.write(model, rows)
+            return len(instances)
+
+    def write(self, model, rows):
+        # savepoints keep a failed insert from aborting a transaction the flush runs in
+        try:
+            with transaction.atomic():
+                model.objects.bulk_create(rows, batch_size=self.batch_size)
+        except Exception:
+            logger.exception('bulk write of %s %s rows failed, retrying one by one', len(rows), model.__name__)
+            for row in rows:
+                try:
+                    with transaction.atomic():
+                        row.save(force_insert=True)
+                except Exception:
+                    logger.exception('dropped %s row %s', model.__name__, row.id)
+
+
+writer = AuditLogWriter(settings.AUDIT_LOG_BATCH_SIZE, settings.AUDIT_LOG_FLUSH_INTERVAL, settings.AUDIT_LOG_BUFFER_LIMIT)
+
+
+@atexit.register
+def flush_on_exit():
+    started = time.time()
+    count = writer.flush()
+    if count > 0:
+        logger.info('flushed %s audit log rows on exit in %.3fs', count, time.time() - started)
+
+
+class AuditLogWorker(Worker):
+    """
+    rq worker flushing the rows a job logged before its work horse exits,
+    the horse leaves through os._exit and skips flush_on_exit
+    """
+
+    def perform_job(self, job, queue):
+        try:
+            return super().perform_job(job, queue)
+        finally:
+            writer.flush()
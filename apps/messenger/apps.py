@@ -7,3 +7,6 @@ class MessengerConfig(AppConfig):
 
     def ready(self):
         import apps.messenger.signals
+        from apps.messenger.push import get_transport
+        # initialise the push transport (firebase app) eagerly, like settings used to
+        get_transport()
@@ -14,4 +14,5 @@ class Message:
 FRIEND_ONLINE = 'friend_online'
 INCOMING_MGS = 'incoming_message'
 FRIEND_REQUEST = 'friend_request'
-PRIVATE_CHANNEL = 'private_channel'
\ No newline at end of file
+PRIVATE_CHANNEL = 'private_channel'
+PRESENCE = 'presence'
\ No newline at end of file
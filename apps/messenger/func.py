@@ -1,8 +1,12 @@
+import hashlib
+from datetime import timedelta
+
+import django_rq
 from django.conf import settings
 from django.core.cache import cache
-from fcm_django.models import FCMDevice
+from django_rq import job
 
-from apps.messenger.models.redis import Meeting, Subscriber, Calls
+from apps.messenger.models.redis import Meeting, Subscriber, Calls, Presence, DeviceHeartbeat, PreKeyCounter
 
 api = 'https://fcm.googleapis.com/fcm/send'
 
@@ -12,42 +16,153 @@ def cache_prefix(service_name, user_id, device_id):
 
 
 def get_user_cache(user_id):
-    user: Subscriber = cache.get(user_id.__str__())
+    user: Subscriber = Presence.get(user_id)
     return user
 
 
+def get_presence_many(user_ids):
+    """
+    return a PresenceStatus(user_id, online, devices) tuple for every user id,
+    fetched in one pipelined round trip
+    """
+    return Presence.get_many(user_ids)
+
+
 def add_or_update_user_cache(user_id, device_id=None, friend_online=None, incoming_msg=None, request=None,
                              thread_id=None):
-    user: Subscriber = cache.get(user_id.__str__())
-    if user is None:
-        user = Subscriber()
     if device_id:
-        user.add_or_update_device(device_id=device_id.__str__(), friend_online=friend_online, incoming_msg=incoming_msg,
-                                  request=None, thread_id=thread_id)
-    return cache.set(user_id, user, timeout=settings.CACHE_TIMEOUT)
+        return Presence.update(user_id, device_id=device_id, friend_online=friend_online, incoming_msg=incoming_msg,
+                               request=request, thread_id=thread_id)
+    return False
 
 
 def remove_user_cache(user_id, device_id=None):
-    if device_id:
-        user = get_user_cache(user_id)
-        if user:
-            user.remove_device(device_id=device_id.__str__())
-            if user.devices.__len__() > 0:
-                cache.set(user_id.__str__(), user,
-                          timeout=settings.CACHE_TIMEOUT)
-            else:
-                cache.delete(user_id.__str__())
-    else:
-        cache.delete(user_id.__str__())
+    return Presence.remove(user_id, device_id)
+
+
+def get_live_devices(user_id):
+    """
+    ids of the user's devices holding an open message subscription
+    """
+    user = Presence.get(user_id)
+    if not user:
+        return []
+    return [device.device_id for device in user.devices if device.incoming_msg]
+
+
+def contacts_prefix(user_id):
+    return f'contacts:{user_id.__str__()}'
+
+
+def get_contact_set(user_id):
+    """
+    return the user's contact ids (as str) as a cached frozenset
+    """
+    key = contacts_prefix(user_id)
+    contacts = cache.get(key)
+    if contacts is None:
+        from apps.messenger.models import Contact
+        contacts = frozenset(str(contact_id) for contact_id in
+                             Contact.objects.filter(owner_id=user_id).values_list('contact_id', flat=True))
+        cache.set(key, contacts, timeout=settings.CONTACTS_CACHE_TIMEOUT)
+    return contacts
+
+
+def invalidate_contact_set(*user_ids):
+    cache.delete_many([contacts_prefix(user_id) for user_id in user_ids])
+
+
+def device_auth_prefix(token):
+    return f'device_auth:{hashlib.sha256(token.encode("utf-8")).hexdigest()}'
+
+
+def get_device_auth(token):
+    """
+    return cached (device_id, user_id) of a device token or None
+    """
+    return cache.get(device_auth_prefix(token))
+
+
+def set_device_auth(token, device_id, user_id):
+    return cache.set(device_auth_prefix(token), (device_id, user_id), timeout=settings.DEVICE_AUTH_TIMEOUT)
+
+
+def remove_device_auth(token):
+    return cache.delete(device_auth_prefix(token))
+
+
+def touch_device(device_id, timestamp):
+    DeviceHeartbeat.touch(device_id, timestamp)
+    # one flush at the end of each interval, scheduled by whichever worker wins the add,
+    # so it picks up every heartbeat of the window
+    if cache.add('device_auth:flush', True, timeout=settings.DEVICE_HEARTBEAT_INTERVAL):
+        django_rq.get_queue('default').enqueue_in(timedelta(seconds=settings.DEVICE_HEARTBEAT_INTERVAL),
+                                                  flush_device_heartbeat)
+
+
+@job
+def flush_device_heartbeat():
+    from apps.messenger.models import DeviceInfo
+
+    heartbeats = DeviceHeartbeat.pop_all()
+    devices = [DeviceInfo(id=device_id, last_seen=last_seen, is_stale=False)
+               for device_id, last_seen in heartbeats.items()]
+    DeviceInfo.objects.bulk_update(devices, ['last_seen', 'is_stale'], batch_size=500)
+    return len(devices)
+
+
+def get_pre_key_count(device_id):
+    count = PreKeyCounter.get(device_id)
+    if count is None:
+        count = load_pre_key_count(device_id)
+    return count
+
+
+def load_pre_key_count(device_id):
+    from apps.messenger.models import PreKey
+    return PreKeyCounter.load(device_id, PreKey.objects.filter(device_id=device_id).count())
+
+
+def add_pre_key_count(device_id, count):
+    """account for uploaded pre-keys and let the device be asked to replenish again"""
+    total = PreKeyCounter.incr(device_id, count)
+    if total is None:
+        total = load_pre_key_count(device_id)
+    cache.delete(f'prekey:replenish:{device_id.__str__()}')
+    return total
+
+
+def consume_pre_keys(device_ids):
+    """
+    account for claimed pre-keys and ask devices under PRE_KEY_LOW_WATER to
+    upload a new batch, at most once until they do
+    """
+    for device_id, count in PreKeyCounter.decr_many(device_ids).items():
+        if count is None:
+            count = load_pre_key_count(device_id)
+        if count < settings.PRE_KEY_LOW_WATER and cache.add(f'prekey:replenish:{device_id}', True,
+                                                            timeout=settings.CACHE_TIMEOUT):
+            send_replenish_signal.delay(device_id, count)
+
 
+@job
+def send_replenish_signal(device_id, count):
+    from apps.messenger.constants import INCOMING_MGS
+    from apps.messenger.models import DeviceInfo
+    from apps.messenger.push import push_to_devices
+    from apps.messenger.subscriptions import MessengerSubscription
 
-def notification_sender(message, device):
-    fcm_client = FCMDevice.objects.filter(
-        device_id=device.id.__str__(), user_id=device.user_id).first()
-    if fcm_client:
-        fcm_client.send_message(message=message)
+    device = DeviceInfo.objects.filter(id=device_id).first()
+    if device is None:
+        return False
+    user = get_user_cache(device.user_id)
+    subscribed = user.find_device(device.id.__str__()) if user else None
+    if subscribed and subscribed.incoming_msg:
+        MessengerSubscription.broadcast(group=cache_prefix(INCOMING_MGS, device.user_id, device.id),
+                                        payload={'data': [{'count': count}], 'type': 'replenish_keys'})
     else:
-        raise Exception('Device not found')
+        push_to_devices.delay([device.id], {'type': 'replenish_keys', 'count': str(count)})
+    return True
 
 
 def meeting_prefix(meeting_id):
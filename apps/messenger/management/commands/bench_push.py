@@ -0,0 +1,88 @@
+import statistics
+import time
+import uuid
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from fcm_django.models import FCMDevice
+
+from apps.messenger.mixins.message_delivery import SendMessageMixin
+from apps.messenger.models import DeviceInfo
+from apps.messenger.push import LocalTransport, get_transport, push_each
+
+UserModel = get_user_model()
+
+
+class Command(BaseCommand):
+    help = 'Drive SendMessage fan-out through the push transport and report pushes/sec and ' \
+           'enqueue-to-send latency. Needs PUSH_TRANSPORT=apps.messenger.push.LocalTransport.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-n', '--devices', type=int, default=500, help='number of destination devices')
+        parser.add_argument('--timeout', type=float, default=60.0, help='seconds to wait for every push')
+        parser.add_argument('--sync', action='store_true', help='run the rq jobs inline instead of on workers')
+
+    def handle(self, *args, **options):
+        if not isinstance(get_transport(), LocalTransport):
+            raise CommandError('Run with PUSH_TRANSPORT=apps.messenger.push.LocalTransport')
+
+        LocalTransport.clear_log()
+        user, source, destinations = self.create_fixtures(options['devices'])
+        try:
+            enqueued_at = {}
+            for i in range(0, len(destinations), settings.MESSAGE_BATCH_SIZE):
+                batch = [(destination, [self.make_message(destination)])
+                         for destination in destinations[i:i + settings.MESSAGE_BATCH_SIZE]]
+                timestamp = time.time()
+                for destination, _ in batch:
+                    enqueued_at[destination.gcm_id] = timestamp
+                if options['sync']:
+                    # the jobs bound their queue at import, so run their bodies inline
+                    push_each(*SendMessageMixin.deliver_batch(source, batch, {}))
+                else:
+                    SendMessageMixin.broadcast_messages.delay(source, batch, {})
+
+            sent = self.wait(enqueued_at, options['timeout'])
+        finally:
+            user.delete()
+            LocalTransport.clear_log()
+
+        if not sent:
+            raise CommandError('No push recorded, are the default and push rq workers running?')
+        latencies = sorted((sent_at - enqueued_at[token]) * 1000 for token, sent_at in sent.items())
+        elapsed = max(sent.values()) - min(enqueued_at.values())
+        self.stdout.write(f'{len(sent)}/{len(enqueued_at)} pushes in {elapsed:.2f}s, '
+                          f'{len(sent) / elapsed if elapsed else 0:.1f} pushes/sec, '
+                          f'p50={statistics.median(latencies):.2f}ms '
+                          f'p99={latencies[max(int(len(latencies) * 0.99) - 1, 0)]:.2f}ms')
+
+    @staticmethod
+    def create_fixtures(count):
+        tag = uuid.uuid4().hex[:8]
+        user = UserModel.objects.create(username=f'bench-push-{tag}', email=f'bench-push-{tag}@example.com',
+                                        first_name='Bench', last_name='Push')
+        source = DeviceInfo.objects.create(user=user, registration_id=0, gcm_id=f'bench-push-{tag}-source')
+        destinations = DeviceInfo.objects.bulk_create([
+            DeviceInfo(user=user, registration_id=i + 1, gcm_id=f'bench-push-{tag}-{i}') for i in range(count)])
+        FCMDevice.objects.bulk_create([
+            FCMDevice(device_id=str(device.id), user=user, registration_id=device.gcm_id, type='android', active=True)
+            for device in destinations])
+        source = DeviceInfo.objects.select_related('user').get(id=source.id)
+        return user, source, destinations
+
+    @staticmethod
+    def make_message(destination):
+        return {'id': str(uuid.uuid4()), 'thread_id': str(uuid.uuid4()), 'contents': 'bench',
+                'destination_device_id': str(destination.id), 'created_by': None}
+
+    @staticmethod
+    def wait(enqueued_at, timeout):
+        deadline = time.time() + timeout
+        sent = {}
+        while time.time() < deadline:
+            sent = {token: sent_at for token, sent_at, _ in LocalTransport.read_log() if token in enqueued_at}
+            if len(sent) >= len(enqueued_at):
+                break
+            time.sleep(0.2)
+        return sent
@@ -0,0 +1,66 @@
+import asyncio
+import statistics
+import time
+import uuid
+
+import django_rq
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.layers import get_channel_layer
+from django.core.management.base import BaseCommand
+
+from apps.messenger.constants import INCOMING_MGS
+from apps.messenger.func import cache_prefix
+from apps.messenger.subscriptions import MessengerSubscription
+
+
+class Command(BaseCommand):
+    help = 'Measure the call signal round trip to a live device, directly through the channel layer or through rq'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-n', '--count', type=int, default=200, help='number of signals to send')
+        parser.add_argument('--queued', action='store_true',
+                            help='deliver through the default rq queue, needs a running rqworker')
+        parser.add_argument('--timeout', type=float, default=5.0, help='seconds to wait for each signal')
+
+    def handle(self, *args, **options):
+        samples = async_to_sync(self.run)(options['count'], options['queued'], options['timeout'])
+        if not samples:
+            self.stderr.write('No signal delivered')
+            return
+        samples.sort()
+        path = 'queued' if options['queued'] else 'direct'
+        self.stdout.write(f'{path}: {len(samples)} signals, '
+                          f'p50={statistics.median(samples):.2f}ms '
+                          f'p95={samples[int(len(samples) * 0.95) - 1]:.2f}ms '
+                          f'p99={samples[int(len(samples) * 0.99) - 1]:.2f}ms '
+                          f'max={samples[-1]:.2f}ms')
+
+    @staticmethod
+    def send(user_id, device_id, payload, queued):
+        if queued:
+            django_rq.enqueue(MessengerSubscription.send_call_signal, user_id, [device_id], payload)
+        else:
+            MessengerSubscription.send_call_signal(user_id, [device_id], payload)
+
+    async def run(self, count, queued, timeout):
+        layer = get_channel_layer()
+        user_id, device_id = uuid.uuid4(), uuid.uuid4()
+        # stand in for the websocket consumer of a live device
+        group = MessengerSubscription._group_name(cache_prefix(INCOMING_MGS, user_id, device_id))
+        channel = await layer.new_channel()
+        await layer.group_add(group, channel)
+
+        send = sync_to_async(self.send, thread_sensitive=False)
+        samples = []
+        try:
+            for seq in range(count):
+                start = time.perf_counter()
+                await send(user_id, device_id, {'signal_type': 'bench', 'seq': seq}, queued)
+                try:
+                    await asyncio.wait_for(layer.receive(channel), timeout)
+                except asyncio.TimeoutError:
+                    continue
+                samples.append((time.perf_counter() - start) * 1000)
+        finally:
+            await layer.group_discard(group, channel)
+        return samples
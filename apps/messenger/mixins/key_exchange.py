@@ -10,6 +10,7 @@ from apps.auths.models import Token
 from apps.base.mixins import Output
 from apps.base.utils import format_message
 from apps.log.func import authorization_log, activity_log
+from apps.messenger.func import add_pre_key_count
 from apps.messenger.constants import Message
 from apps.messenger.exceptions import PreKeyBundleError, PreKeyCountExceededError, SignedPreKeyInvalid, \
     DeviceLimitExceed
@@ -82,9 +83,11 @@ class AddKeyBundleMixin(Output):
 
                 cls.validate(pre_keys, signed_pre_key, identity_key, device, user)
 
-                for pre_key in pre_keys:
-                    PreKey.objects.create(id=int(pre_key.key_id), public_key=pre_key.public_key,
-                                          device_id=device.id)
+                added, rejected = PreKey.add_many(device.id, [(int(pre_key.key_id), pre_key.public_key)
+                                                              for pre_key in pre_keys])
+                add_pre_key_count(device.id, len(added))
+                if len(rejected) > 0:
+                    logger.info('device %s pre-keys rejected, ids held by another device: %s', device.id, rejected)
 
                 device.signed_pre_key = SignedPreKey.objects.create(id=signed_pre_key.key_id,
                                                                     public_key=signed_pre_key.public_key,
@@ -94,8 +97,9 @@ class AddKeyBundleMixin(Output):
                 device.save()
                 user.save()
                 activity_log(user=user.id, remarks='Update key bundle', doc_id=device.id, date_created=timezone.now(),
-                             data={'user_id': user.id, 'device_id': device.id})
-                return cls(success=True, result={'details': 'Key bundle updated success.'})
+                             data={'user_id': str(user.id), 'device_id': str(device.id)})
+                return cls(success=True, result={'details': 'Key bundle updated success.',
+                                                 'rejected_pre_keys': rejected})
             else:
                 return cls(success=False, errors=Message.INVALID_CREDENTIAL)
         except PreKeyBundleError:
@@ -172,7 +176,7 @@ class VerifyDeviceTokenMixin(Output):
                                                    registration_id=int(registration_id), name=device_name)
                         if device:
                             token.delete()
-                            authorization_log(user, 'Add new device',
+                            authorization_log(user.id, 'Add new device',
                                               {'registration_id': registration_id, 'device_name': device_name})
                             return cls(success=True,
                                        result={'device_id': device.id.__str__(), 'registration_id': registration_id,
@@ -1,20 +1,23 @@
 import collections
 import json
-from uuid import uuid4
+from uuid import uuid4, UUID
 
+from django.conf import settings
+from django.db import transaction
 from django.utils import timezone
 from django_rq import job
-from firebase_admin.messaging import Message as FMessage, Notification
 from graphene.utils.str_converters import to_camel_case
-from cloudinary import CloudinaryImage, uploader
 
 from apps.base.converter import convert_keys
 from apps.base.mixins import Output
 from apps.messenger.constants import Message
-from apps.messenger.func import notification_sender, add_or_update_meeting, get_meeting, leave_meeting
+from apps.messenger.func import add_or_update_meeting, get_meeting, leave_meeting, get_live_devices
 from apps.messenger.models import DeviceInfo, Thread, MemberInfo, UserInfo, Attachment
-from apps.messenger.models.redis import Calls
+from apps.messenger.models.message_thread import Message as ThreadMessage
+from apps.messenger.models.redis import Calls, Mailbox
+from apps.messenger.push import push_each, push_to_devices, push_to_users
 from apps.messenger.subscriptions import MessengerSubscription, CallSignalingSubscription
+from apps.messenger.uploads import upload_attachments
 
 
 class AddThreadMixin(Output):
@@ -77,22 +80,55 @@ class SendMessageMixin(Output):
                 split_list = cls.split_messages(messages)
                 # checking permission
                 thread_list = cls.get_thread_id_list(messages)
+                if Thread.objects.filter(id__in=thread_list).count() != len(thread_list):
+                    raise Thread.DoesNotExist()
+                members = cls.get_member_list(thread_list, user)
                 for thread_id in thread_list:
-                    thread = Thread.objects.get(id=thread_id)
-                    member_info = MemberInfo.objects.filter(
-                        thread=thread, user_info__user_id=user.id).first()
+                    member_info = members.get(str(thread_id), None)
                     if (not member_info or member_info.is_muted or member_info.is_blocked) and not user.is_admin:
                         return cls(success=False, errors={'message': f'{thread_id}', 'code': 'insufficient_permission'})
-                        # uploading files
-                    if len(files) > 0:
-                        file_info = cls.file_uploading(user=user, thread_id=thread_id, files=files)
-
+                # resolving destinations and senders
+                destinations = DeviceInfo.objects.in_bulk([msgs[0].get('destination_device_id') for msgs in split_list])
+                if len(destinations) != len(split_list):
+                    raise DeviceInfo.DoesNotExist()
+                senders = cls.get_sender_list(thread_list, messages)
+
+                # staging files once the send is valid, each file is uploaded once by the uploads queue
+                # and every thread of the send gets its own attachment row
+                attachments = cls.file_uploading(user=user, thread_ids=thread_list, files=files)
+                try:
+                    with transaction.atomic():
+                        Attachment.objects.bulk_create({attachment.id: attachment
+                                                        for thread_attachments in attachments.values()
+                                                        for attachment in thread_attachments
+                                                        if attachment._state.adding}.values())
+                        cls.save_history(user, messages)
+                except Exception:
+                    for thread_attachments in attachments.values():
+                        for attachment in thread_attachments:
+                            attachment.discard()
+                    raise
+                file_info = {thread_id: [attachment.to_media() for attachment in thread_attachments]
+                             for thread_id, thread_attachments in attachments.items()}
+
+                batch = []
                 for msgs in split_list:
-                    destination_id = msgs[0].get('destination_device_id')
-                    destination = DeviceInfo.objects.get(id=destination_id)
-                    cls.broadcast_message.delay(device, destination, msgs, file_info)
-                return cls(success=True, result={'message': 'Sending', 'time_stamp': timezone.now().__str__()})
-            except Thread.DoesNotExist or DeviceInfo.DoesNotExist:
+                    for message in msgs:
+                        message['sender'] = senders.get(message.get('created_by'), None)
+                    destination = destinations[UUID(msgs[0].get('destination_device_id'))]
+                    batch.append((destination, msgs))
+                    if len(batch) >= settings.MESSAGE_BATCH_SIZE:
+                        cls.broadcast_messages.delay(device, batch, file_info)
+                        batch = []
+                if len(batch) > 0:
+                    cls.broadcast_messages.delay(device, batch, file_info)
+                pending = list({attachment.id for thread_attachments in attachments.values()
+                                for attachment in thread_attachments if attachment.status == Attachment.PENDING})
+                if len(pending) > 0:
+                    upload_attachments.delay(pending, [device.id] + list(destinations.keys()))
+                return cls(success=True, result={'message': 'Sending', 'time_stamp': timezone.now().__str__(),
+                                                 'attachments': file_info})
+            except (Thread.DoesNotExist, DeviceInfo.DoesNotExist):
                 return cls(success=False, errors=Message.INVALID_DATA_FORMAT)
 
             except Exception as e:
@@ -101,23 +137,71 @@ class SendMessageMixin(Output):
 
     @classmethod
     @job
-    def broadcast_message(cls, source: DeviceInfo, destination: DeviceInfo, messages, file_info=[]):
-        message_list = []
-        success = True
-        file_info = json.dumps(file_info)
+    def broadcast_messages(cls, source: DeviceInfo, batch, file_info=None):
+        # every push of the batch goes out in one send_all, undelivered messages fall back to the mailbox
+        pushes, fallback = cls.deliver_batch(source, batch, file_info)
+        if len(pushes) > 0:
+            push_each.delay(pushes, fallback)
+
+    @classmethod
+    def deliver_batch(cls, source: DeviceInfo, batch, file_info=None):
+        """
+        deliver a batch and signal its completion to the source, returns the
+        pushes to send and the messages to queue for devices they do not reach;
+        file_info maps a thread id to the media of its messages
+        """
+        delivered, failed, pushes, fallback = [], [], [], {}
+        file_info = file_info or {}
+        for destination, messages in batch:
+            message_list = []
+            for message in messages:
+                message_list.append({'id': message.get('id').__str__(),
+                                     'thread_id': message.get('thread_id').__str__(),
+                                     'registration_id': source.registration_id,
+                                     'media': cls.get_media(file_info, message)})
+            try:
+                success = cls.broadcast_message(source, destination, messages, file_info, pushes=pushes,
+                                                fallback=fallback)
+            except Exception:
+                success = False
+            if success:
+                delivered += message_list
+            else:
+                failed += message_list
+
+        # send signal on transmit completion
+        method = DeviceInfo.check_device_availability(source)
+        for message_list, success in ((delivered, True), (failed, False)):
+            if len(message_list) == 0:
+                continue
+            if method == 'websocket':
+                MessengerSubscription.send_completion_signal(
+                    source, message_list, success)
+            elif method == 'gcm' or method == 'apn':
+                camel_list = []
+                for message in message_list:
+                    camel_list.append(convert_keys(message, to_camel_case))
+                temp = json.dumps(camel_list)
+                pushes.append((source.id, {'messages': temp, 'type': 'completion_signal', 'success': str(success)},
+                               None))
+            else:
+                raise Exception('Communication Error')
+        return pushes, fallback
+
+    @classmethod
+    def broadcast_message(cls, source: DeviceInfo, destination: DeviceInfo, messages, file_info=None, pushes=None,
+                          fallback=None):
         # check if is sync message
-        is_sync = source.user == destination.user
+        is_sync = source.user_id == destination.user_id
         for message in messages:
-            # pos = message_list.items().__len__()
-            message_list.append({'id': message.get('id').__str__(), 'thread_id': message.get('thread_id').__str__(),
-                                 'registration_id': source.registration_id, 'media': file_info})
             message['is_sync'] = is_sync
             message['timestamp'] = timezone.now().__str__()
-            sender_data = cls.get_userinfo(message.get('thread_id'), message.get('created_by'))
-            message['sender'] = sender_data
-            message['media'] = file_info
+            message['media'] = cls.get_media(file_info or {}, message)
 
-        method = DeviceInfo.check_device_availability(destination)
+        try:
+            method = DeviceInfo.check_device_availability(destination)
+        except Exception:
+            method = ''
         if method == 'websocket':
             MessengerSubscription.send_notify(destination, messages)
         elif method == 'gcm' or method == 'apn':
@@ -125,28 +209,23 @@ class SendMessageMixin(Output):
             for message in messages:
                 camel_list.append(convert_keys(message, to_camel_case))
             temp = json.dumps(camel_list)
-            notification = Notification(title=f'New message from {source.user.first_name} {source.user.last_name}',
-                                        body=timezone.now().__str__(), image=source.user.avatar)
-            message = FMessage(data={'messages': temp, 'type': 'incoming_message'}, notification=notification)
-            notification_sender(message=message, device=destination)
+            notification = {'title': f'New message from {source.user.first_name} {source.user.last_name}',
+                            'body': timezone.now().__str__(), 'image': source.user.avatar}
+            push = (destination.id, {'messages': temp, 'type': 'incoming_message'}, notification)
+            if pushes is None:
+                push_each.delay([push], {str(destination.id): messages})
+            else:
+                pushes.append(push)
+                if fallback is not None:
+                    fallback[str(destination.id)] = messages
         else:
-            success = False
+            # keep for the device until it reconnects and drains its mailbox
+            Mailbox.get_or_create_device_mailbox(destination.id).insert_queue(messages)
+        return True
 
-        # send signal on transmit completion
-        method = DeviceInfo.check_device_availability(source)
-        if method == 'websocket':
-            MessengerSubscription.send_completion_signal(
-                source, message_list, success)
-        elif method == 'gcm' or method == 'apn':
-            camel_list = []
-            for message in message_list:
-                camel_list.append(convert_keys(message, to_camel_case))
-            temp = json.dumps(camel_list)
-            message = FMessage(
-                data={'messages': temp, 'type': 'completion_signal', 'success': str(success)})
-            notification_sender(message=message, device=source)
-        else:
-            raise Exception('Communication Error')
+    @staticmethod
+    def get_media(file_info, message):
+        return json.dumps(file_info.get(str(message.get('thread_id')), []))
 
     @classmethod
     def split_messages(cls, messages):
@@ -167,36 +246,94 @@ class SendMessageMixin(Output):
         return result
 
     @classmethod
-    def get_userinfo(cls, thread_id, member_id):
-        try:
-            member = MemberInfo.objects.filter(
-                thread_id=thread_id, id=member_id).first()
-            user = UserInfo.objects.filter(
-                id=member.user_info.id).first().get_user()
-            return {'id': user.id.__str__(), 'first_name': user.first_name, 'last_name': user.last_name,
-                    'avatar': user.avatar}
-        except MemberInfo.DoesNotExist:
-            pass
+    def save_history(cls, user, messages):
+        """
+        store a row per destination, reply_to holds the client id of the replied
+        message and is linked to the copy of the same destination when it is
+        stored already or part of this send
+        """
+        history, stored = [], {}
+        for msg in messages:
+            reply_to = msg.get('reply_to', None)
+            history.append(ThreadMessage(client_id=msg.get('id'), thread_id=msg.get('thread_id'),
+                                         destination=msg.get('destination_device_id'), contents=msg.get('contents'),
+                                         reply_to_client_id=str(reply_to) if reply_to else None,
+                                         extras=msg.get('extras', None) or {}, user_created=user.id))
+            stored[(str(msg.get('thread_id')), str(msg.get('destination_device_id')), msg.get('id'))] = history[-1].id
+
+        replies = {(str(message.thread_id), str(message.destination), message.reply_to_client_id)
+                   for message in history if message.reply_to_client_id}
+        replied = ThreadMessage.find_by_client_ids(replies.difference(stored.keys()))
+        replied.update(stored)
+        for message in history:
+            if message.reply_to_client_id:
+                message.reply_to_id = replied.get((str(message.thread_id), str(message.destination),
+                                                   message.reply_to_client_id), None)
+        return ThreadMessage.objects.bulk_create(history, batch_size=settings.MESSAGE_BATCH_SIZE)
 
     @classmethod
-    def file_uploading(cls, user, thread_id, files=None):
+    def get_member_list(cls, thread_ids, user):
+        members = MemberInfo.objects.filter(thread_id__in=thread_ids, user_info__user_id=user.id)
+        return {str(member.thread_id): member for member in members}
+
+    @classmethod
+    def get_sender_list(cls, thread_ids, messages):
+        member_ids = set(str(msg.get('created_by')) for msg in messages)
+        members = MemberInfo.objects.filter(thread_id__in=thread_ids, id__in=member_ids).select_related(
+            'user_info__user')
+        result = {}
+        for member in members:
+            user = member.user_info.user
+            result[str(member.id)] = {'id': user.id.__str__(), 'first_name': user.first_name,
+                                      'last_name': user.last_name, 'avatar': user.avatar}
+        return result
+
+    @classmethod
+    def file_uploading(cls, user, thread_ids, files=None):
+        """
+        stage image and video files locally and return the unsaved upload tickets
+        by thread id, a file is staged once and the rows of the other threads
+        follow its upload; files already uploaded once reuse their cloudinary asset
+        """
         if files is None:
             files = []
-        results = []
-        for file in files:
-            if file.content_type.__contains__('image'):
-                media = uploader.upload_resource(file=file, folder=str(thread_id), tags=['attachments'],
-                                                 discard_original_filename=True, eager={"width": 1920, "crop": "limit"})
-                attachment = media.metadata['eager'][0]
-                Attachment.objects.create(image=media, user_created=user.id, thread_id=thread_id)
-                results.append({'isVideo': False, 'uri': attachment['url'], 'name': media.public_id})
-            elif file.content_type.__contains__('video'):
-                media = uploader.upload_large(file=file, folder=str(thread_id), tags=['attachments'],
-                                              resource_type="video", discard_original_filename=True,
-                                              eager={"width": 1920, "crop": "limit", "audio_codec": "none"})
-                # Attachment.objects.create(video=media, user_created=user.id, thread_id=thread_id)
-                results.append({'isVideo': True, 'uri': media['url'], 'name': media['public_id']})
-        return results
+        staged, hashes = {}, []
+        try:
+            for file in files:
+                if file.content_type.__contains__('image') or file.content_type.__contains__('video'):
+                    attachment = Attachment.stage(user, thread_ids[0], file)
+                    if attachment.content_hash in staged:
+                        attachment.discard()
+                    else:
+                        staged[attachment.content_hash] = attachment
+                    hashes.append(attachment.content_hash)
+        except Exception:
+            for attachment in staged.values():
+                attachment.discard()
+            raise
+
+        uploaded = Attachment.find_uploaded(list(staged.keys()), user.id, thread_ids[0])
+        result = {}
+        for thread_id in thread_ids:
+            # one entry per file in the order sent, identical files share their row
+            attachments = {content_hash: (uploaded.get(content_hash, None) or attachment).reuse(user, thread_id)
+                           for content_hash, attachment in staged.items()}
+            result[str(thread_id)] = [attachments[content_hash] for content_hash in hashes]
+        for content_hash in uploaded.keys():
+            staged[content_hash].discard()
+        return result
+
+
+class AckMessageMixin(Output):
+    # [message_ids] ids of the mailbox entries returned by fetchPendingMessages
+    @classmethod
+    def resolve_mutation(cls, root, info, **kwargs):
+        device = getattr(info.context, 'device', None)
+        if device:
+            message_ids = kwargs.get('message_ids', [])
+            removed = Mailbox.get_or_create_device_mailbox(device.id).remove_task(*message_ids)
+            return cls(success=True, result={'removed': removed, 'code': 'messages_acknowledged'})
+        return cls(success=False, errors=Message.NO_AUTH_DEVICE)
 
 
 class SeenMessageMixin(Output):
@@ -237,8 +374,8 @@ class SeenMessageMixin(Output):
         if method == 'websocket':
             MessengerSubscription.send_seen_signal(device, payload)
         elif method == 'gcm':
-            message = Message(data=payload, topic='seen_signal_sent')
-            notification_sender(message=message, device=device)
+            push_to_devices.delay([device.id], {'type': 'seen_signal_sent',
+                                                'payload': json.dumps(convert_keys(payload, to_camel_case))})
         elif method == 'apn':
             pass
 
@@ -257,18 +394,19 @@ class CallSignalingMixin(Output):
                 # if not contacts.__contains___(str(callee_id)):
                 #     return cls(success=False, errors={'message': 'Invalid contact', 'code': 'invalid_id'})
 
-                cls.send_call_signal.delay(user, callee_id, kwargs.get('meeting_id'))
+                payload = cls.get_payload(user, kwargs.get('meeting_id'))
+                live_devices = get_live_devices(callee_id)
+                MessengerSubscription.send_call_signal(callee_id, live_devices, payload)
+                cls.send_call_signal(user, callee_id, kwargs.get('meeting_id'), exclude=live_devices)
                 return cls(success=True, result={'message': 'success'})
             else:
                 return cls(success=False, errors=Message.INVALID_CREDENTIAL)
         except Exception as e:
             return cls(success=False, errors={'message': e.__str__(), 'code': 'unexpected_exception'})
 
-    @classmethod
-    @job
-    def send_call_signal(cls, source, destination, meeting_id, data=None):
-        meeting_id = str(meeting_id)
-        payload = {
+    @staticmethod
+    def get_payload(source, meeting_id):
+        return {
             'signal_type': 'calling',
             'from': {
                 'id': source.id.__str__(),
@@ -276,18 +414,16 @@ class CallSignalingMixin(Output):
                 'last_name': source.last_name,
                 'username': source.username,
             },
-            'meeting_id': meeting_id,
+            'meeting_id': str(meeting_id),
         }
-        notification = Notification(title=f'Incoming call from {source.first_name} {source.last_name}',
-                                    image=source.avatar)
 
+    @classmethod
+    def send_call_signal(cls, source, destination, meeting_id, data=None, exclude=()):
+        payload = cls.get_payload(source, meeting_id)
+        notification = {'title': f'Incoming call from {source.first_name} {source.last_name}',
+                        'image': source.avatar}
         temp = json.dumps(convert_keys(payload, to_camel_case))
-        message = FMessage(notification=notification, data={
-            'type': 'meeting',
-            'payload': temp,
-        })
-        for device in DeviceInfo.objects.filter(user_id=destination):
-            notification_sender(message=message, device=device)
+        push_to_users.delay([destination], {'type': 'meeting', 'payload': temp}, notification, exclude=exclude)
 
 
 # </editor-fold>
@@ -303,6 +439,8 @@ class CallSignaling2Mixin(Output):
                 # signal type, has_video, call_id, recipients, answer, offer
                 signal_type = kwargs.get('signal_type', None)
                 call_id = kwargs.get('call_id', None)
+                if call_id:
+                    call_id = call_id.__str__()
 
                 if signal_type == 'add_offer_candidate':
                     offer_candidate = kwargs.get('offer_candidate')
@@ -313,9 +451,11 @@ class CallSignaling2Mixin(Output):
                     if call_id:
                         update = Calls.update_call(call_id=call_id, offer_candidate=offer_candidate)
                         if update:
-                            CallSignalingSubscription.broadcast(group=cls.prefix(call_id),
-                                                                payload={'signal_type': signal_type,
-                                                                         'offer_candidate': offer_candidate})
+                            payload = {'signal_type': signal_type, 'call_id': call_id,
+                                       'offer_candidate': offer_candidate}
+                            if kwargs.get('to', None):
+                                cls.send_signal(user, kwargs.get('to'), payload)
+                            CallSignalingSubscription.broadcast(group=cls.prefix(call_id), payload=payload)
                             return cls(success=True, results={'call_id': call_id})
                         else:
                             return cls(success=False, errors=Message.INVALID_DATA_FORMAT)
@@ -325,9 +465,11 @@ class CallSignaling2Mixin(Output):
                         return cls(success=False, errors=Message.INVALID_DATA_FORMAT)
                     update = Calls.update_call(call_id, answer_candidate=answer_candidate)
                     if update:
-                        CallSignalingSubscription.broadcast(group=cls.prefix(call_id),
-                                                            payload={'signal_type': signal_type,
-                                                                     'answer_candidate': answer_candidate})
+                        payload = {'signal_type': signal_type, 'call_id': call_id,
+                                   'answer_candidate': answer_candidate}
+                        if kwargs.get('to', None):
+                            cls.send_signal(user, kwargs.get('to'), payload)
+                        CallSignalingSubscription.broadcast(group=cls.prefix(call_id), payload=payload)
                         return cls(success=True, results={'call_id': call_id})
                     else:
                         return cls(success=False, errors=Message.INVALID_DATA_FORMAT)
@@ -336,14 +478,14 @@ class CallSignaling2Mixin(Output):
                     to = kwargs.get('to', None)
                     if not offer or not to:
                         return cls(success=False, errors=Message.INVALID_DATA_FORMAT)
-                    update = Calls.update_call(call_id, offer=offer)
+                    update = Calls.update_call(call_id, **{signal_type: offer})
                     if update:
                         payload = {
                             'signal_type': signal_type,
                             'call_id': call_id,
                             'data': offer,
                         }
-                        cls.send_signal.delay(user, to, payload)
+                        cls.send_signal(user, to, payload)
                         return cls(success=True, result={'call_id': call_id})
                     else:
                         return cls(success=False, errors=Message.INVALID_DATA_FORMAT)
@@ -355,7 +497,12 @@ class CallSignaling2Mixin(Output):
                         'call_id': call_id,
                     }
                     Calls.stop_call(call_id)
-                    cls.send_signal(user, '', payload)
+                    if kwargs.get('to', None):
+                        cls.send_signal(user, kwargs.get('to'), payload)
+                    else:
+                        cls.stamp_source(user, payload)
+                        CallSignalingSubscription.broadcast(group=cls.prefix(call_id), payload=payload)
+                    return cls(success=True, result={'call_id': call_id})
         except Exception as e:
             return cls(success=False, errors={'message': e.__str__(), 'code': 'unexpected_exception'})
 
@@ -363,25 +510,36 @@ class CallSignaling2Mixin(Output):
     def prefix(cls, meeting_id):
         return f'meeting:{meeting_id.__str__()}'
 
-    @classmethod
-    @job
-    def send_signal(cls, source, destination, data):
+    @staticmethod
+    def stamp_source(source, data):
         data['from'] = {
             'id': source.id.__str__(),
             'first_name': source.first_name,
             'last_name': source.last_name,
             'username': source.username,
         }
+        return data
+
+    @classmethod
+    def send_signal(cls, source, destination, data):
+        """
+        deliver a signal from the request handler: devices with a live websocket
+        get it through the channel layer right away, the others through the
+        queued FCM fallback
+        """
+        cls.stamp_source(source, data)
+        live_devices = get_live_devices(destination)
+        MessengerSubscription.send_call_signal(destination, live_devices, data)
+        # offers ring every other device, the rest only fall back when nothing is connected
+        if data['signal_type'] == 'offer' or len(live_devices) == 0:
+            cls.push_signal(source, destination, data, exclude=live_devices)
+        return live_devices
+
+    @classmethod
+    def push_signal(cls, source, destination, data, exclude=()):
+        notification = None
         if data['signal_type'] == 'offer':
-            notification = Notification(title=f'Incoming call from {source.first_name} {source.last_name}',
-                                        image=source.avatar)
-
-            temp = json.dumps(convert_keys(data, to_camel_case))
-            message = FMessage(notification=notification, data={
-                'type': 'meeting',
-                'payload': temp,
-            })
-            for device in DeviceInfo.objects.filter(user_id=destination):
-                notification_sender(message=message, device=device)
-        else:
-            CallSignalingSubscription.broadcast(group=cls.prefix(data['id']), payload=data)
+            notification = {'title': f'Incoming call from {source.first_name} {source.last_name}',
+                            'image': source.avatar}
+        temp = json.dumps(convert_keys(data, to_camel_case))
+        push_to_users.delay([destination], {'type': 'meeting', 'payload': temp}, notification, exclude=exclude)
@@ -1,11 +1,9 @@
 from django.conf import settings
-from django_rq import job
-from fcm_django.models import FCMDevice
-from firebase_admin.messaging import Message as FMessage
 
 from apps.base.mixins import Output
 from apps.messenger.constants import Message
-from apps.messenger.models import UserInfo, DeviceInfo
+from apps.messenger.models import UserInfo
+from apps.messenger.push import push_to_users
 from apps.messenger.utils import validate_date_str
 
 
@@ -74,7 +72,7 @@ class SendFriendRequestMixin(Output):
                 recipient_id = kwargs.get('recipient_id', None)
                 user_info.send_friend_request(recipient_id)
                 # send notify
-                cls.send_friend_request.delay(recipient_id, user.id)
+                cls.send_friend_request(recipient_id, user.id)
                 return cls(success=True, result={'message': 'Request sent'})
             else:
                 return cls(success=False, errors=Message.INVALID_CREDENTIAL)
@@ -82,15 +80,8 @@ class SendFriendRequestMixin(Output):
             return cls(success=False, errors={'message': e.__str__(), 'code': 'unexpected_exception'})
 
     @classmethod
-    @job
     def send_friend_request(cls, user_id, sender_id):
-        devices = DeviceInfo.objects.filter(user_id=user_id)
-        if devices.exists():
-            message = FMessage(data={'type': 'friend_request', 'sender': sender_id.__str__()})
-            for device in devices:
-                client = FCMDevice.objects.filter(device_id=device.id, user_id=user_id).first()
-                if client:
-                    client.send_message(message=message)
+        push_to_users.delay([user_id], {'type': 'friend_request', 'sender': sender_id.__str__()})
 
 
 class ProcessFriendRequestMixin(Output):
@@ -105,7 +96,7 @@ class ProcessFriendRequestMixin(Output):
                 is_accept = kwargs.get('is_accept', None)
                 user_info.process_friend_request(user_id=sender_id, is_accept=eval(is_accept))
                 if eval(is_accept):
-                    cls.send_accept_signal.delay(sender_id, user.id)
+                    cls.send_accept_signal(sender_id, user.id)
                 return cls(success=True, result={'message': 'Request accepted success'}) if eval(is_accept) else cls(
                     success=False, result={'message': 'Request denied success'})
             else:
@@ -114,15 +105,8 @@ class ProcessFriendRequestMixin(Output):
             return cls(success=False, errors={'message': e.__str__(), 'code': 'unexpected_exception'})
 
     @classmethod
-    @job
     def send_accept_signal(cls, user_id, sender_id):
-        devices = DeviceInfo.objects.filter(user_id=user_id)
-        if devices.exists():
-            message = FMessage(data={'type': 'friend_accepted', 'sender': sender_id.__str__()})
-            for device in devices:
-                client = FCMDevice.objects.filter(device_id=device.id, user_id=user_id).first()
-                if client:
-                    client.send_message(message=message)
+        push_to_users.delay([user_id], {'type': 'friend_accepted', 'sender': sender_id.__str__()})
 
 
 class RemoveContactMixin(Output):
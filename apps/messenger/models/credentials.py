@@ -1,13 +1,16 @@
-from uuid import uuid4
+from datetime import datetime
+from uuid import uuid4, UUID
 
 from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.db import models
+from django.db import models, transaction, IntegrityError, connection
+from django.db.models import Q
 from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
+from psycopg2.extras import execute_values
 
 from apps.messenger.exceptions import PreKeyCountExceededError
-from apps.messenger.func import get_user_cache
+from apps.messenger.func import get_user_cache, get_contact_set, invalidate_contact_set, consume_pre_keys
 from apps.messenger.utils import AuthenticationCredentials
 
 UserModel = get_user_model()
@@ -34,6 +37,68 @@ class PreKey(models.Model):
             raise PreKeyCountExceededError()
         return PreKey.create(*args, **kwargs)
 
+    @classmethod
+    def add_many(cls, device_id, keys):
+        """
+        insert a batch of (key_id, public_key) of a device with one INSERT ... ON
+        CONFLICT DO NOTHING, returns (added, rejected) key ids; a key id already
+        held by another device is rejected, one the device already has is skipped
+        """
+        if len(keys) == 0:
+            return [], []
+        sql = f'INSERT INTO {cls._meta.db_table} (id, public_key, device_id) VALUES %s ' \
+              f'ON CONFLICT (id) DO NOTHING RETURNING id'
+        with connection.cursor() as cursor:
+            rows = execute_values(cursor.cursor, sql, [(key_id, public_key, device_id) for key_id, public_key in keys],
+                                  page_size=len(keys), fetch=True)
+        added = set(row[0] for row in rows)
+        skipped = [key_id for key_id, _ in keys if key_id not in added]
+        rejected = list(cls.objects.filter(id__in=skipped).exclude(device_id=device_id).values_list(
+            'id', flat=True)) if skipped else []
+        return list(added), rejected
+
+    @classmethod
+    def claim_bundles(cls, user_id, device_id=None):
+        """
+        Claim one pre-key for every enabled device of the user in a single
+        statement. Keys are picked with FOR UPDATE SKIP LOCKED and removed with
+        DELETE ... RETURNING, so concurrent fetchers never get the same key.
+        Returns (identity_key, [(device_id, registration_id, SignedPreKey, PreKey)])
+        """
+        sql = f"""
+            WITH devices AS (
+                SELECT d.id, d.registration_id, d.signed_pre_key_id, u.identity_key
+                FROM {DeviceInfo._meta.db_table} d
+                JOIN {UserModel._meta.db_table} u ON u.id = d.user_id
+                WHERE d.user_id = %s AND (%s::uuid IS NULL OR d.id = %s::uuid)
+                    AND d.signed_pre_key_id IS NOT NULL
+                    AND (d.fetches_messages OR COALESCE(d.gcm_id, '') <> '' OR COALESCE(d.apn_id, '') <> '')
+            ), picked AS (
+                SELECT k.id FROM devices
+                CROSS JOIN LATERAL (
+                    SELECT p.id FROM {cls._meta.db_table} p WHERE p.device_id = devices.id
+                    ORDER BY p.id LIMIT 1 FOR UPDATE SKIP LOCKED
+                ) k
+            ), claimed AS (
+                DELETE FROM {cls._meta.db_table} p USING picked WHERE p.id = picked.id
+                RETURNING p.id, p.public_key, p.device_id
+            )
+            SELECT devices.identity_key, devices.id, devices.registration_id,
+                s.id, s.public_key, s.signature, claimed.id, claimed.public_key
+            FROM devices
+            JOIN claimed ON claimed.device_id = devices.id
+            JOIN {SignedPreKey._meta.db_table} s ON s.id = devices.signed_pre_key_id
+        """
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(sql, [user_id, device_id, device_id])
+            rows = cursor.fetchall()
+
+        consume_pre_keys([row[1] for row in rows])
+        identity_key = rows[0][0] if rows else None
+        bundles = [(row[1], row[2], SignedPreKey(id=row[3], public_key=row[4], signature=row[5]),
+                    cls(id=row[6], public_key=row[7], device_id=row[1])) for row in rows]
+        return identity_key, bundles
+
 
 class SignedPreKey(models.Model):
     id = models.PositiveIntegerField(primary_key=True)
@@ -99,10 +164,10 @@ class DeviceInfo(models.Model):
 
     @classmethod
     def check_device_availability(cls, device):
-        if not device.apn_id and not device.gcm_id and not get_user_cache(device.user_id):
+        user_cache = get_user_cache(device.user_id)
+        if not device.apn_id and not device.gcm_id and not user_cache:
             raise Exception('Unable to communicate with receiver')
         method = ''
-        user_cache = get_user_cache(device.user_id)
         if user_cache:
             dev = user_cache.find_device(str(device.id))
             if dev and dev.incoming_msg:
@@ -144,6 +209,7 @@ class DeviceInfo(models.Model):
 class UserInfo(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid4, editable=False)
     user = models.ForeignKey(UserModel, verbose_name=_('user credentials'), on_delete=models.CASCADE)
+    # legacy pipe-delimited contact ids, moved into Contact by Contact.backfill()
     contacts = models.TextField(verbose_name=_('user contacts'), null=True, blank=True, default='')
     threads = models.ManyToManyField(
         'Thread',
@@ -172,91 +238,203 @@ class UserInfo(models.Model):
         )
 
     def get_friend_requests(self):
-        requests = self.extras.get('friend_request', {})
+        requests = {}
+        for request in FriendRequest.get_pending(self.user_id):
+            is_sender = request.sender_id == self.user_id
+            other_id = request.recipient_id if is_sender else request.sender_id
+            requests[other_id.__str__()] = {
+                'timestamp': request.date_created.__str__(),
+                'type': 'sender' if is_sender else 'receiver'
+            }
         return requests
 
+    def get_friend_request(self, user_id):
+        request = FriendRequest.get_pending(self.user_id).filter(
+            Q(sender_id=user_id) | Q(recipient_id=user_id)).first()
+        if request:
+            return {'timestamp': request.date_created.__str__(),
+                    'type': 'sender' if request.sender_id == self.user_id else 'receiver'}
+
     def send_friend_request(self, user_id):
-        # init friend request data
-        friend = UserInfo.objects.get(user_id=user_id)
-        if friend.extras.get('friend_request', None) is None:
-            friend.extras['friend_request'] = {}
-        if self.extras.get('friend_request', None) is None:
-            self.extras['friend_request'] = {}
         # check if user_id in contact
-        if self.contacts and self.contacts.__contains__(user_id):
+        if self.has_contact(user_id):
             raise Exception(_('User already in contact list'))
-        if self.user_id.__str__() == user_id:
+        if self.user_id.__str__() == user_id.__str__():
             raise Exception(_('Invalid request'))
-
-        if friend and self:
-            timestamp = timezone.now()
-            # create request
-            if friend.extras['friend_request'].get(self.user_id.__str__(), None) is None:
-                # limit friend request
-                if friend.extras['friend_request'].keys().__len__() > settings.FRIEND_REQUEST_LIMIT:
-                    raise Exception(_('Friend request limit exceed'))
-
-                friend.extras['friend_request'][self.user_id.__str__()] = {
-                    'timestamp': timestamp.__str__(),
-                    'type': 'receiver'
-                }
-                self.extras['friend_request'][friend.user_id.__str__()] = {
-                    'timestamp': timestamp.__str__(),
-                    'type': 'sender'
-                }
-                self.save()
-                friend.save()
-            else:
-                raise Exception(_('Friend request already sent.'))
-        else:
+        if not UserModel.objects.filter(id=user_id).exists():
             raise Exception(_('Invalid input'))
+        if self.get_friend_request(user_id):
+            raise Exception(_('Friend request already sent.'))
+        # limit friend request
+        if FriendRequest.objects.filter(recipient_id=user_id, status=FriendRequest.PENDING).count() \
+                >= settings.FRIEND_REQUEST_LIMIT:
+            raise Exception(_('Friend request limit exceed'))
+        try:
+            with transaction.atomic():
+                FriendRequest.objects.create(sender_id=self.user_id, recipient_id=user_id)
+        except IntegrityError:
+            raise Exception(_('Friend request already sent.'))
         return True
 
     def process_friend_request(self, user_id, is_accept=True):
-        if isinstance(self.extras, dict) and self.extras.get('friend_request', None):
-            if self.extras['friend_request'].get(user_id, None) \
-                    and self.extras['friend_request'][user_id]['type'] == 'receiver':
-                # process request
-                sender = UserInfo.objects.get(user_id=user_id)
-                if is_accept:
-                    if not isinstance(sender.contacts, str):
-                        sender.contacts = ''
-                    if not isinstance(self.contacts, str):
-                        self.contacts = ''
-                    self.contacts = user_id.__str__() + '|' + self.contacts
-                    sender.contacts = self.user_id.__str__() + '|' + sender.contacts
-                self.extras['friend_request'].pop(user_id)
-                sender.extras['friend_request'].pop(self.user_id.__str__())
-                self.save()
-                sender.save()
-                return True
-            else:
+        with transaction.atomic():
+            status = FriendRequest.ACCEPTED if is_accept else FriendRequest.DECLINED
+            updated = FriendRequest.objects.filter(sender_id=user_id, recipient_id=self.user_id,
+                                                   status=FriendRequest.PENDING) \
+                .update(status=status, date_modified=timezone.now())
+            if not updated:
                 raise Exception(_('Invalid add friend request'))
-        raise Exception(_('Invalid input'))
+            if is_accept:
+                Contact.link(self.user_id, UUID(str(user_id)))
+        return True
 
     def remove_contact(self, user_id):
-        contact_list = self.get_contacts()
         try:
-            owner_id = self.user_id
-            contact_list.remove(user_id)
-            self.contacts = '|'.join(contact_list)
-            self.save()
-
-            # remove from other user
-            other = UserInfo.objects.filter(user_id=user_id).first()
-            contact_list = other.get_contacts()
-            contact_list.remove(owner_id)
-            other.contacts = '|'.join(contact_list)
-            other.save()
+            return Contact.unlink(self.user_id, UUID(str(user_id)))
         except ValueError:
             return False
-        return True
 
     def get_contacts(self):
-        return ' '.join(self.contacts.split('|')).split()
+        return list(get_contact_set(self.user_id))
+
+    def has_contact(self, user_id):
+        return str(user_id) in get_contact_set(self.user_id)
 
     def get_threads(self):
         return self.threads.filter(memberinfo__is_blocked=False)
 
     def get_user(self):
         return UserModel.objects.filter(id=self.user_id).first()
+
+
+class Contact(models.Model):
+    """
+    A directed contact edge, every friendship is stored in both directions so
+    a user's contact set is a single index range on (owner, contact).
+    """
+    owner = models.ForeignKey(UserModel, verbose_name=_('contact owner'), on_delete=models.CASCADE,
+                              related_name='contact_edges')
+    contact = models.ForeignKey(UserModel, verbose_name=_('contact'), on_delete=models.CASCADE, related_name='+')
+    date_created = models.DateTimeField(verbose_name=_('created date'), default=timezone.now, editable=False)
+
+    class Meta:
+        verbose_name = _('Contact')
+        verbose_name_plural = _('Contacts')
+        default_permissions = ()
+        constraints = [
+            models.UniqueConstraint(fields=['owner', 'contact'], name='contact_edge_uniq'),
+        ]
+
+    @classmethod
+    def link(cls, user_id, other_id):
+        cls.objects.bulk_create([cls(owner_id=user_id, contact_id=other_id),
+                                 cls(owner_id=other_id, contact_id=user_id)], ignore_conflicts=True)
+        transaction.on_commit(lambda: invalidate_contact_set(user_id, other_id))
+        return True
+
+    @classmethod
+    def unlink(cls, user_id, other_id):
+        deleted, _ = cls.objects.filter(Q(owner_id=user_id, contact_id=other_id) |
+                                        Q(owner_id=other_id, contact_id=user_id)).delete()
+        transaction.on_commit(lambda: invalidate_contact_set(user_id, other_id))
+        return deleted > 0
+
+    @classmethod
+    def backfill(cls, batch_size=1000):
+        """move the legacy pipe-delimited UserInfo.contacts strings into contact edges"""
+        legacy = UserInfo.objects.exclude(contacts__isnull=True).exclude(contacts='')
+        pairs = set()
+        for user_id, contacts in legacy.values_list('user_id', 'contacts').iterator():
+            for contact_id in ' '.join(contacts.split('|')).split():
+                try:
+                    contact_id = UUID(contact_id)
+                except ValueError:
+                    continue
+                if contact_id != user_id:
+                    pairs.add((user_id, contact_id))
+                    pairs.add((contact_id, user_id))
+        if not pairs:
+            return 0
+
+        user_ids = {user_id for pair in pairs for user_id in pair}
+        existing = set(UserModel.objects.filter(id__in=user_ids).values_list('id', flat=True))
+        edges = [cls(owner_id=owner_id, contact_id=contact_id) for owner_id, contact_id in pairs
+                 if owner_id in existing and contact_id in existing]
+        with transaction.atomic():
+            cls.objects.bulk_create(edges, batch_size=batch_size, ignore_conflicts=True)
+            legacy.update(contacts='')
+        invalidate_contact_set(*existing)
+        return len(edges)
+
+
+class FriendRequest(models.Model):
+    PENDING, ACCEPTED, DECLINED = 0, 1, 2
+
+    id = models.UUIDField(primary_key=True, default=uuid4, editable=False)
+    sender = models.ForeignKey(UserModel, verbose_name=_('sender'), on_delete=models.CASCADE,
+                               related_name='sent_friend_requests')
+    recipient = models.ForeignKey(UserModel, verbose_name=_('recipient'), on_delete=models.CASCADE,
+                                  related_name='friend_requests')
+    status = models.SmallIntegerField(verbose_name=_('request status'), choices=settings.FRIEND_REQUEST_STATUS,
+                                      default=PENDING)
+    date_created = models.DateTimeField(verbose_name=_('created date'), default=timezone.now, editable=False)
+    date_modified = models.DateTimeField(verbose_name=_('modified date'), default=timezone.now)
+
+    class Meta:
+        verbose_name = _('Friend request')
+        verbose_name_plural = _('Friend requests')
+        ordering = ('-date_created', '-id')
+        default_permissions = ()
+        constraints = [
+            models.UniqueConstraint(fields=['sender', 'recipient'], condition=Q(status=0),
+                                    name='friend_request_pending_uniq'),
+        ]
+        indexes = [
+            models.Index(fields=['recipient', 'status', 'date_created', 'id'], name='friend_request_inbox_idx'),
+            models.Index(fields=['sender', 'status', 'date_created', 'id'], name='friend_request_outbox_idx'),
+        ]
+
+    @classmethod
+    def get_pending(cls, user_id):
+        return cls.objects.filter(Q(recipient_id=user_id) | Q(sender_id=user_id), status=cls.PENDING)
+
+    @classmethod
+    def get_page(cls, user_id, after=None, limit=50):
+        """
+        keyset page of pending requests (sent and received), newest first, with
+        both parties loaded in the same query
+        """
+        queryset = cls.get_pending(user_id).select_related('sender', 'recipient')
+        if after:
+            date_created, pk = after
+            queryset = queryset.filter(Q(date_created__lt=date_created) | Q(date_created=date_created, id__lt=pk))
+        return list(queryset.order_by('-date_created', '-id')[:limit])
+
+    @classmethod
+    def backfill(cls, batch_size=1000):
+        """move the legacy UserInfo.extras['friend_request'] entries into the table"""
+        legacy = UserInfo.objects.filter(extras__has_key='friend_request')
+        requests = []
+        for user_id, extras in legacy.values_list('user_id', 'extras').iterator():
+            for sender_id, value in (extras.get('friend_request') or {}).items():
+                # every request is stored on both sides, keep the receiver copy only
+                if value.get('type') != 'receiver':
+                    continue
+                try:
+                    timestamp = datetime.fromisoformat(value['timestamp'])
+                except (KeyError, ValueError):
+                    timestamp = timezone.now()
+                try:
+                    requests.append(cls(sender_id=UUID(sender_id), recipient_id=user_id, date_created=timestamp))
+                except ValueError:
+                    continue
+        if requests:
+            existing = set(UserModel.objects.filter(
+                id__in={request.sender_id for request in requests}).values_list('id', flat=True))
+            requests = [request for request in requests if request.sender_id in existing]
+        with transaction.atomic():
+            cls.objects.bulk_create(requests, batch_size=batch_size, ignore_conflicts=True)
+            for user_info in legacy.only('id', 'extras'):
+                user_info.extras.pop('friend_request', None)
+                user_info.save(update_fields=['extras'])
+        return len(requests)
@@ -1,10 +1,13 @@
-from uuid import uuid4
+import collections
+import hashlib
+import os
+from uuid import uuid4, UUID
 
 from cloudinary.models import CloudinaryField
 from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.db import models
-from django.db.models import Q, Count
+from django.db import models, transaction, connection
+from django.db.models import Q
 from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 
@@ -52,6 +55,8 @@ class Thread(models.Model):
     members_roles = models.JSONField(verbose_name=_('Member roles'), null=True, blank=True)
     is_encrypted = models.BooleanField(verbose_name=_('Is an encrypted thread'), default=False, editable=False)
     leader_id = models.UUIDField(verbose_name=_('Thread leader id'), null=False, blank=False)
+    member_key = models.CharField(verbose_name=_('Canonical member set key'), max_length=64, null=True, blank=True,
+                                  db_index=True, editable=False)
 
     extras = models.JSONField(null=True, blank=True, default=dict)
 
@@ -93,41 +98,66 @@ class Thread(models.Model):
     def is_group(self):
         return self.members.count() > 2
 
+    @staticmethod
+    def make_member_key(user_ids):
+        """sha256 of the sorted, de-duplicated member user ids"""
+        canonical = ','.join(sorted({str(UUID(str(user_id))) for user_id in user_ids}))
+        return hashlib.sha256(canonical.encode()).hexdigest()
+
+    @classmethod
+    def refresh_member_key(cls, thread_id):
+        user_ids = MemberInfo.objects.filter(thread_id=thread_id).values_list('user_info__user_id', flat=True)
+        cls.objects.filter(id=thread_id).update(member_key=cls.make_member_key(user_ids))
+
+    @classmethod
+    def rebuild_member_keys(cls, batch_size=1000):
+        """
+        backfill member_key for threads created before it was maintained, threads
+        which already have a key are left alone so it can run on every migrate
+        """
+        updated = 0
+        while True:
+            thread_ids = list(cls.objects.filter(member_key__isnull=True).values_list('id', flat=True)[:batch_size])
+            if len(thread_ids) == 0:
+                return updated
+            members = collections.defaultdict(list)
+            for thread_id, user_id in MemberInfo.objects.filter(thread_id__in=thread_ids).values_list(
+                    'thread_id', 'user_info__user_id'):
+                members[thread_id].append(user_id)
+            threads = [cls(id=thread_id, member_key=cls.make_member_key(members[thread_id])) for thread_id in thread_ids]
+            cls.objects.bulk_update(threads, ['member_key'])
+            updated += len(threads)
+
     @classmethod
     def get_thread_by_list_user(cls, user_ids, is_encrypted=False):
-        user_infos = UserInfo.objects.filter(user_id__in=user_ids)
-        # q = Q(is_encrypted=is_encrypted)
-        # for user_info in target_users:
-        #     q &= Q(memberinfo__user_info=user_info)
-        result = Thread.objects.annotate(counter=Count('memberinfo')).filter(counter=len(user_infos))
-        for member in user_infos:
-            result = result.filter(memberinfo__user_info=member)
-        return result
+        return cls.objects.filter(member_key=cls.make_member_key(user_ids), is_deleted=False)
 
     @classmethod
     def get_or_create_thread(cls, thread_name, current_user, user_ids, is_encrypted=False):
-        user_ids.append(current_user.id)
-        thread = cls.get_thread_by_list_user(user_ids, is_encrypted)
-        #  return the thread if it exists
-        if thread.count() == 1:
-            thread = thread.first()
-            return thread
-
-        # create new thread
-        elif thread.count() == 0 and ((user_ids.__len__() < 3 and is_encrypted) or not is_encrypted):
-            thread = Thread.objects.create(
-                name=thread_name, leader_id=current_user.id, is_encrypted=is_encrypted)
-            for user_id in user_ids:
-                user_info = UserInfo.objects.get(user_id=user_id)
-                if user_info:
-                    MemberInfo.objects.create(
-                        user_info=user_info, thread=thread)
-                else:
+        user_ids = set(str(UUID(str(user_id))) for user_id in user_ids)
+        user_ids.add(str(current_user.id))
+        member_key = cls.make_member_key(user_ids)
+
+        with transaction.atomic():
+            # serialize concurrent creates of the same member set until commit
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT pg_advisory_xact_lock(%s)', [int(member_key[:15], 16)])
+
+            #  return the thread if it exists
+            thread = cls.objects.filter(member_key=member_key, is_deleted=False).first()
+            if thread:
+                return thread
+
+            # create new thread
+            if (user_ids.__len__() < 3 and is_encrypted) or not is_encrypted:
+                user_infos = list(UserInfo.objects.filter(user_id__in=user_ids))
+                if len(user_infos) != len(user_ids):
                     raise Exception(_('Invalid user'))
-            # current_user_info = UserInfo.objects.get(user_id=current_user.id)
-            # MemberInfo.objects.create(user_info=current_user_info, thread=thread)
-            thread.save()
-            return thread
+                thread = Thread.objects.create(name=thread_name, leader_id=current_user.id,
+                                               is_encrypted=is_encrypted, member_key=member_key)
+                MemberInfo.objects.bulk_create([MemberInfo(user_info=user_info, thread=thread)
+                                                for user_info in user_infos])
+                return thread
         # raise exception if user not leader
         raise Exception(_('Invalid input.'))
 
@@ -179,7 +209,11 @@ class Message(models.Model):
     thread = models.ForeignKey(Thread, verbose_name=_('thread of message'), on_delete=models.CASCADE)
     status = models.SmallIntegerField(verbose_name=_('message delivery status'), choices=settings.MESSAGE_STATUS,
                                       default=0)
-    reply_to = models.ForeignKey('self', verbose_name=_('reply to message'), on_delete=models.DO_NOTHING)
+    client_id = models.CharField(verbose_name=_('client message id'), max_length=64, null=True, blank=True)
+    reply_to_client_id = models.CharField(verbose_name=_('client id of the replied message'), max_length=64,
+                                          null=True, blank=True)
+    reply_to = models.ForeignKey('self', verbose_name=_('reply to message'), on_delete=models.DO_NOTHING, null=True,
+                                 blank=True, db_constraint=False)
     contents = models.TextField(verbose_name=_('message contents'), null=False, blank=False, editable=False)
     is_pinned = models.BooleanField(verbose_name=_('is pinned message'), default=False)
 
@@ -194,6 +228,9 @@ class Message(models.Model):
         verbose_name = _('Message')
         verbose_name_plural = _('Message')
         ordering = ('-date_created',)
+        indexes = [
+            models.Index(fields=['thread', 'destination', 'date_created', 'id'], name='message_thread_keyset_idx'),
+        ]
         default_permissions = ()
         permissions = (
             ('view_all_message', _('Can view all message')),
@@ -208,12 +245,50 @@ class Message(models.Model):
     def __str__(self):
         return '{} - {}'.format(self.date_created, self.status)
 
+    @classmethod
+    def get_page(cls, thread_id, destination, before=None, limit=50):
+        """
+        keyset pagination over (date_created, id), newest first
+        """
+        result = cls.objects.filter(thread_id=thread_id, destination=destination, is_deleted=False)
+        if before:
+            date_created, pk = before
+            result = result.filter(Q(date_created__lt=date_created) | Q(date_created=date_created, id__lt=pk))
+        return list(result.order_by('-date_created', '-id')[:limit])
+
+    @classmethod
+    def find_by_client_ids(cls, keys):
+        """
+        map (thread_id, destination, client_id) keys to the pk of the stored
+        copy of that message, keys without one are left out
+        """
+        query = Q()
+        for thread_id, destination, client_id in keys:
+            query |= Q(thread_id=thread_id, destination=destination, client_id=client_id)
+        if not query:
+            return {}
+        result = cls.objects.filter(query).values_list('thread_id', 'destination', 'client_id', 'id')
+        return {(str(thread_id), str(destination), client_id): pk for thread_id, destination, client_id, pk in result}
+
 
 class Attachment(models.Model):
+    PENDING, UPLOADED, FAILED = 0, 1, 2
+    STATUS_CODES = ('pending', 'uploaded', 'failed')
+
     id = models.UUIDField(primary_key=True, editable=False, default=uuid4)
     image = CloudinaryField('image', null=True, blank=True)
     video = CloudinaryField('video', null=True, blank=True)
 
+    name = models.CharField(verbose_name=_('file name'), max_length=255, blank=True)
+    content_type = models.CharField(verbose_name=_('content type'), max_length=100, blank=True)
+    status = models.SmallIntegerField(verbose_name=_('upload status'), choices=settings.ATTACHMENT_STATUS,
+                                      default=PENDING)
+    # staged copy waiting for the uploads queue, cleared once uploaded
+    path = models.CharField(verbose_name=_('staging path'), max_length=255, blank=True)
+    url = models.URLField(verbose_name=_('delivery url'), max_length=500, blank=True)
+    # sha256 of the file, identical files share one cloudinary asset
+    content_hash = models.CharField(verbose_name=_('content hash'), max_length=64, blank=True)
+
     user_created = models.UUIDField(verbose_name=_('create by'), blank=True, null=True)
     date_created = models.DateTimeField(default=timezone.now, editable=False)
     thread_id = models.UUIDField()
@@ -222,3 +297,74 @@ class Attachment(models.Model):
         verbose_name = _('attachment')
         verbose_name_plural = _('attachments')
         default_permissions = ()
+        indexes = [
+            models.Index(fields=['content_hash', 'thread_id'], name='attachment_content_hash_idx'),
+        ]
+
+    @property
+    def is_video(self):
+        return self.content_type.startswith('video')
+
+    @classmethod
+    def stage(cls, user, thread_id, file):
+        """
+        stream an uploaded file to ATTACHMENT_STAGING_DIR chunk by chunk, hashing
+        it on the way, the returned attachment is not saved yet
+        """
+        attachment = cls(user_created=user.id, thread_id=thread_id, name=file.name, content_type=file.content_type)
+        os.makedirs(settings.ATTACHMENT_STAGING_DIR, exist_ok=True)
+        attachment.path = os.path.join(settings.ATTACHMENT_STAGING_DIR, attachment.id.hex)
+        digest = hashlib.sha256()
+        with open(attachment.path, 'wb') as staged:
+            for chunk in file.chunks():
+                digest.update(chunk)
+                staged.write(chunk)
+        attachment.content_hash = digest.hexdigest()
+        return attachment
+
+    def discard(self):
+        """drop the staged copy"""
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+        self.path = ''
+
+    @classmethod
+    def find_uploaded(cls, content_hashes, user_id, thread_id=None):
+        """
+        uploaded attachments by content hash that user_id may already read, its own
+        uploads or those of threads it is a member of; a row of thread_id is
+        preferred so a resend inside the same thread does not add a row
+        """
+        readable = Q(user_created=user_id) | Q(thread_id__in=MemberInfo.objects.filter(
+            user_info__user_id=user_id).values('thread_id'))
+        result = {}
+        for attachment in cls.objects.filter(readable, content_hash__in=content_hashes, status=cls.UPLOADED):
+            current = result.get(attachment.content_hash, None)
+            if current is None or (str(current.thread_id) != str(thread_id)
+                                   and str(attachment.thread_id) == str(thread_id)):
+                result[attachment.content_hash] = attachment
+        return result
+
+    def adopt(self, source):
+        """point at the cloudinary asset of an identical uploaded attachment"""
+        self.discard()
+        self.image, self.video, self.url = source.image, source.video, source.url
+        self.status = self.UPLOADED
+        return self
+
+    def reuse(self, user, thread_id):
+        """
+        this attachment for a send to thread_id, another thread gets a new row
+        sharing the asset, or following the upload while this one is pending
+        """
+        if str(self.thread_id) == str(thread_id):
+            return self
+        attachment = Attachment(user_created=user.id, thread_id=thread_id, name=self.name,
+                                content_type=self.content_type, content_hash=self.content_hash)
+        return attachment.adopt(self) if self.status == self.UPLOADED else attachment
+
+    def to_media(self):
+        """the media entry sent along messages, uri stays empty until the upload is done"""
+        media = self.video if self.is_video else self.image
+        return {'ticket': self.id.__str__(), 'isVideo': self.is_video, 'uri': self.url or None,
+                'name': media.public_id if media else self.name, 'status': self.STATUS_CODES[self.status]}
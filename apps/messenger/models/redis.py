@@ -1,104 +1,278 @@
+import collections
 import json
 import uuid
+from datetime import datetime
 from re import S
 from django.conf import settings
-from django.core.cache import cache
+from django_redis import get_redis_connection
 
 
 class DeviceServices:
-    device_id = ''
-    friend_online = False
-    incoming_msg = False
-    requests = False
-    thread_id = None
+    __slots__ = ('device_id', 'flags', 'thread_id')
+
+    FRIEND_ONLINE = 1
+    INCOMING_MSG = 2
+    REQUESTS = 4
 
     def __init__(self, device_id: str, friend_online=False, incoming_msg=False, request=False, thread_id=None):
         self.device_id = device_id
-        self.friend_online = friend_online
-        self.incoming_msg = incoming_msg
-        self.requests = request
+        self.flags = (self.FRIEND_ONLINE if friend_online else 0) | (self.INCOMING_MSG if incoming_msg else 0) | (
+            self.REQUESTS if request else 0)
         self.thread_id = thread_id
 
+    @property
+    def friend_online(self):
+        return bool(self.flags & self.FRIEND_ONLINE)
+
+    @property
+    def incoming_msg(self):
+        return bool(self.flags & self.INCOMING_MSG)
+
+    @property
+    def requests(self):
+        return bool(self.flags & self.REQUESTS)
+
+    @classmethod
+    def decode(cls, device_id, value):
+        if isinstance(device_id, bytes):
+            device_id = device_id.decode()
+        if isinstance(value, bytes):
+            value = value.decode()
+        flags, _, thread_id = value.partition(':')
+        device = cls(device_id, thread_id=thread_id or None)
+        device.flags = int(flags)
+        return device
+
+
+PresenceStatus = collections.namedtuple('PresenceStatus', ['user_id', 'online', 'devices'])
+
 
 class Subscriber:
-    devices: list[DeviceServices] = []
+    __slots__ = ('devices', '_index')
 
     def __init__(self, devices=None):
         if devices is None:
             devices = []
         self.devices = devices
+        self._index = {device.device_id: device for device in devices}
 
     def find_device(self, device_id: str):
-        for device in self.devices:
-            if device.device_id == device_id:
-                return device
-        return None
-
-    def add_or_update_device(self, device_id: str, friend_online=None, incoming_msg=None, request=None, thread_id=None):
-        if self.find_device(device_id) is None:
-            friend_online = False if friend_online is None else friend_online
-            incoming_msg = False if incoming_msg is None else incoming_msg
-            request = False if request is None else request
-            self.devices.append(DeviceServices(device_id, friend_online, incoming_msg, request, thread_id))
-        else:
-            if incoming_msg is not None:
-                self.find_device(device_id).incoming_msg = incoming_msg
-            if friend_online is not None:
-                self.find_device(device_id).friend_online = friend_online
-            if request is not None:
-                self.find_device(device_id).requests = request
-            self.find_device(device_id).thread_id = thread_id
-        return self
-
-    def remove_device(self, device_id: str):
-        device = self.find_device(device_id)
-        if device:
-            self.devices.remove(device)
-            if self.devices.__len__() == 0:
-                del self
-            return True
-        return False
+        return self._index.get(device_id, None)
+
+
+class Presence:
+    """
+    Per-user presence registry.
+
+    Each user owns one redis hash ``presence:<user_id>`` mapping a device id
+    to ``<flags>:<thread_id>``, so every connect, disconnect or subscription
+    change touches a single field atomically instead of re-pickling the
+    whole subscriber.
+    """
+    UPDATE_SCRIPT = """
+        local value = redis.call('HGET', KEYS[1], ARGV[1])
+        local flags = 0
+        if value then
+            flags = tonumber(string.sub(value, 1, string.find(value, ':', 1, true) - 1))
+        end
+        flags = bit.bor(bit.band(flags, bit.bnot(tonumber(ARGV[2]))), tonumber(ARGV[3]))
+        redis.call('HSET', KEYS[1], ARGV[1], flags .. ':' .. ARGV[4])
+        redis.call('EXPIRE', KEYS[1], ARGV[5])
+        return flags
+    """
+    _update_script = None
+
+    @classmethod
+    def prefix(cls, user_id):
+        return f'presence:{user_id.__str__()}'
+
+    @classmethod
+    def get_connection(cls):
+        return get_redis_connection('default')
+
+    @classmethod
+    def get(cls, user_id):
+        values = cls.get_connection().hgetall(cls.prefix(user_id))
+        if not values:
+            return None
+        return Subscriber([DeviceServices.decode(key, value) for key, value in values.items()])
+
+    @classmethod
+    def get_many(cls, user_ids):
+        user_ids = list(user_ids)
+        pipe = cls.get_connection().pipeline(transaction=False)
+        for user_id in user_ids:
+            pipe.hgetall(cls.prefix(user_id))
+        results = []
+        for user_id, values in zip(user_ids, pipe.execute()):
+            online = False
+            devices = []
+            for key, value in values.items():
+                devices.append(key.decode() if isinstance(key, bytes) else key)
+                flags = int(value.split(b':', 1)[0] if isinstance(value, bytes) else value.split(':', 1)[0])
+                online = online or bool(flags & DeviceServices.FRIEND_ONLINE)
+            results.append(PresenceStatus(user_id, online, tuple(devices)))
+        return results
+
+    @classmethod
+    def update(cls, user_id, device_id, friend_online=None, incoming_msg=None, request=None, thread_id=None):
+        mask, flags = 0, 0
+        for flag, value in ((DeviceServices.FRIEND_ONLINE, friend_online), (DeviceServices.INCOMING_MSG, incoming_msg),
+                            (DeviceServices.REQUESTS, request)):
+            if value is not None:
+                mask |= flag
+                flags |= flag if value else 0
+        if cls._update_script is None:
+            cls._update_script = cls.get_connection().register_script(cls.UPDATE_SCRIPT)
+        return cls._update_script(keys=[cls.prefix(user_id)],
+                                  args=[device_id.__str__(), mask, flags, thread_id or '', settings.CACHE_TIMEOUT])
+
+    @classmethod
+    def remove(cls, user_id, device_id=None):
+        if device_id:
+            return cls.get_connection().hdel(cls.prefix(user_id), device_id.__str__())
+        return cls.get_connection().delete(cls.prefix(user_id))
+
+
+class DeviceHeartbeat:
+    """
+    Coalesces device ``last_seen`` bumps in the redis hash
+    ``device:heartbeat`` until they are flushed to the database.
+    """
+    KEY = 'device:heartbeat'
+
+    @classmethod
+    def get_connection(cls):
+        return get_redis_connection('default')
+
+    @classmethod
+    def touch(cls, device_id, timestamp):
+        return cls.get_connection().hset(cls.KEY, device_id.__str__(), timestamp.isoformat())
+
+    @classmethod
+    def pop_all(cls):
+        pipe = cls.get_connection().pipeline(transaction=True)
+        pipe.hgetall(cls.KEY)
+        pipe.delete(cls.KEY)
+        values, _ = pipe.execute()
+        return {key.decode(): datetime.fromisoformat(value.decode()) for key, value in values.items()}
+
+
+class PreKeyCounter:
+    """
+    Remaining one-time pre-keys per device, kept in the redis hash
+    ``prekey:count`` so status polls and claims never COUNT(*) the table.
+    A missing field means the counter is cold and must be loaded from the
+    database.
+    """
+    KEY = 'prekey:count'
+    DECR_SCRIPT = """
+        local result = {}
+        for i, device_id in ipairs(ARGV) do
+            if redis.call('HEXISTS', KEYS[1], device_id) == 1 then
+                result[i] = redis.call('HINCRBY', KEYS[1], device_id, -1)
+            else
+                result[i] = false
+            end
+        end
+        return result
+    """
+    INCR_SCRIPT = """
+        if redis.call('HEXISTS', KEYS[1], ARGV[1]) == 1 then
+            return redis.call('HINCRBY', KEYS[1], ARGV[1], ARGV[2])
+        end
+        return false
+    """
+    _decr_script = None
+    _incr_script = None
+
+    @classmethod
+    def get_connection(cls):
+        return get_redis_connection('default')
+
+    @classmethod
+    def get(cls, device_id):
+        value = cls.get_connection().hget(cls.KEY, device_id.__str__())
+        return int(value) if value is not None else None
+
+    @classmethod
+    def load(cls, device_id, count):
+        """warm a cold counter with a database count, a counter warmed meanwhile is kept"""
+        connection = cls.get_connection()
+        connection.hsetnx(cls.KEY, device_id.__str__(), count)
+        return cls.get(device_id)
+
+    @classmethod
+    def incr(cls, device_id, amount):
+        """add to a warm counter, returns the new count or None when cold"""
+        if cls._incr_script is None:
+            cls._incr_script = cls.get_connection().register_script(cls.INCR_SCRIPT)
+        return cls._incr_script(keys=[cls.KEY], args=[device_id.__str__(), amount])
+
+    @classmethod
+    def decr_many(cls, device_ids):
+        """decrement every warm counter, returns {device_id: count or None}"""
+        device_ids = [device_id.__str__() for device_id in device_ids]
+        if len(device_ids) == 0:
+            return {}
+        if cls._decr_script is None:
+            cls._decr_script = cls.get_connection().register_script(cls.DECR_SCRIPT)
+        counts = cls._decr_script(keys=[cls.KEY], args=device_ids)
+        return {device_id: count for device_id, count in zip(device_ids, counts)}
+
+    @classmethod
+    def remove(cls, device_id):
+        return cls.get_connection().hdel(cls.KEY, device_id.__str__())
 
 
 class Mailbox:
-    device_id = ''
-    message_queue = []
+    """
+    Per-device offline mailbox kept in the redis stream ``mailbox:<device_id>``.
+
+    Every message is its own entry, so trimming the stream to
+    ``MESSAGE_QUEUE_LIMIT`` entries on every insert keeps that many messages,
+    and entries stay until the device acknowledges them by id.
+    """
+    __slots__ = ('device_id',)
 
     def __init__(self, device_id):
         self.device_id = device_id.__str__()
 
-    def insert_queue(self, task_id):
-        if self.queue_count() > settings.MESSAGE_QUEUE_LIMIT:
-            item_id = self.message_queue.pop(0)
-            # TODO: remove task
-
-        self.message_queue.append(task_id)
+    @classmethod
+    def prefix(cls, device_id):
+        return f'mailbox:{device_id.__str__()}'
 
-    def remove_task(self, task_id):
-        self.message_queue.remove(task_id)
-        # TODO: remove task
+    @classmethod
+    def get_connection(cls):
+        return get_redis_connection('default')
+
+    def insert_queue(self, messages):
+        """one entry per message so MESSAGE_QUEUE_LIMIT counts messages, returns the entry ids"""
+        pipe = self.get_connection().pipeline(transaction=False)
+        for message in messages:
+            pipe.xadd(self.prefix(self.device_id), {'data': json.dumps([message])},
+                      maxlen=settings.MESSAGE_QUEUE_LIMIT, approximate=False)
+        pipe.expire(self.prefix(self.device_id), settings.CACHE_TIMEOUT)
+        return [entry_id.decode() for entry_id in pipe.execute()[:len(messages)]]
+
+    def fetch(self, count=None):
+        entries = self.get_connection().xrange(self.prefix(self.device_id), count=count)
+        return [(entry_id.decode(), json.loads(fields[b'data'])) for entry_id, fields in entries]
+
+    def remove_task(self, *task_ids):
+        if len(task_ids) == 0:
+            return 0
+        return self.get_connection().xdel(self.prefix(self.device_id), *task_ids)
 
     def queue_count(self):
-        return self.message_queue.__len__()
+        return self.get_connection().xlen(self.prefix(self.device_id))
 
     @classmethod
     def get_or_create_device_mailbox(cls, device_id):
-        prefix = f'mailbox_{device_id.__str__()}'
-        mailbox = cache.get(prefix)
-        if mailbox is None:
-            mailbox = Mailbox(device_id)
-            cache.set(prefix, mailbox)
-        return mailbox
-
-    def save(self):
-        prefix = f'mailbox_{self.device_id.__str__()}'
-        if self.queue_count() == 0:
-            return self.remove()
-        return cache.set(prefix, self)
+        return Mailbox(device_id)
 
     def remove(self):
-        prefix = f'mailbox_{self.device_id.__str__()}'
-        return cache.delete(prefix)
+        return self.get_connection().delete(self.prefix(self.device_id))
 
 
 class Meeting:
@@ -118,16 +292,49 @@ class Meeting:
         return json.dumps(self, default=lambda o: o.__dict__, sort_keys=True, indent=4)
 
 
-class Calls:
-    offer = {}
-    answer = {}
-    offer_candidates = []
-    answer_candidates = []
-    has_video = True
+CallSession = collections.namedtuple('CallSession', ['call_id', 'has_video', 'offer', 'answer',
+                                                     'offer_candidates', 'answer_candidates'])
 
-    def __init__(self, offer_candidate, has_video=True):
-        self.offer_candidates.append(offer_candidate)
-        self.has_video = has_video
+
+class Calls:
+    """
+    Call signaling state, one set of redis keys per call:
+
+    - ``call:<id>`` hash with ``has_video``, ``offer`` and ``answer``
+    - ``call:<id>:offer_candidates`` / ``call:<id>:answer_candidates`` lists
+    - ``call:<id>:seen`` set used to drop duplicated candidates
+
+    Every write refreshes ``CALL_SESSION_TIMEOUT`` on all keys, so abandoned
+    calls expire on their own. Candidates are appended with RPUSH inside a
+    script, ICE trickling is O(1) and safe across workers.
+    """
+    UPDATE_SCRIPT = """
+        if redis.call('EXISTS', KEYS[1]) == 0 then
+            return -1
+        end
+        local updated = 0
+        if ARGV[2] ~= '' and redis.call('SADD', KEYS[4], 'offer:' .. ARGV[2]) == 1 then
+            redis.call('RPUSH', KEYS[2], ARGV[2])
+            updated = 1
+        end
+        if ARGV[3] ~= '' and redis.call('SADD', KEYS[4], 'answer:' .. ARGV[3]) == 1 then
+            redis.call('RPUSH', KEYS[3], ARGV[3])
+            updated = 1
+        end
+        if ARGV[4] ~= '' and redis.call('HGET', KEYS[1], 'offer') ~= ARGV[4] then
+            redis.call('HSET', KEYS[1], 'offer', ARGV[4])
+            updated = 1
+        end
+        if ARGV[5] ~= '' and redis.call('HGET', KEYS[1], 'answer') ~= ARGV[5] then
+            redis.call('HSET', KEYS[1], 'answer', ARGV[5])
+            updated = 1
+        end
+        for i = 1, #KEYS do
+            redis.call('EXPIRE', KEYS[i], ARGV[1])
+        end
+        return updated
+    """
+    _update_script = None
 
     @classmethod
     def generate_id(cls):
@@ -137,40 +344,58 @@ class Calls:
     def call_prefix(cls, call_id):
         return f'call:{call_id.__str__()}'
 
+    @classmethod
+    def keys(cls, call_id):
+        prefix = cls.call_prefix(call_id)
+        return [prefix, f'{prefix}:offer_candidates', f'{prefix}:answer_candidates', f'{prefix}:seen']
+
+    @classmethod
+    def get_connection(cls):
+        return get_redis_connection('default')
+
+    @staticmethod
+    def dumps(value):
+        return json.dumps(value, sort_keys=True) if value else ''
+
     @classmethod
     def get_call(cls, call_id):
-        return cache.get(cls.call_prefix(call_id))
+        call_key, offer_key, answer_key, _ = cls.keys(call_id)
+        pipe = cls.get_connection().pipeline(transaction=False)
+        pipe.hgetall(call_key)
+        pipe.lrange(offer_key, 0, -1)
+        pipe.lrange(answer_key, 0, -1)
+        values, offer_candidates, answer_candidates = pipe.execute()
+        if not values:
+            return None
+        offer, answer = values.get(b'offer'), values.get(b'answer')
+        return CallSession(call_id.__str__(), values.get(b'has_video') == b'1',
+                           json.loads(offer) if offer else None, json.loads(answer) if answer else None,
+                           [json.loads(candidate) for candidate in offer_candidates],
+                           [json.loads(candidate) for candidate in answer_candidates])
 
     @classmethod
     def create_call(cls, offer_candidate, has_video):
-        call = Calls(offer_candidate, has_video)
         pk = cls.generate_id()
-        cache.set(pk, call)
-        return pk, call
+        call_key = cls.call_prefix(pk)
+        pipe = cls.get_connection().pipeline(transaction=True)
+        pipe.hset(call_key, mapping={'has_video': int(bool(has_video)), 'offer': '', 'answer': ''})
+        pipe.expire(call_key, settings.CALL_SESSION_TIMEOUT)
+        pipe.execute()
+        if offer_candidate:
+            cls.update_call(pk, offer_candidate=offer_candidate)
+        return pk, cls.get_call(pk)
 
     @classmethod
     def stop_call(cls, call_id):
-        prefix = cls.call_prefix(call_id)
-        cache.delete(prefix)
+        return cls.get_connection().delete(*cls.keys(call_id))
 
     @classmethod
     def update_call(cls, call_id, offer_candidate=None, answer_candidate=None, answer=None, offer=None):
-        call: Calls = cls.get_call(call_id)
-        update = False
-        if not call:
+        if cls._update_script is None:
+            cls._update_script = cls.get_connection().register_script(cls.UPDATE_SCRIPT)
+        updated = cls._update_script(keys=cls.keys(call_id),
+                                     args=[settings.CALL_SESSION_TIMEOUT, cls.dumps(offer_candidate),
+                                           cls.dumps(answer_candidate), cls.dumps(offer), cls.dumps(answer)])
+        if updated == -1:
             raise ValueError('Invalid call')
-        if offer_candidate and not call.offer_candidates.__contains__(offer_candidate):
-            call.offer_candidates.append(offer_candidate)
-            update = True
-        if answer_candidate and not call.answer_candidates.__contains__(answer_candidate):
-            call.answer_candidates.append(answer_candidate)
-            update = True
-        if answer and call.answer != answer:
-            call.answer = answer
-            update = True
-        if offer and call.offer != offer:
-            call.offer = offer
-            update = True
-        if update:
-            cache.set(cls.call_prefix(call_id), call)
-        return update
\ No newline at end of file
+        return updated == 1
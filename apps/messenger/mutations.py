@@ -7,7 +7,7 @@ from apps.base.mixins import DynamicArgsMixin, MutationMixin
 from apps.messenger.mixins import AddSignedPreKeyMixin, AddKeyBundleMixin, CreateDeviceTokenMixin, \
     VerifyDeviceTokenMixin, RemoveDeviceMixin, SendMessageMixin, AddThreadMixin, UpdateDeviceInfoMixin, \
     SendFriendRequestMixin, ProcessFriendRequestMixin, RemoveContactMixin, SeenMessageMixin, UpdateAccountInfoMixin, \
-    CallSignaling2Mixin
+    CallSignaling2Mixin, AckMessageMixin
 from apps.messenger.mixins.message_delivery import CallSignalingMixin
 
 
@@ -141,6 +141,15 @@ class SeenMessages(MutationMixin, DynamicArgsMixin, SeenMessageMixin, graphene.M
         message_ids = graphene.List(graphene.UUID, required=True)
 
 
+class AckMessages(MutationMixin, AckMessageMixin, graphene.Mutation):
+    __doc__ = AckMessageMixin.__doc__
+
+    result = AutoCamelCasedScalar()
+
+    class Arguments:
+        message_ids = graphene.List(graphene.String, required=True)
+
+
 class UpdateUserInfo(MutationMixin, UpdateAccountInfoMixin, graphene.Mutation):
     __doc__ = UpdateAccountInfoMixin.__doc__
 
@@ -168,17 +177,17 @@ class CallSignaling(MutationMixin, CallSignalingMixin, graphene.Mutation):
 
 
 # signal type, has_video, call_id, recipients, answer, offer
-# class CallSignaling(MutationMixin, CallSignaling2Mixin, graphene.Mutation):
-#     __doc__ = CallSignaling2Mixin.__doc__
-
-#     result = AutoCamelCasedScalar()
-
-#     class Arguments:
-#         signal_type = graphene.String(required=True)
-#         has_video = graphene.Boolean()
-#         call_id = graphene.UUID()
-#         to = graphene.UUID()
-#         answer = AutoCamelCasedScalar()
-#         offer = AutoCamelCasedScalar()
-#         offer_candidate = AutoCamelCasedScalar()
-#         answer_candidate = AutoCamelCasedScalar()
+class SignalCall(MutationMixin, CallSignaling2Mixin, graphene.Mutation):
+    __doc__ = CallSignaling2Mixin.__doc__
+
+    result = AutoCamelCasedScalar()
+
+    class Arguments:
+        signal_type = graphene.String(required=True)
+        has_video = graphene.Boolean()
+        call_id = graphene.UUID()
+        to = graphene.UUID()
+        answer = AutoCamelCasedScalar()
+        offer = AutoCamelCasedScalar()
+        offer_candidate = AutoCamelCasedScalar()
+        answer_candidate = AutoCamelCasedScalar()
@@ -0,0 +1,186 @@
+import collections
+import json
+import logging
+import random
+import time
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils.module_loading import import_string
+from django_redis import get_redis_connection
+from django_rq import job
+from fcm_django.models import FCMDevice
+from firebase_admin import messaging
+
+from apps.messenger.models.redis import Mailbox
+
+logger = logging.getLogger(__name__)
+
+# send_each / send_each_for_multicast take at most 500 messages per call
+PUSH_BATCH_SIZE = 500
+
+PushResult = collections.namedtuple('PushResult', ['token', 'success', 'invalid'])
+
+
+class FirebaseTransport:
+    """
+    Delivers through the Firebase Admin SDK, one v1 API send per message
+    issued concurrently by send_each / send_each_for_multicast
+    """
+    # the v1 API reports a stale token as UNREGISTERED and a token of another project
+    # as SENDER_ID_MISMATCH, INVALID_ARGUMENT also covers bad payloads so it is not pruned
+    INVALID_TOKEN_ERRORS = (messaging.UnregisteredError, messaging.SenderIdMismatchError)
+
+    def __init__(self):
+        import firebase_admin
+        try:
+            self.app = firebase_admin.get_app()
+        except ValueError:
+            self.app = firebase_admin.initialize_app(
+                firebase_admin.credentials.Certificate(settings.FIREBASE_CREDENTIALS))
+
+    @staticmethod
+    def build_notification(notification):
+        return messaging.Notification(**notification) if notification else None
+
+    def collect(self, tokens, response):
+        results = []
+        for token, result in zip(tokens, response.responses):
+            invalid = isinstance(result.exception, self.INVALID_TOKEN_ERRORS)
+            if not result.success and not invalid:
+                logger.warning('push to %s failed: %s', token, result.exception)
+            results.append(PushResult(token, result.success, invalid))
+        return results
+
+    def send_multicast(self, tokens, data, notification=None):
+        response = messaging.send_each_for_multicast(messaging.MulticastMessage(
+            tokens=tokens, data=data, notification=self.build_notification(notification)), app=self.app)
+        return self.collect(tokens, response)
+
+    def send_all(self, pushes):
+        """pushes is a list of (token, data, notification)"""
+        response = messaging.send_each([messaging.Message(token=token, data=data,
+                                                          notification=self.build_notification(notification))
+                                        for token, data, notification in pushes], app=self.app)
+        return self.collect([token for token, _, _ in pushes], response)
+
+
+class LocalTransport:
+    """
+    Offline stand-in for FCM. Every request sleeps PUSH_STUB_LATENCY ms, fails
+    a token as unregistered with PUSH_STUB_ERROR_RATE probability, and is
+    recorded as [token, sent_at, success] in the redis list ``push:stub:log``
+    so load tests can read deliveries made by any worker process.
+    """
+    LOG_KEY = 'push:stub:log'
+
+    def __init__(self):
+        self.latency = settings.PUSH_STUB_LATENCY / 1000
+        self.error_rate = settings.PUSH_STUB_ERROR_RATE
+
+    @classmethod
+    def get_connection(cls):
+        return get_redis_connection('default')
+
+    def record(self, tokens):
+        if self.latency:
+            time.sleep(self.latency)
+        sent_at = time.time()
+        results = []
+        for token in tokens:
+            success = random.random() >= self.error_rate
+            results.append(PushResult(token, success, not success))
+        if len(results) > 0:
+            self.get_connection().rpush(self.LOG_KEY, *[json.dumps([result.token, sent_at, result.success])
+                                                        for result in results])
+        return results
+
+    def send_multicast(self, tokens, data, notification=None):
+        return self.record(tokens)
+
+    def send_all(self, pushes):
+        return self.record([token for token, _, _ in pushes])
+
+    @classmethod
+    def read_log(cls):
+        return [json.loads(entry) for entry in cls.get_connection().lrange(cls.LOG_KEY, 0, -1)]
+
+    @classmethod
+    def clear_log(cls):
+        return cls.get_connection().delete(cls.LOG_KEY)
+
+
+_transport = None
+
+
+def get_transport():
+    global _transport
+    if _transport is None:
+        _transport = import_string(settings.PUSH_TRANSPORT)()
+    return _transport
+
+
+def get_tokens(user_ids=(), device_ids=(), exclude=()):
+    """active registration ids of the given users / devices, in one query"""
+    query = Q(user_id__in=user_ids) | Q(device_id__in=[str(device_id) for device_id in device_ids])
+    return list(FCMDevice.objects.filter(query, active=True).exclude(
+        device_id__in=[str(device_id) for device_id in exclude]).values_list('registration_id', flat=True))
+
+
+def prune_tokens(results):
+    tokens = [result.token for result in results if result.invalid]
+    if len(tokens) > 0:
+        FCMDevice.objects.filter(registration_id__in=tokens).update(active=False)
+    return len(tokens)
+
+
+def multicast(tokens, data, notification=None):
+    """send the same payload to every token, PUSH_BATCH_SIZE tokens per request"""
+    transport, results = get_transport(), []
+    for i in range(0, len(tokens), PUSH_BATCH_SIZE):
+        results += transport.send_multicast(tokens[i:i + PUSH_BATCH_SIZE], data, notification)
+    prune_tokens(results)
+    return sum(1 for result in results if result.success)
+
+
+@job(settings.PUSH_QUEUE)
+def push_to_users(user_ids, data, notification=None, exclude=()):
+    return multicast(get_tokens(user_ids=user_ids, exclude=exclude), data, notification)
+
+
+@job(settings.PUSH_QUEUE)
+def push_to_devices(device_ids, data, notification=None):
+    return multicast(get_tokens(device_ids=device_ids), data, notification)
+
+
+@job(settings.PUSH_QUEUE)
+def push_each(pushes, fallback=None):
+    """
+    send one payload per device, pushes is a list of (device_id, data, notification)
+    sent with send_all, PUSH_BATCH_SIZE messages per request; fallback maps a
+    device id to the messages queued in its mailbox when the device has no
+    active token or its push fails. Returns the undelivered device ids.
+    """
+    devices = FCMDevice.objects.filter(device_id__in=[str(device_id) for device_id, _, _ in pushes], active=True)
+    tokens = {device.device_id: device.registration_id for device in devices.only('device_id', 'registration_id')}
+    undelivered, messages, targets = [], [], []
+    for device_id, data, notification in pushes:
+        if str(device_id) in tokens:
+            messages.append((tokens[str(device_id)], data, notification))
+            targets.append(str(device_id))
+        else:
+            undelivered.append(str(device_id))
+
+    transport, results = get_transport(), []
+    for i in range(0, len(messages), PUSH_BATCH_SIZE):
+        results += transport.send_all(messages[i:i + PUSH_BATCH_SIZE])
+    prune_tokens(results)
+    undelivered += [device_id for device_id, result in zip(targets, results) if not result.success]
+
+    if len(undelivered) > 0:
+        logger.warning('%s of %s pushes undelivered: %s', len(undelivered), len(pushes), undelivered)
+        for device_id in set(undelivered):
+            if fallback and device_id in fallback:
+                # kept for the device until it reconnects and drains its mailbox
+                Mailbox.get_or_create_device_mailbox(device_id).insert_queue(fallback[device_id])
+    return undelivered
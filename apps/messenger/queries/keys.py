@@ -1,5 +1,8 @@
+from uuid import UUID
+
 import graphene
 
+from apps.messenger.func import get_pre_key_count
 from apps.messenger.models import PreKey, DeviceInfo
 from apps.messenger.models.credentials import UserInfo
 from apps.messenger.types.keys import PreKeyCount, PreKeyResponseType, PreKeyItemType, PreKeyType, SignedPreKeyType
@@ -13,8 +16,7 @@ class KeyQuery(graphene.ObjectType):
     @staticmethod
     def resolve_get_status(root, info, device_id, **kwargs):
         if hasattr(info.context, 'user'):
-            counted = PreKey.objects.filter(device_id=device_id).count()
-            return PreKeyCount(count=counted)
+            return PreKeyCount(count=get_pre_key_count(device_id))
 
     @staticmethod
     def resolve_get_signed_pre_key(root, info, device_id, **kwargs):
@@ -25,26 +27,20 @@ class KeyQuery(graphene.ObjectType):
                 return device.signed_pre_key
 
     @staticmethod
-    def resolve_get_device_keys(root, info, user_id, device_id='*',**kwargs):
+    def resolve_get_device_keys(root, info, user_id, device_id='*', **kwargs):
         if hasattr(info.context, 'user'):
             user = info.context.user
             user_info = UserInfo.objects.get(user_id=user.id)
-            if not user_info.get_contacts().__contains__(user_id.__str__()):
+            if not user_info.has_contact(user_id):
                 return []
-            devices = DeviceInfo.objects.filter(user_id=user_id)
-            items = []
-            if devices.count() > 0:
-                for device in devices:
-                    if device.is_enabled() and (device_id == '*' or device_id == device.id.__str__()) and device.prekey_set.count() > 0:
-                        signed_key = device.signed_pre_key
-                        pre_key = device.prekey_set.all()[:1].get()
-                        if signed_key and pre_key:
-                            key = PreKeyType(id=pre_key.id, public_key=pre_key.public_key)
-                            item = PreKeyItemType(device_id=device.id, registration_id=device.registration_id,
-                                                        signed_pre_key=signed_key, pre_key=key)
-                            items.append(item)
-                            pre_key.delete()
-
-                if items.__len__() > 0:
-                    return PreKeyResponseType(identity_key=user.identity_key, devices=items)
+            try:
+                device_id = None if device_id == '*' else UUID(device_id)
+            except ValueError:
+                return []
+            identity_key, bundles = PreKey.claim_bundles(user_id, device_id)
+            items = [PreKeyItemType(device_id=device, registration_id=registration_id, signed_pre_key=signed_key,
+                                    pre_key=PreKeyType(id=pre_key.id, public_key=pre_key.public_key))
+                     for device, registration_id, signed_key, pre_key in bundles]
+            if items.__len__() > 0:
+                return PreKeyResponseType(identity_key=identity_key, devices=items)
         return []
\ No newline at end of file
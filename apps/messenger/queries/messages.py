@@ -1,13 +1,16 @@
 import graphene
-from datetime import datetime
+from django.conf import settings
 from django.db.models import Q
 
 from apps.account.models import User
-from apps.messenger.func import get_user_cache
-from apps.messenger.models import UserInfo, Thread
-from apps.messenger.models.redis import Calls
+from apps.messenger.func import get_presence_many
+from apps.messenger.utils import encode_cursor, decode_cursor
+from apps.messenger.models import UserInfo, Thread, MemberInfo, FriendRequest
+from apps.messenger.models.message_thread import Message
+from apps.messenger.models.redis import Calls, Mailbox
 from apps.messenger.types import FriendRequestConnection, FriendOnlineConnection, ThreadTypeConnections, \
-    UserViewConnection, FriendOnlineType, FriendRequestType, ThreadType, MeetingType
+    UserViewConnection, FriendOnlineType, FriendRequestType, ThreadType, MeetingType, PendingMessageType, \
+    MessagePageType
 
 
 class MessageQuery(graphene.ObjectType):
@@ -20,21 +23,18 @@ class MessageQuery(graphene.ObjectType):
     search_contacts = graphene.relay.ConnectionField(UserViewConnection, keyword=graphene.String())
     get_online_status = graphene.Field(FriendOnlineType, user_id=graphene.UUID(required=True))
     get_meeting = graphene.Field(MeetingType, meeting_id=graphene.UUID(required=True))
+    fetch_pending_messages = graphene.List(PendingMessageType, limit=graphene.Int(), ack=graphene.Boolean())
+    thread_messages = graphene.Field(MessagePageType, thread_id=graphene.UUID(required=True), before=graphene.String(),
+                                     limit=graphene.Int())
 
     @staticmethod
     def resolve_get_online_status(root, info, **kwargs):
         if hasattr(info.context, 'user') and info.context.user.is_authenticated:
             user_info = UserInfo.objects.get(user=info.context.user)
-            contacts = user_info.get_contacts()
             friend_id = kwargs.get('user_id')
-            if contacts.__contains__(friend_id):
-                friend = get_user_cache(friend_id.__str__())
-                if friend:
-                    for d in friend.devices:
-                        if d.friend_online:
-                            return FriendOnlineType(user_id=friend_id, status='online')
-                else:
-                    return FriendOnlineType(user_id=friend_id, status='offline')
+            if user_info.has_contact(friend_id):
+                presence = get_presence_many([friend_id])[0]
+                return FriendOnlineType(user_id=friend_id, status='online' if presence.online else 'offline')
 
     @staticmethod
     def resolve_friends_online(root, info, **kwargs):
@@ -44,12 +44,9 @@ class MessageQuery(graphene.ObjectType):
             user_info = UserInfo.objects.get(user_id=user.id)
             if user_info:
                 contacts = user_info.get_contacts()
-                for user_id in contacts:
-                    friend = get_user_cache(user_id)
-                    if friend:
-                        for d in friend.devices:
-                            if d.friend_online is True:
-                                arr.append(FriendOnlineType(user_id=user_id, status='online'))
+                for presence in get_presence_many(contacts):
+                    if presence.online:
+                        arr.append(FriendOnlineType(user_id=presence.user_id, status='online'))
             return arr
         return []
 
@@ -57,16 +54,23 @@ class MessageQuery(graphene.ObjectType):
     def resolve_friend_request(root, info, **kwargs):
         if hasattr(info.context, 'user') and info.context.user.is_authenticated:
             user = info.context.user
-            user_info = UserInfo.objects.filter(user_id=user.id).first()
-            requests = user_info.get_friend_requests()
-            result = []
-            for key, value in requests.items():
-                sender = User.objects.get(id=key)
-                if sender:
-                    # 2021-12-27 21:34:53.160763
-                    time = datetime.strptime(value['timestamp'], '%Y-%m-%d %H:%M:%S.%f')
-                    result.append(FriendRequestType(pk=sender.id, first_name=sender.first_name, last_name=sender.last_name, avatar=sender.avatar, timestamp=time, type=value['type']))
-            return result
+            after = kwargs.get('after', None)
+            limit = min(kwargs.get('first', None) or settings.FRIEND_REQUEST_PAGE_LIMIT,
+                        settings.FRIEND_REQUEST_PAGE_LIMIT)
+            requests = FriendRequest.get_page(user.id, decode_cursor(after) if after else None, limit + 1)
+            has_next_page = len(requests) > limit
+            edges = []
+            for request in requests[:limit]:
+                is_sender = request.sender_id == user.id
+                other = request.recipient if is_sender else request.sender
+                node = FriendRequestType(pk=other.id, first_name=other.first_name, last_name=other.last_name,
+                                         avatar=other.avatar, timestamp=request.date_created,
+                                         type='sender' if is_sender else 'receiver')
+                edges.append(FriendRequestConnection.Edge(node=node,
+                                                          cursor=encode_cursor(request.date_created, request.id)))
+            return FriendRequestConnection(edges=edges, page_info=graphene.relay.PageInfo(
+                has_next_page=has_next_page, has_previous_page=after is not None,
+                start_cursor=edges[0].cursor if edges else None, end_cursor=edges[-1].cursor if edges else None))
         return []
 
     @staticmethod
@@ -82,8 +86,7 @@ class MessageQuery(graphene.ObjectType):
         if hasattr(info.context, 'user') and info.context.user.is_authenticated:
             user = info.context.user
             user_info = UserInfo.objects.filter(user_id=user.id).first()
-            contacts = ' '.join(user_info.contacts.split('|')).split()
-            return User.objects.filter(id__in=contacts)
+            return User.objects.filter(id__in=user_info.get_contacts())
         return []
 
     @staticmethod
@@ -124,5 +127,29 @@ class MessageQuery(graphene.ObjectType):
     @staticmethod
     def resolve_get_meeting(root, info, meeting_id):
         call = Calls.get_call(meeting_id)
-        return MeetingType(pk=meeting_id, offers=call.offers, answers=call.answers, members=call.members,
+        return MeetingType(pk=meeting_id, offers={'description': call.offer, 'candidates': call.offer_candidates},
+                           answers={'description': call.answer, 'candidates': call.answer_candidates}, members=[],
                            has_video=call.has_video) if call else None
+
+    @staticmethod
+    def resolve_fetch_pending_messages(root, info, limit=None, ack=False):
+        if hasattr(info.context, 'device') and info.context.device:
+            mailbox = Mailbox.get_or_create_device_mailbox(info.context.device.id)
+            entries = mailbox.fetch(count=limit)
+            if ack:
+                mailbox.remove_task(*[entry_id for entry_id, _ in entries])
+            return [PendingMessageType(id=entry_id, data=messages) for entry_id, messages in entries]
+        return []
+
+    @staticmethod
+    def resolve_thread_messages(root, info, thread_id, before=None, limit=None):
+        if hasattr(info.context, 'device') and info.context.device:
+            user, device = info.context.user, info.context.device
+            if not MemberInfo.objects.filter(thread_id=thread_id, user_info__user_id=user.id, is_blocked=False).exists():
+                return None
+            limit = min(max(limit or settings.MESSAGE_PAGE_LIMIT, 1), settings.MESSAGE_PAGE_LIMIT)
+            messages = Message.get_page(thread_id, device.id, decode_cursor(before) if before else None, limit)
+            next_cursor = None
+            if len(messages) == limit:
+                next_cursor = encode_cursor(messages[-1].date_created, messages[-1].id)
+            return MessagePageType(messages=messages, next_cursor=next_cursor)
@@ -2,7 +2,7 @@ import graphene
 
 from apps.messenger.mutations import AddSignedPreKey, AddKeyBundle, CreateDeviceToken, VerifyDeviceToken, RemoveDevice, \
     AddThread, SendMessage, UpdateDeviceInfo, SendFriendRequest, ProcessFriendRequest, RemoveContact, SeenMessages, \
-    UpdateUserInfo, CallSignaling
+    UpdateUserInfo, CallSignaling, AckMessages, SignalCall
 from apps.messenger.queries import DeviceInfoQuery, KeyQuery, MessageQuery
 from apps.messenger.subscriptions import MessengerSubscription, FriendOnlineSubscription, \
     FriendRequestSubscription, PrivateChannelSubscription, CallSignalingSubscription
@@ -21,8 +21,10 @@ class MessengerMutation(graphene.ObjectType):
     process_friend_request = ProcessFriendRequest.Field()
     remove_contact = RemoveContact.Field()
     seen_signal = SeenMessages.Field()
+    ack_messages = AckMessages.Field()
     update_user_info = UpdateUserInfo.Field()
     call_signaling = CallSignaling.Field()
+    signal_call = SignalCall.Field()
 
 
 class MessengerQuery(DeviceInfoQuery, KeyQuery, MessageQuery, graphene.ObjectType):
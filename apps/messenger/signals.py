@@ -1,9 +1,11 @@
 from django.contrib.auth import get_user_model
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete, post_migrate
 from django.dispatch import receiver
 from fcm_django.models import FCMDevice
 
-from apps.messenger.models import UserInfo, DeviceInfo
+from apps.messenger.func import remove_device_auth
+from apps.messenger.models.redis import PreKeyCounter
+from apps.messenger.models import UserInfo, DeviceInfo, MemberInfo, Thread, Contact, FriendRequest
 
 
 @receiver(post_save, sender=get_user_model())
@@ -29,4 +31,27 @@ def update_device_token(sender, instance: DeviceInfo, **kwargs):
         device, _ = FCMDevice.objects.update_or_create(device_id=instance.id, user_id=instance.user_id)
         device.registration_id = token
         device.type = device_type
+        device.active = True
         device.save()
+
+
+@receiver(post_delete, sender=DeviceInfo)
+def remove_device_token(sender, instance: DeviceInfo, **kwargs):
+    if instance.token:
+        remove_device_auth(instance.token)
+    PreKeyCounter.remove(instance.id)
+
+
+@receiver(post_save, sender=MemberInfo)
+@receiver(post_delete, sender=MemberInfo)
+def update_thread_member_key(sender, instance: MemberInfo, **kwargs):
+    if kwargs.get('created', True):
+        Thread.refresh_member_key(instance.thread_id)
+
+
+@receiver(post_migrate)
+def backfill_contacts(sender, **kwargs):
+    if sender.name == 'apps.messenger':
+        Contact.backfill()
+        FriendRequest.backfill()
+        Thread.rebuild_member_keys()
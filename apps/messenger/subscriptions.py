@@ -4,8 +4,9 @@ from django.conf import settings
 from django.utils.translation import gettext_lazy as _
 
 from apps.base.converter import AutoCamelCasedScalar
-from apps.messenger.constants import FRIEND_ONLINE, INCOMING_MGS, FRIEND_REQUEST, PRIVATE_CHANNEL
-from apps.messenger.func import cache_prefix, get_user_cache, add_or_update_user_cache, get_meeting
+from apps.messenger.constants import FRIEND_ONLINE, INCOMING_MGS, FRIEND_REQUEST, PRIVATE_CHANNEL, PRESENCE
+from apps.messenger.func import cache_prefix, get_user_cache, add_or_update_user_cache, get_meeting, \
+    get_presence_many
 from apps.messenger.mixins.subscription import AuthenticationMixin
 from apps.messenger.models import UserInfo, DeviceInfo
 from apps.messenger.models.message_thread import MemberInfo, Thread
@@ -26,8 +27,16 @@ class FriendOnlineSubscription(Subscription, AuthenticationMixin):
             user_id=user.id, device_id=device.id, friend_online=True)
         prefix = cache_prefix(FRIEND_ONLINE, user.id, device.id)
         cls.send_notify(user.id, device.id, True)
+        if settings.PRESENCE_PUBLISH_MODE == 'group':
+            user_info = UserInfo.objects.filter(user_id=user.id).first()
+            contacts = user_info.get_contacts() if user_info else []
+            return [prefix] + [cls.presence_prefix(contact_id) for contact_id in contacts]
         return [prefix]
 
+    @staticmethod
+    def presence_prefix(user_id):
+        return f'{PRESENCE}:{user_id.__str__()}'
+
     @staticmethod
     def publish(payload, info, *args, **kwargs):
         if payload.get('is_list', False):
@@ -56,18 +65,20 @@ class FriendOnlineSubscription(Subscription, AuthenticationMixin):
 
     @classmethod
     def send_notify(cls, user_id, device_id, is_connect=True, *args, **kwargs):
+        if settings.PRESENCE_PUBLISH_MODE == 'group':
+            cls.broadcast(group=cls.presence_prefix(user_id), payload={
+                'is_list': False, 'data': f'{user_id}|{is_connect}'})
+            return
         user = UserInfo.objects.filter(user_id=user_id).first()
         if user:
             contacts = user.get_contacts()
             # list_online = []
-            for id_user in contacts:
-                user_cache = get_user_cache(id_user)
-                if user_cache:
-                    for device in user_cache.devices:
-                        group_name = cache_prefix(
-                            FRIEND_ONLINE, id_user, device.device_id)
-                        cls.broadcast(group=group_name, payload={
-                            'is_list': False, 'data': f'{id_user}|{is_connect}'})
+            for presence in get_presence_many(contacts):
+                for contact_device_id in presence.devices:
+                    group_name = cache_prefix(
+                        FRIEND_ONLINE, presence.user_id, contact_device_id)
+                    cls.broadcast(group=group_name, payload={
+                        'is_list': False, 'data': f'{presence.user_id}|{is_connect}'})
             #             if is_connect:
             #                 list_online.append({'user_id': id_user, 'status': 'online'})
             # if is_connect:
@@ -130,6 +141,19 @@ class MessengerSubscription(Subscription, AuthenticationMixin):
         else:
             raise Exception(_('Invalid input'))
 
+    @classmethod
+    def send_call_signal(cls, user_id, device_ids, payload):
+        """push a call signal straight through the channel layer to live devices"""
+        for device_id in device_ids:
+            cls.broadcast(group=cache_prefix(INCOMING_MGS, user_id, device_id),
+                          payload={'data': [payload], 'type': 'call_signal'})
+
+    @classmethod
+    def send_attachment_signal(cls, destination: DeviceInfo, payload):
+        """final urls of the attachments a device received tickets for"""
+        cls.broadcast(group=cache_prefix(INCOMING_MGS, destination.user_id, destination.id),
+                      payload={'data': payload, 'type': 'attachment_ready'})
+
     @classmethod
     def send_completion_signal(cls, destination: DeviceInfo, payload, success=True):
         receiver = get_user_cache(destination.user_id)
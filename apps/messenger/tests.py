@@ -1,3 +1,119 @@
-from django.test import TestCase
+from concurrent.futures import ThreadPoolExecutor
+from uuid import uuid4
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+
+from apps.messenger.func import get_pre_key_count
+from apps.messenger.mixins.message_delivery import SendMessageMixin
+from apps.messenger.models import Thread, MemberInfo, UserInfo, DeviceInfo, SignedPreKey, PreKey
+from apps.messenger.models.message_thread import Message
+
+UserModel = get_user_model()
+
+
+def make_user(name):
+    return UserModel.objects.create(username=name, email=f'{name}@example.com', first_name=name, last_name='Test')
+
+
+class ThreadMemberKeyTests(TestCase):
+    def setUp(self):
+        self.alice, self.bob = make_user('alice'), make_user('bob')
+
+    def make_legacy_thread(self, *users):
+        thread = Thread.objects.create(name='legacy', leader_id=users[0].id)
+        MemberInfo.objects.bulk_create([MemberInfo(user_info=UserInfo.objects.get(user=user), thread=thread)
+                                        for user in users])
+        # threads created before member_key was maintained
+        Thread.objects.filter(id=thread.id).update(member_key=None)
+        return thread
+
+    def test_legacy_thread_is_reused_after_rebuild(self):
+        legacy = self.make_legacy_thread(self.alice, self.bob)
+        self.assertEqual(Thread.rebuild_member_keys(), 1)
+
+        thread = Thread.get_or_create_thread('new', self.alice, [self.bob.id])
+        self.assertEqual(thread.id, legacy.id)
+        self.assertEqual(Thread.objects.count(), 1)
+        self.assertEqual(Thread.get_thread_by_list_user([self.bob.id, self.alice.id]).get().id, legacy.id)
+
+    def test_rebuild_skips_threads_with_a_key(self):
+        self.make_legacy_thread(self.alice, self.bob)
+        Thread.rebuild_member_keys()
+        with self.assertNumQueries(1):
+            self.assertEqual(Thread.rebuild_member_keys(), 0)
+
+    def test_new_thread_gets_a_key(self):
+        thread = Thread.get_or_create_thread('new', self.alice, [self.bob.id])
+        self.assertEqual(thread.member_key, Thread.make_member_key([self.alice.id, self.bob.id]))
+        self.assertEqual(Thread.get_or_create_thread('again', self.bob, [self.alice.id]).id, thread.id)
+
+
+class MessageReplyTests(TestCase):
+    def setUp(self):
+        self.alice, self.bob = make_user('alice'), make_user('bob')
+        self.thread = Thread.get_or_create_thread('new', self.alice, [self.bob.id])
+        self.destination = uuid4()
+
+    def message(self, reply_to=None):
+        return {'id': str(uuid4()), 'thread_id': self.thread.id, 'destination_device_id': self.destination,
+                'contents': 'contents', 'reply_to': reply_to, 'created_by': uuid4()}
+
+    def test_reply_is_linked_by_client_id(self):
+        first = self.message()
+        SendMessageMixin.save_history(self.alice, [first])
+        reply = self.message(reply_to=first['id'])
+        # replies to a message of the same send need no lookup
+        nested = self.message(reply_to=reply['id'])
+        SendMessageMixin.save_history(self.bob, [reply, nested])
+
+        stored = {message.client_id: message for message in Message.objects.filter(thread=self.thread)}
+        self.assertEqual(stored[reply['id']].reply_to_id, stored[first['id']].id)
+        self.assertEqual(stored[nested['id']].reply_to_id, stored[reply['id']].id)
+        self.assertEqual(stored[nested['id']].reply_to_client_id, reply['id'])
+
+    def test_reply_to_an_unknown_message_keeps_the_client_id(self):
+        reply_to = str(uuid4())
+        reply = self.message(reply_to=reply_to)
+        SendMessageMixin.save_history(self.alice, [reply])
+        message = Message.objects.get(client_id=reply['id'])
+        self.assertEqual((message.reply_to_id, message.reply_to_client_id), (None, reply_to))
+
+
+class PreKeyClaimTests(TransactionTestCase):
+    def setUp(self):
+        self.user = make_user('alice')
+        self.user.identity_key = 'identity'
+        self.user.save()
+        self.device = self.make_device(1)
+
+    def make_device(self, registration_id):
+        signed_pre_key = SignedPreKey.objects.create(id=registration_id, public_key='signed', signature='signature')
+        return DeviceInfo.objects.create(user=self.user, registration_id=registration_id,
+                                         signed_pre_key=signed_pre_key, fetches_messages=True)
+
+    def claim(self):
+        try:
+            return [pre_key.id for _, _, _, pre_key in PreKey.claim_bundles(self.user.id, self.device.id)[1]]
+        finally:
+            connection.close()
+
+    def test_concurrent_claims_never_share_a_key(self):
+        added, rejected = PreKey.add_many(self.device.id, [(key_id, f'key{key_id}') for key_id in range(1, 11)])
+        self.assertEqual((len(added), rejected), (10, []))
+        self.assertEqual(get_pre_key_count(self.device.id), 10)
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            claimed = [key_id for keys in pool.map(lambda _: self.claim(), range(20)) for key_id in keys]
+
+        self.assertEqual(sorted(claimed), list(range(1, 11)))
+        self.assertFalse(PreKey.objects.filter(device=self.device).exists())
+        self.assertEqual(get_pre_key_count(self.device.id), 0)
+
+    def test_key_ids_of_another_device_are_rejected(self):
+        PreKey.add_many(self.device.id, [(1, 'key1'), (2, 'key2')])
+        other = self.make_device(2)
+        added, rejected = PreKey.add_many(other.id, [(2, 'other2'), (3, 'other3')])
+        self.assertEqual((added, rejected), ([3], [2]))
+        self.assertEqual(PreKey.objects.get(id=2).device_id, self.device.id)
@@ -62,12 +62,19 @@ class FriendOnlineConnection(graphene.Connection):
 class MessageEventType(graphene.ObjectType):
     data = graphene.List(AutoCamelCasedScalar)  # GenericScalar()
     type = graphene.Enum('EVENT_TYPE', [('NewMessage', 'incoming_message'), ('SeenMessage', 'seen_signal'),
-                                        ('MessageDelivered', 'completion_signal')])()
+                                        ('MessageDelivered', 'completion_signal'),
+                                        ('ReplenishKeys', 'replenish_keys'), ('CallSignal', 'call_signal'),
+                                        ('AttachmentReady', 'attachment_ready')])()
 
     # def resolve_data(self, info, **kwargs):
     #     return self.data
 
 
+class PendingMessageType(graphene.ObjectType):
+    id = graphene.String()
+    data = graphene.List(AutoCamelCasedScalar)
+
+
 class OnlineEvent(graphene.ObjectType):
     user_id = graphene.UUID()
     status = graphene.Enum('ONLINE_TYPE', [('Online', 'online'), ('Offline', 'offline')])()
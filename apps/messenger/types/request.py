@@ -2,7 +2,9 @@ import graphene
 from graphene_django import DjangoObjectType
 
 from apps.account.models import User
+from apps.base.loaders import get_loaders
 from apps.messenger.models import Thread, MemberInfo
+from apps.messenger.models.message_thread import Message
 
 
 class AddFriendRequestType(graphene.ObjectType):
@@ -55,7 +57,7 @@ class MemberViewType(DjangoObjectType):
         return self.pk
 
     def resolve_info(self, info, **kwargs):
-        return User.objects.get(id=self.user_info.user_id)
+        return get_loaders(info).users.load(self.user_info.user_id)
 
 
 class ThreadType(DjangoObjectType):
@@ -69,15 +71,38 @@ class ThreadType(DjangoObjectType):
     members = graphene.List(MemberViewType)
 
     def resolve_leader(self, info, **kwargs):
-        return User.objects.get(id=self.leader_id)
+        if self.leader_id is None:
+            return None
+        return get_loaders(info).users.load(self.leader_id)
 
     def resolve_pk(self, info, **kwargs):
         return self.pk
 
     def resolve_members(self, info, **kwargs):
-        return MemberInfo.objects.filter(thread_id=self.pk)
+        return get_loaders(info).thread_members.load(self.pk)
 
 
 class ThreadTypeConnections(graphene.Connection):
     class Meta:
         node = ThreadType
+
+
+class MessageType(DjangoObjectType):
+    class Meta:
+        model = Message
+        fields = ['id', 'client_id', 'reply_to_client_id', 'status', 'contents', 'is_pinned', 'extras',
+                  'user_created', 'date_created', 'destination']
+
+    pk = graphene.UUID()
+    reply_to = graphene.UUID()
+
+    def resolve_pk(self, info, **kwargs):
+        return self.pk
+
+    def resolve_reply_to(self, info, **kwargs):
+        return self.reply_to_id
+
+
+class MessagePageType(graphene.ObjectType):
+    messages = graphene.List(MessageType)
+    next_cursor = graphene.String()
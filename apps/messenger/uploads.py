@@ -0,0 +1,89 @@
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from cloudinary import CloudinaryResource, uploader
+from django.conf import settings
+from django_rq import job
+
+from apps.messenger.models import Attachment, DeviceInfo
+from apps.messenger.push import push_each
+from apps.messenger.subscriptions import MessengerSubscription
+
+logger = logging.getLogger(__name__)
+
+# delivery transformations, pre-generated by cloudinary in the background through eager_async
+IMAGE_TRANSFORMATION = {'width': 1920, 'crop': 'limit'}
+VIDEO_TRANSFORMATION = {'width': 1920, 'crop': 'limit', 'audio_codec': 'none'}
+
+
+def upload(attachment: Attachment):
+    """upload one staged attachment, runs on the pool threads so it must not touch the database"""
+    transformation = VIDEO_TRANSFORMATION if attachment.is_video else IMAGE_TRANSFORMATION
+    options = {'folder': str(attachment.thread_id), 'tags': ['attachments'], 'discard_original_filename': True,
+               'eager': [transformation], 'eager_async': True}
+    try:
+        if attachment.is_video:
+            media = uploader.upload_large(attachment.path, resource_type='video', **options)
+        else:
+            media = uploader.upload(attachment.path, **options)
+    except Exception as e:
+        logger.warning('upload of attachment %s failed: %s', attachment.id, e)
+        attachment.status = Attachment.FAILED
+        return attachment
+    finally:
+        attachment.discard()
+
+    resource = CloudinaryResource(media['public_id'], format=media.get('format'), version=str(media['version']),
+                                  type=media['type'], resource_type=media['resource_type'], metadata=media)
+    if attachment.is_video:
+        attachment.video = resource
+    else:
+        attachment.image = resource
+    attachment.url = resource.build_url(secure=True, **transformation)
+    attachment.status = Attachment.UPLOADED
+    return attachment
+
+
+@job(settings.ATTACHMENT_QUEUE)
+def upload_attachments(attachment_ids, device_ids):
+    """
+    upload the staged attachments of a send, ATTACHMENT_UPLOAD_CONCURRENCY at a
+    time, then deliver their final urls to every device of the send
+    """
+    attachments = list(Attachment.objects.filter(id__in=attachment_ids, status=Attachment.PENDING))
+    # an identical file may have been uploaded by another send since this one was staged
+    uploaded = Attachment.find_uploaded([attachment.content_hash for attachment in attachments],
+                                        attachments[0].user_created if attachments else None)
+    staged = {}
+    for attachment in attachments:
+        if attachment.content_hash in uploaded:
+            attachment.adopt(uploaded[attachment.content_hash])
+        elif attachment.path:
+            staged[attachment.content_hash] = attachment
+    with ThreadPoolExecutor(max_workers=settings.ATTACHMENT_UPLOAD_CONCURRENCY) as pool:
+        list(pool.map(upload, staged.values()))
+    # rows of the other threads of the send follow the staged copy of their file
+    for attachment in attachments:
+        if attachment.status == Attachment.PENDING:
+            source = staged.get(attachment.content_hash, None)
+            if source and source.status == Attachment.UPLOADED:
+                attachment.adopt(source)
+            else:
+                attachment.status = Attachment.FAILED
+    Attachment.objects.bulk_update(attachments, ['image', 'video', 'status', 'path', 'url'])
+
+    payload = [attachment.to_media() for attachment in attachments]
+    pushes = []
+    for device in DeviceInfo.objects.filter(id__in=device_ids):
+        try:
+            method = DeviceInfo.check_device_availability(device)
+        except Exception:
+            continue
+        if method == 'websocket':
+            MessengerSubscription.send_attachment_signal(device, payload)
+        elif method == 'gcm' or method == 'apn':
+            pushes.append((device.id, {'type': 'attachment_ready', 'media': json.dumps(payload)}, None))
+    if len(pushes) > 0:
+        push_each.delay(pushes)
+    return len(payload)
@@ -1,6 +1,8 @@
+import base64
 import hashlib
 import random
 from datetime import datetime
+from uuid import UUID
 
 
 class AuthenticationCredentials:
@@ -29,3 +31,16 @@ def validate_date_str(date_text):
         return datetime.strptime(date_text, '%Y-%m-%d')
     except ValueError:
         raise ValueError("Incorrect data format, should be YYYY-MM-DD")
+
+
+def encode_cursor(date_created, pk):
+    value = f'{date_created.isoformat()}|{pk}'
+    return base64.urlsafe_b64encode(value.encode('utf-8')).decode('utf-8')
+
+
+def decode_cursor(cursor):
+    try:
+        date_created, pk = base64.urlsafe_b64decode(cursor.encode('utf-8')).decode('utf-8').split('|')
+        return datetime.fromisoformat(date_created), UUID(pk)
+    except (ValueError, UnicodeError):
+        raise ValueError("Invalid cursor")
@@ -30,3 +30,5 @@ PERM_ALL_OPTION = (
     (0, _("Current owner/inherit")),
     (1, _("Current data on system")),
 )
+
+PERMISSION_CACHE_TIMEOUT = 60 * 60  # 1 HOUR, dropped earlier by the permission signals
@@ -16,4 +16,16 @@ HISTORY_ACTION_NAME = (
 
 DOCS_CODE = (
     ('key_bundle_update', _('update key bundle'))
-)
\ No newline at end of file
+)
+
+AUDIT_LOG_BATCH_SIZE = 100  # rows per bulk insert
+
+AUDIT_LOG_FLUSH_INTERVAL = 500  # ms between flushes of a partial batch
+
+AUDIT_LOG_BUFFER_LIMIT = 10000  # buffered rows before callers write synchronously
+
+LOG_PAGE_LIMIT = 100
+
+LOG_PARTITION_PREMAKE = 3  # monthly partitions created ahead of time
+
+LOG_RETENTION_MONTHS = 12  # older monthly partitions are dropped
@@ -13,12 +13,50 @@ THREAD_STATUS = (
     (2, _('Archive'))
 )
 
+ATTACHMENT_STATUS = (
+    (0, _('Pending')),
+    (1, _('Uploaded')),
+    (2, _('Failed'))
+)
+
+FRIEND_REQUEST_STATUS = (
+    (0, _('Pending')),
+    (1, _('Accepted')),
+    (2, _('Declined'))
+)
+
 DEVICE_LIMIT = 3
 
 MASTER_ID = '1'
 
 FRIEND_REQUEST_LIMIT = 100
 
+FRIEND_REQUEST_PAGE_LIMIT = 50
+
 CLIENTS_LIMIT = 100
 
-MESSAGE_QUEUE_LIMIT = 100
+MESSAGE_QUEUE_LIMIT = 100  # messages kept per device mailbox, the oldest are trimmed
+
+MESSAGE_BATCH_SIZE = 50
+
+MESSAGE_PAGE_LIMIT = 100
+
+# 'group': publish once to presence:<user_id>, contacts listen on that group
+# 'device': legacy broadcast to every friend_online:<user>:<device> group
+PRESENCE_PUBLISH_MODE = 'group'
+
+DEVICE_AUTH_TIMEOUT = 60 * 60  # 1 HOUR
+
+DEVICE_HEARTBEAT_INTERVAL = 60  # seconds between last_seen flushes
+
+CONTACTS_CACHE_TIMEOUT = 60 * 60  # 1 HOUR
+
+PRE_KEY_LOW_WATER = 10  # replenish event is sent once a device drops below this many pre-keys
+
+CALL_SESSION_TIMEOUT = 60 * 60  # 1 HOUR, refreshed on every signaling update
+
+PUSH_QUEUE = 'push'  # dedicated rq queue for FCM deliveries
+
+ATTACHMENT_QUEUE = 'uploads'  # dedicated rq queue for cloudinary uploads
+
+ATTACHMENT_UPLOAD_CONCURRENCY = 4  # parallel uploads per job
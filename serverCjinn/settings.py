@@ -5,7 +5,6 @@ from pathlib import Path
 import django.db.models.options as options
 from django.utils.translation import ugettext_lazy as _
 from django_filters import rest_framework as filters
-from firebase_admin import initialize_app, credentials
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 
@@ -58,8 +57,8 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
-    'apps.base.middleware.CjinnMiddleware',
-    'apps.base.middleware.OnlineNowMiddleware',
+    'apps.base.middleware.AsyncCjinnMiddleware',
+    'apps.base.middleware.AsyncOnlineNowMiddleware',
 ]
 
 ROOT_URLCONF = 'serverCjinn.urls'
@@ -115,6 +114,16 @@ RQ_QUEUES = {
     'default': {
         'USE_REDIS_CACHE': 'default',
     },
+    'push': {
+        'USE_REDIS_CACHE': 'default',
+    },
+    'uploads': {
+        'USE_REDIS_CACHE': 'default',
+        'DEFAULT_TIMEOUT': 30 * 60,  # large videos
+    },
+}
+RQ = {
+    'WORKER_CLASS': 'apps.log.writer.AuditLogWorker',
 }
 
 CACHE_TIMEOUT = 10 * 60 * 1000  # 10 MIN
@@ -132,11 +141,22 @@ DATABASES = {
         'USER': os.environ.get('DB_USERNAME', 'admin'),
         'PASSWORD': os.environ.get('DB_PASSWORD', '123456@abc'),
         'HOST': 'db',
-        'PORT': '5432'
+        'PORT': '5432',
+        'CONN_MAX_AGE': int(os.environ.get('DB_CONN_MAX_AGE', 60)),
     },
 }
+# threads serving ASGI requests per process, each keeps its own DB connection
+REQUEST_THREADS = int(os.environ.get('REQUEST_THREADS', 8))
+
+FIREBASE_CREDENTIALS = os.path.join(BASE_DIR, 'data/firebase-adminsdk.json')
+# apps.messenger.push.LocalTransport records pushes in redis instead of calling FCM (load tests, offline dev)
+PUSH_TRANSPORT = os.environ.get('PUSH_TRANSPORT', 'apps.messenger.push.FirebaseTransport')
+PUSH_STUB_LATENCY = int(os.environ.get('PUSH_STUB_LATENCY', 0))  # ms per request
+PUSH_STUB_ERROR_RATE = float(os.environ.get('PUSH_STUB_ERROR_RATE', 0))
+
+# attachments are written here by the request and picked up by the uploads workers
+ATTACHMENT_STAGING_DIR = os.environ.get('ATTACHMENT_STAGING_DIR', os.path.join(BASE_DIR, 'data/uploads'))
 
-FIREBASE_APP = initialize_app(credentials.Certificate(os.path.join(BASE_DIR, 'data/firebase-adminsdk.json')))
 FCM_DJANGO_SETTINGS = {
     # default: _('FCM Django')
     "APP_VERBOSE_NAME": "[DEFAULT]",
@@ -4,11 +4,9 @@ from django import http
 from django.conf import settings
 from django.contrib import admin
 from django.urls import path, include
-from django.views.decorators.csrf import csrf_exempt
-from graphene_file_upload.django import FileUploadGraphQLView
 from graphql import GraphQLCoreBackend
 
-from apps.base.views import current_info
+from apps.base.views import current_info, AsyncGraphQLView
 
 
 def graphiql(request):
@@ -28,7 +26,7 @@ class GraphQLCustomCoreBackend(GraphQLCoreBackend):
 
 urlpatterns = [
     path('admin/', admin.site.urls),
-    path('graphql/', csrf_exempt(FileUploadGraphQLView.as_view(graphiql=getattr(settings, 'DEBUG', False)))),
+    path('graphql/', AsyncGraphQLView.as_view(graphiql=getattr(settings, 'DEBUG', False))),
     path('', current_info),
     path('django-rq/', include('django_rq.urls')),
     path('i18n/', include('django.conf.urls.i18n'))
@@ -1,6 +1,9 @@
-python manage.py rqworker &
+python manage.py rqworker --with-scheduler &
+python manage.py rqworker push &
+python manage.py rqworker uploads &
 python manage.py makemigrations &&
 python manage.py migrate &&
+python manage.py log_partitions &&
 python manage.py runserver 0.0.0.0:8000
 #gunicorn serverCjinn.asgi:application -c gunicorn.conf
 #gunicorn --bind 0.0.0.0:8000 serverCjinn.asgi -w 4 -k uvicorn.workers.UvicornWorker -t 30 -n "server_cjinn"
\ No newline at end of file